@@ -19,6 +19,7 @@ setup_lambda script
    limitations under the License.
 """
 
+import json
 import os
 from time import sleep
 
@@ -32,45 +33,55 @@ EVENTS_C = boto3.client('events')
 
 BASE_DIR = os.path.dirname(os.path.realpath(__file__))
 
-def setup_iam_role():
+# EC2 and autoscaling lifecycle events handled by zumoco for single instances
+INSTANCE_EVENT_PATTERN = {
+    'source': ['aws.ec2', 'aws.autoscaling'],
+    'detail-type': ['EC2 Instance State-change Notification',
+                    'EC2 Instance Launch Successful',
+                    'EC2 Instance Terminate Successful']
+}
+
+SERVICE_POLICIES = ['ec2_access', 'sns_access', 'cloudwatch_access', 'rds_access',
+                    'as_access', 's3_access', 'tag_access', 'sts_access']
+
+def setup_iam_role(role_name, policies):
     """
     Setup the AWS IAM role
     """
     try:
-        IAM_C.get_role(RoleName='aws_monitor')
+        IAM_C.get_role(RoleName=role_name)
     except ClientError as err:
         if err.response['Error']['Code'] == 'NoSuchEntity':
             with open('{}/lambda_role_policy.json'.format(BASE_DIR), 'r') as policy_file:
                 policy = policy_file.read()
-                IAM_C.create_role(RoleName='aws_monitor',
+                IAM_C.create_role(RoleName=role_name,
                                   AssumeRolePolicyDocument=policy)
         else:
             raise err
 
-    for pol in ['ec2_access', 'sns_access', 'cloudwatch_access', 'rds_access',
-                'as_access', 's3_access']:
+    for pol in policies:
         with open('{}/{}.json'.format(BASE_DIR, pol), 'r') as policy_file:
             policy = policy_file.read()
-            IAM_C.put_role_policy(RoleName='aws_monitor',
+            IAM_C.put_role_policy(RoleName=role_name,
                                   PolicyName=pol,
                                   PolicyDocument=policy)
     try:
-        IAM_C.get_instance_profile(InstanceProfileName='aws_monitor')
+        IAM_C.get_instance_profile(InstanceProfileName=role_name)
     except ClientError as err:
         if err.response['Error']['Code'] == 'NoSuchEntity':
-            IAM_C.create_instance_profile(InstanceProfileName='aws_monitor')
+            IAM_C.create_instance_profile(InstanceProfileName=role_name)
         else:
             raise err
 
-    role_instance_profiles = IAM_C.list_instance_profiles_for_role(RoleName='aws_monitor')
+    role_instance_profiles = IAM_C.list_instance_profiles_for_role(RoleName=role_name)
     add_instance_profile = True
     for profile in role_instance_profiles['InstanceProfiles']:
-        if profile['InstanceProfileName'] == 'aws_monitor':
+        if profile['InstanceProfileName'] == role_name:
             add_instance_profile = False
     if add_instance_profile:
-        IAM_C.add_role_to_instance_profile(InstanceProfileName='aws_monitor',
-                                           RoleName='aws_monitor')
-    return IAM_R.Role('aws_monitor')
+        IAM_C.add_role_to_instance_profile(InstanceProfileName=role_name,
+                                           RoleName=role_name)
+    return IAM_R.Role(role_name)
 
 def configure_vpc():
     """
@@ -85,13 +96,58 @@ def configure_vpc():
         vpc_config['SecurityGroupIds'] = [security_group_id]
     return vpc_config
 
+def deploy_function(name, role, description, zip_bytes, vpc_config):
+    """
+    Create or update a lambda function running zumoco from the zip
+    """
+    try:
+        LAMBDA_C.get_function(FunctionName=name)
+        return LAMBDA_C.update_function_code(FunctionName=name,
+                                             ZipFile=zip_bytes,
+                                             Publish=True)
+    except ClientError as err:
+        if err.response['Error']['Code'] == 'ResourceNotFoundException':
+            sleep(10)
+            return LAMBDA_C.create_function(FunctionName=name,
+                                            Code={'ZipFile': zip_bytes},
+                                            Runtime='python2.7',
+                                            Role=role.arn,
+                                            Handler='zumoco.main',
+                                            Timeout=300,
+                                            Description=description,
+                                            MemorySize=128,
+                                            VpcConfig=vpc_config)
+        raise err
+
+def add_rule_target(rule_name, target_id, rule, fcn):
+    """
+    Allow an EventBridge rule to invoke the function, and target it
+    """
+    try:
+        LAMBDA_C.add_permission(FunctionName='DiscoverInstances',
+                                StatementId='{}-Permission'.format(rule_name),
+                                Action='lambda:InvokeFunction',
+                                Principal='events.amazonaws.com',
+                                SourceArn=rule['RuleArn'])
+    except ClientError as err:
+        if err.response['Error']['Code'] != 'ResourceConflictException':
+            # ignore conflicts if the rule exists
+            raise err
+
+    EVENTS_C.put_targets(Rule=rule_name,
+                         Targets=[{'Id': target_id,
+                                   'Arn': fcn['FunctionArn'],}])
+
 def upload_lambda_function():
     """
     main function of deployment.
-    Ensure IAM is setup. Upload zip. Create function.
+    Ensure IAM is setup. Upload zip. Create functions.
+    The scheduled function may fan out to the worker function (team.json Sharding),
+    so its role may invoke the worker and the worker's role does not.
     """
     vpc_config = configure_vpc()
-    role = setup_iam_role()
+    role = setup_iam_role('aws_monitor', SERVICE_POLICIES + ['lambda_access'])
+    worker_role = setup_iam_role('aws_monitor_worker', SERVICE_POLICIES)
 
     rule = EVENTS_C.put_rule(Name='DiscoverInstancesSchedule',
                              ScheduleExpression=os.environ.get('DISCOVERY_SCHEDULE'),
@@ -100,41 +156,19 @@ def upload_lambda_function():
 
     with open('{}/../aws_monitor.zip'.format(BASE_DIR), 'rb') as zip_file:
         zip_bytes = zip_file.read()
-        fcn = {}
-        try:
-            LAMBDA_C.get_function(FunctionName='DiscoverInstances')
-            fcn = LAMBDA_C.update_function_code(FunctionName='DiscoverInstances',
-                                                ZipFile=zip_bytes,
-                                                Publish=True)
-        except ClientError as err:
-            if err.response['Error']['Code'] == 'ResourceNotFoundException':
-                sleep(10)
-                fcn = LAMBDA_C.create_function(FunctionName='DiscoverInstances',
-                                               Code={'ZipFile': zip_bytes},
-                                               Runtime='python2.7',
-                                               Role=role.arn,
-                                               Handler='zumoco.main',
-                                               Timeout=300,
-                                               Description="Discover, add cloudwatch alerts",
-                                               MemorySize=128,
-                                               VpcConfig=vpc_config)
-
-            else:
-                raise err
-
-        try:
-            LAMBDA_C.add_permission(FunctionName='DiscoverInstances',
-                                    StatementId='DiscoverInstancesSchedule-Permission',
-                                    Action='lambda:InvokeFunction',
-                                    Principal='events.amazonaws.com',
-                                    SourceArn=rule['RuleArn'])
-        except ClientError as err:
-            if err.response['Error']['Code'] != 'ResourceConflictException':
-                # ignore conflicts if the rule exists
-                raise err
-
-        EVENTS_C.put_targets(Rule='DiscoverInstancesSchedule',
-                             Targets=[{'Id': 'DiscoverInstances-schedule',
-                                       'Arn': fcn['FunctionArn'],}])
+        fcn = deploy_function('DiscoverInstances', role,
+                              'Discover, add cloudwatch alerts', zip_bytes, vpc_config)
+        deploy_function('DiscoverInstancesWorker', worker_role,
+                        'Discover, add cloudwatch alerts for one shard',
+                        zip_bytes, vpc_config)
+
+        add_rule_target('DiscoverInstancesSchedule', 'DiscoverInstances-schedule', rule, fcn)
+
+    # Lifecycle events add/remove single instances between scheduled runs
+    rule = EVENTS_C.put_rule(Name='DiscoverInstancesEvents',
+                             EventPattern=json.dumps(INSTANCE_EVENT_PATTERN),
+                             State='ENABLED',
+                             Description='Update alarms for launched/terminated instances')
+    add_rule_target('DiscoverInstancesEvents', 'DiscoverInstances-events', rule, fcn)
 
 upload_lambda_function()
@@ -0,0 +1,498 @@
+#!/usr/bin/env python
+"""
+   In-process fake of the AWS APIs zumoco calls,
+   used by tests/zumoco_bench.py to run zumoco against synthetic fleets.
+"""
+
+# Global imports
+import collections
+import hashlib
+import io
+import random
+import shutil
+import tempfile
+import threading
+import time
+
+from botocore import exceptions
+
+# Local imports
+import zumoco
+
+ACCOUNT = '123456789012'
+REGION = 'us-east-1'
+ZONES = ['us-east-1a', 'us-east-1b', 'us-east-1c']
+
+# operation -> (input token, output token, page size)
+PAGING = {
+    'describe_instances' : ('NextToken', 'NextToken', 1000),
+    'describe_db_instances' : ('Marker', 'Marker', 100),
+    'describe_auto_scaling_groups' : ('NextToken', 'NextToken', 100),
+    'describe_alarms' : ('NextToken', 'NextToken', 100),
+    'list_dashboards' : ('NextToken', 'NextToken', 1000),
+    'list_topics' : ('NextToken', 'NextToken', 100),
+    'get_resources' : ('PaginationToken', 'PaginationToken', 100),
+    'list_objects_v2' : ('ContinuationToken', 'NextContinuationToken', 1000),
+}
+
+# CloudWatch calls that may be throttled
+THROTTLED_OPS = ['put_metric_alarm', 'delete_alarms', 'put_dashboard', 'delete_dashboards',
+                 'describe_alarms', 'get_dashboard', 'list_dashboards']
+
+
+def client_error(code, operation, status=400):
+    """
+    Build a botocore ClientError as the real clients raise it
+    """
+    return exceptions.ClientError({'Error' : {'Code' : code, 'Message' : code},
+                                   'ResponseMetadata' : {'HTTPStatusCode' : status}},
+                                  operation)
+
+
+def page(items, kwargs, operation):
+    """
+    Return (page items, next token) for a paginated operation
+    """
+    in_token, _, size = PAGING[operation]
+    start = int(kwargs.get(in_token) or 0)
+    end = start + size
+    return items[start:end], (str(end) if end < len(items) else None)
+
+
+class FakePaginator(object):
+    """
+    Paginator over a FakeClient operation
+    """
+    def __init__(self, client, operation):
+        self.client = client
+        self.operation = operation
+
+    def paginate(self, **kwargs):
+        """
+        Yield each page of the operation
+        """
+        in_token, out_token, _ = PAGING[self.operation]
+        while True:
+            response = getattr(self.client, self.operation)(**kwargs)
+            yield response
+            if not response.get(out_token):
+                break
+            kwargs = dict(kwargs)
+            kwargs[in_token] = response[out_token]
+
+
+class FakeClientMeta(object): # pylint: disable=too-few-public-methods
+    """
+    Client meta, as botocore clients carry it
+    """
+    region_name = REGION
+
+
+class FakeClient(object):
+    """
+    Client for one service, dispatching calls to the FakeAWS backend
+    """
+    def __init__(self, backend, service):
+        self.backend = backend
+        self.service = service
+        self.meta = FakeClientMeta()
+
+    def get_paginator(self, operation):
+        """
+        Return a paginator for the operation
+        """
+        return FakePaginator(self, operation)
+
+    def __getattr__(self, operation):
+        handler = getattr(self.backend, self.service.replace('-', '') + '_' + operation)
+
+        def call(**kwargs):
+            """
+            Count, delay, and maybe throttle a single API call
+            """
+            self.backend.record(self.service, operation)
+            if self.backend.latency:
+                time.sleep(self.backend.latency)
+            if operation in THROTTLED_OPS and \
+               (self.backend.rand.random() < self.backend.throttle_rate or
+                self.backend.over_quota(operation)):
+                self.backend.record(self.service, operation + ':Throttling')
+                raise client_error('Throttling', operation)
+            return handler(**kwargs)
+        return call
+
+
+class FakeAWS(object):
+    """
+    Synthetic ec2, rds, autoscaling, cloudwatch, sns, s3 and tagging backend
+    """
+    def __init__(self, latency=0.0, throttle_rate=0.0, seed=0, quotas=None):
+        self.latency = latency
+        self.throttle_rate = throttle_rate
+        # operation -> calls per second allowed, beyond which calls are throttled
+        self.quotas = quotas or {}
+        self.recent = collections.defaultdict(collections.deque)
+        self.rand = random.Random(seed)
+        self.lock = threading.Lock()
+        self.calls = collections.Counter()
+        self.ec2 = []
+        self.rds = []
+        self.asgs = []
+        self.tags = {}
+        self.alarms = {}
+        self.dashboards = {}
+        self.topics = []
+        self.objects = {}
+        self.published = []
+        self.invocations = []
+        # (region, role ARN) -> clients requested
+        self.targets = collections.Counter()
+        self.saved = {}
+        self.tmpdir = None
+
+    # backend setup
+    def add_ec2_instances(self, count, name='web'):
+        """
+        Add running ec2 instances, with full-size describe records
+        """
+        for i in range(count):
+            inst_id = 'i-%017x' % (len(self.ec2) + 1)
+            self.ec2.append({
+                'InstanceId' : inst_id,
+                'InstanceType' : 'm5.large',
+                'ImageId' : 'ami-0123456789abcdef0',
+                'State' : {'Code' : 16, 'Name' : 'running'},
+                'Placement' : {'AvailabilityZone' : ZONES[i % len(ZONES)],
+                               'Tenancy' : 'default'},
+                'PrivateIpAddress' : '10.0.%d.%d' % (i // 250 % 250, i % 250),
+                'Tags' : [{'Key' : 'Name', 'Value' : '%s-%d' % (name, i)},
+                          {'Key' : 'aws:autoscaling:groupName',
+                           'Value' : '%s-asg-%d' % (name, i % 10)}],
+                'BlockDeviceMappings' : [{'DeviceName' : '/dev/xvda',
+                                          'Ebs' : {'VolumeId' : 'vol-%017x' % i,
+                                                   'Status' : 'attached'}}],
+                'NetworkInterfaces' : [{'NetworkInterfaceId' : 'eni-%017x' % i,
+                                        'SubnetId' : 'subnet-0123456789abcdef0',
+                                        'VpcId' : 'vpc-0123456789abcdef0'}],
+                'SecurityGroups' : [{'GroupId' : 'sg-0123456789abcdef0',
+                                     'GroupName' : 'default'}]})
+
+    def add_rds_instances(self, count):
+        """
+        Add rds instances, tagged through the tagging API only
+        """
+        for i in range(count):
+            ident = 'db-%d' % (len(self.rds) + 1)
+            arn = 'arn:aws:rds:%s:%s:db:%s' % (REGION, ACCOUNT, ident)
+            self.rds.append({'DBInstanceIdentifier' : ident,
+                             'DBInstanceArn' : arn,
+                             'DBInstanceClass' : 'db.r5.large',
+                             'Engine' : 'mysql',
+                             'AvailabilityZone' : ZONES[i % len(ZONES)]})
+            self.tags[arn] = [{'Key' : 'Name', 'Value' : 'database-%d' % i}]
+
+    def add_asgs(self, count):
+        """
+        Add autoscaling groups
+        """
+        for i in range(count):
+            self.asgs.append({'AutoScalingGroupName' : 'asg-%d' % (len(self.asgs) + 1),
+                              'AvailabilityZones' : ZONES,
+                              'Tags' : [{'Key' : 'Name', 'Value' : 'group-%d' % i}]})
+
+    def add_topics(self, arns):
+        """
+        Register SNS topics
+        """
+        self.topics.extend(arn for arn in arns if arn and arn not in self.topics)
+
+    def over_quota(self, operation):
+        """
+        Return whether a call exceeds the operation's quota over the last second
+        """
+        if operation not in self.quotas:
+            return False
+        now = time.time()
+        with self.lock:
+            recent = self.recent[operation]
+            while recent and recent[0] <= now - 1:
+                recent.popleft()
+            if len(recent) >= self.quotas[operation]:
+                return True
+            recent.append(now)
+            return False
+
+    def record(self, service, operation):
+        """
+        Count an API call
+        """
+        with self.lock:
+            self.calls[service + '.' + operation] += 1
+
+    # zumoco wiring
+    def client(self, service, region=None, config=None, role_arn=None): # pylint: disable=unused-argument
+        """
+        Stand-in for zumoco.get_client
+        """
+        with self.lock:
+            self.targets[(region, role_arn)] += 1
+        return FakeClient(self, service)
+
+    def install(self):
+        """
+        Route zumoco's clients to this backend, with empty caches
+        """
+        self.tmpdir = tempfile.mkdtemp()
+        self.saved = {'get_client' : zumoco.get_client,
+                      'STATE_CACHE_DIR' : zumoco.STATE_CACHE_DIR}
+        zumoco.get_client = self.client
+        zumoco.STATE_CACHE_DIR = self.tmpdir
+        reset_caches()
+
+    def uninstall(self):
+        """
+        Restore zumoco's clients
+        """
+        for name, value in self.saved.items():
+            setattr(zumoco, name, value)
+        reset_caches()
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+    # ec2
+    def ec2_describe_instances(self, **kwargs):
+        """
+        Fake ec2 describe_instances, one instance per reservation
+        """
+        if 'InstanceIds' in kwargs:
+            insts = [inst for inst in self.ec2 if inst['InstanceId'] in kwargs['InstanceIds']]
+            if not insts:
+                raise client_error('InvalidInstanceID.NotFound', 'describe_instances')
+            return {'Reservations' : [{'ReservationId' : 'r-' + inst['InstanceId'][2:],
+                                       'Instances' : [dict(inst)]} for inst in insts]}
+        insts, token = page(self.ec2, kwargs, 'describe_instances')
+        return {'Reservations' : [{'ReservationId' : 'r-' + inst['InstanceId'][2:],
+                                   'Instances' : [dict(inst)]} for inst in insts],
+                'NextToken' : token}
+
+    # rds
+    def rds_describe_db_instances(self, **kwargs):
+        """
+        Fake rds describe_db_instances
+        """
+        insts, token = page(self.rds, kwargs, 'describe_db_instances')
+        return {'DBInstances' : [dict(inst) for inst in insts], 'Marker' : token}
+
+    def rds_list_tags_for_resource(self, ResourceName):
+        """
+        Fake rds list_tags_for_resource
+        """
+        return {'TagList' : self.tags.get(ResourceName, [])}
+
+    # autoscaling
+    def autoscaling_describe_auto_scaling_groups(self, **kwargs):
+        """
+        Fake autoscaling describe_auto_scaling_groups
+        """
+        asgs, token = page(self.asgs, kwargs, 'describe_auto_scaling_groups')
+        return {'AutoScalingGroups' : [dict(asg) for asg in asgs], 'NextToken' : token}
+
+    # tagging
+    def resourcegroupstaggingapi_get_resources(self, **kwargs):
+        """
+        Fake resourcegroupstaggingapi get_resources by ARN list
+        """
+        arns = kwargs['ResourceARNList']
+        if len(arns) > 100:
+            raise client_error('InvalidParameterException', 'get_resources')
+        found = [{'ResourceARN' : arn, 'Tags' : self.tags[arn]}
+                 for arn in arns if self.tags.get(arn)]
+        return {'ResourceTagMappingList' : found, 'PaginationToken' : ''}
+
+    # cloudwatch
+    def cloudwatch_put_metric_alarm(self, **kwargs):
+        """
+        Fake cloudwatch put_metric_alarm
+        """
+        alarm = dict(kwargs)
+        alarm['AlarmArn'] = 'arn:aws:cloudwatch:%s:%s:alarm:%s' % (REGION, ACCOUNT,
+                                                                   kwargs['AlarmName'])
+        alarm['StateValue'] = 'INSUFFICIENT_DATA'
+        if 'Threshold' in alarm:
+            alarm['Threshold'] = float(alarm['Threshold'])
+        alarm.setdefault('OKActions', [])
+        alarm.setdefault('Dimensions', [])
+        with self.lock:
+            self.alarms[kwargs['AlarmName']] = alarm
+        return {}
+
+    def cloudwatch_describe_alarms(self, **kwargs):
+        """
+        Fake cloudwatch describe_alarms by AlarmNamePrefix
+        """
+        prefix = kwargs.get('AlarmNamePrefix', '')
+        with self.lock:
+            names = sorted(name for name in self.alarms if name.startswith(prefix))
+        names, token = page(names, kwargs, 'describe_alarms')
+        with self.lock:
+            alarms = [dict(self.alarms[name]) for name in names if name in self.alarms]
+        return {'MetricAlarms' : alarms, 'CompositeAlarms' : [], 'NextToken' : token}
+
+    def cloudwatch_delete_alarms(self, AlarmNames):
+        """
+        Fake cloudwatch delete_alarms, limited to 100 names
+        """
+        if len(AlarmNames) > 100:
+            raise client_error('ValidationError', 'delete_alarms')
+        with self.lock:
+            for name in AlarmNames:
+                self.alarms.pop(name, None)
+        return {}
+
+    def cloudwatch_put_dashboard(self, DashboardName, DashboardBody):
+        """
+        Fake cloudwatch put_dashboard
+        """
+        with self.lock:
+            self.dashboards[DashboardName] = DashboardBody
+        return {'DashboardValidationMessages' : []}
+
+    def cloudwatch_get_dashboard(self, DashboardName):
+        """
+        Fake cloudwatch get_dashboard
+        """
+        with self.lock:
+            if DashboardName not in self.dashboards:
+                raise client_error('ResourceNotFound', 'get_dashboard', 404)
+            return {'DashboardName' : DashboardName,
+                    'DashboardBody' : self.dashboards[DashboardName]}
+
+    def cloudwatch_list_dashboards(self, **kwargs):
+        """
+        Fake cloudwatch list_dashboards by DashboardNamePrefix
+        """
+        prefix = kwargs.get('DashboardNamePrefix', '')
+        with self.lock:
+            names = sorted(name for name in self.dashboards if name.startswith(prefix))
+        names, token = page(names, kwargs, 'list_dashboards')
+        return {'DashboardEntries' : [{'DashboardName' : name} for name in names],
+                'NextToken' : token}
+
+    def cloudwatch_delete_dashboards(self, DashboardNames):
+        """
+        Fake cloudwatch delete_dashboards
+        """
+        with self.lock:
+            for name in DashboardNames:
+                self.dashboards.pop(name, None)
+        return {}
+
+    # sns
+    def sns_list_topics(self, **kwargs):
+        """
+        Fake sns list_topics
+        """
+        topics, token = page(self.topics, kwargs, 'list_topics')
+        return {'Topics' : [{'TopicArn' : arn} for arn in topics], 'NextToken' : token}
+
+    def sns_get_topic_attributes(self, TopicArn):
+        """
+        Fake sns get_topic_attributes
+        """
+        if TopicArn not in self.topics:
+            raise client_error('NotFound', 'get_topic_attributes', 404)
+        return {'Attributes' : {'TopicArn' : TopicArn}}
+
+    def sns_publish(self, **kwargs):
+        """
+        Fake sns publish
+        """
+        with self.lock:
+            self.published.append(kwargs)
+        return {'MessageId' : str(len(self.published))}
+
+    # s3
+    def s3_get_object(self, Bucket, Key, IfNoneMatch=None):
+        """
+        Fake s3 get_object, honouring IfNoneMatch
+        """
+        with self.lock:
+            if (Bucket, Key) not in self.objects:
+                raise client_error('NoSuchKey', 'get_object', 404)
+            body, etag = self.objects[(Bucket, Key)]
+        if IfNoneMatch == etag:
+            raise client_error('304', 'get_object', 304)
+        return {'Body' : io.BytesIO(body), 'ETag' : etag}
+
+    def s3_put_object(self, Bucket, Key, Body, IfMatch=None, IfNoneMatch=None,
+                      **kwargs): # pylint: disable=unused-argument
+        """
+        Fake s3 put_object, honouring the IfMatch and IfNoneMatch='*' conditions
+        """
+        etag = '"' + hashlib.md5(Body).hexdigest() + '"'
+        with self.lock:
+            current = self.objects.get((Bucket, Key), (None, None))[1]
+            if (IfNoneMatch == '*' and current is not None) or \
+               (IfMatch is not None and IfMatch != current):
+                raise client_error('PreconditionFailed', 'put_object', 412)
+            self.objects[(Bucket, Key)] = (Body, etag)
+        return {'ETag' : etag, 'ResponseMetadata' : {'HTTPStatusCode' : 200}}
+
+    def s3_delete_object(self, Bucket, Key):
+        """
+        Fake s3 delete_object
+        """
+        with self.lock:
+            self.objects.pop((Bucket, Key), None)
+        return {}
+
+    def s3_list_objects_v2(self, Bucket, Prefix='', **kwargs):
+        """
+        Fake s3 list_objects_v2
+        """
+        with self.lock:
+            keys = sorted(key for bucket, key in self.objects
+                          if bucket == Bucket and key.startswith(Prefix))
+        keys, token = page(keys, kwargs, 'list_objects_v2')
+        return {'Contents' : [{'Key' : key} for key in keys], 'KeyCount' : len(keys),
+                'NextContinuationToken' : token}
+
+    def s3_delete_objects(self, Bucket, Delete):
+        """
+        Fake s3 delete_objects
+        """
+        with self.lock:
+            for obj in Delete['Objects']:
+                self.objects.pop((Bucket, obj['Key']), None)
+        return {'Deleted' : Delete['Objects']}
+
+    # lambda
+    def lambda_invoke(self, FunctionName, InvocationType, Payload):
+        """
+        Fake lambda invoke, queueing asynchronous invocations
+        """
+        with self.lock:
+            self.invocations.append((FunctionName, InvocationType, Payload))
+        return {'StatusCode' : 202}
+
+
+def add_team_topics(backend, team_info):
+    """
+    Register every monitordef's SNS topics
+    """
+    for svc in team_info['MonitorDefs']:
+        svc_info = zumoco.load_monitor_file(zumoco.DEFS_PATH + svc)
+        backend.add_topics(svc_info['AlarmDestinations'].values())
+        backend.add_topics([svc_info['ReportARN']])
+
+
+def reset_caches():
+    """
+    Empty zumoco's warm-invocation caches
+    """
+    zumoco.TAG_CACHE.clear()
+    zumoco.STATE_CACHE.clear()
+    zumoco.DASHBOARD_HASHES.clear()
+    zumoco.TOPIC_VALID.clear()
+    zumoco.TOPIC_CACHE.clear()
+    zumoco.CLOUDWATCH_RATES.buckets.clear()
+    zumoco.CLOUDWATCH_RATES.reset_budget()
@@ -0,0 +1,312 @@
+#!/usr/bin/env python
+"""
+   Benchmarks for zumoco.py, run offline against tests/fake_aws.py
+   Called via python -m tests.zumoco_bench [--latency-ms=N]
+   [--import-budget-ms=N] [instance counts...]
+"""
+
+# Global imports
+import collections
+import contextlib
+import io
+import json
+import logging
+import os
+import subprocess
+import sys
+import time
+import timeit
+import tracemalloc
+
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+
+# Local imports
+import zumoco
+from tests.fake_aws import FakeAWS, add_team_topics
+from tests.zumoco_tests import TestZumoco
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_SIZES = [100, 1000, 5000]
+# the fake backend has no CloudWatch quotas
+BENCH_CLOUDWATCH_TPS = 100000
+# fraction of the fleet replaced between the previous and current run
+CHURN = 0.05
+BENCH_SHARDS = 4
+IMPORT_RUNS = 5
+# time a fresh interpreter importing zumoco, then creating its first client
+COLD_START_SCRIPT = """
+import time
+start = time.time()
+import zumoco
+imported = time.time()
+zumoco.get_client('cloudwatch')
+print('%f %f' % (imported - start, time.time() - imported))
+"""
+
+
+def make_instances(count):
+    """
+    Build a synthetic ec2 fleet
+    """
+    return [{'myname' : 'zumocotest_ec2_bench_i-%08d' % i,
+             'InstanceId' : 'i-%08d' % i,
+             'Placement' : {'AvailabilityZone' : 'us-east-1a'}}
+            for i in range(count)]
+
+
+def make_alarms(insts, svc_info):
+    """
+    Build the alarms describe_alarms would return for the fleet
+    """
+    return [{'AlarmName' : inst['myname'] + '_' + alarm,
+             'AlarmArn' : 'arn:aws:cloudwatch:us-east-1:123456789012:alarm:' +
+                          inst['myname'] + '_' + alarm,
+             'MetricName' : svc_info['Alarms'][alarm]['MetricName'],
+             'Dimensions' : [{'Name' : svc_info['AlarmDimName'],
+                              'Value' : inst[svc_info['AlarmDimName']]}]}
+            for inst in insts for alarm in svc_info['Alarms']]
+
+
+def scan_widget_alarms(svc_inst, alarms, svc_info):
+    """
+    Reference: the original linear alarm scan per (instance, chart)
+    """
+    arns = []
+    for inst in svc_inst:
+        for chart in svc_info['Charts'].values():
+            if not chart['is_alarm']:
+                continue
+            for alarm in alarms:
+                if alarm['MetricName'] in chart['metric_list']:
+                    if alarm['Dimensions'][0]['Value'] == inst[svc_info['AlarmDimName']]:
+                        arns.append(alarm['AlarmArn'])
+                        break
+    return arns
+
+
+def bench_dashboard_widgets(sizes):
+    """
+    Compare indexed widget construction against the linear alarm scan
+    """
+    svc_info = TestZumoco.svcinfo_helper()
+    print('build_dashboard_widgets (seconds)')
+    print('%10s %10s %12s %12s' % ('instances', 'alarms', 'indexed', 'linear scan'))
+    for size in sizes:
+        insts = make_instances(size)
+        alarms = make_alarms(insts, svc_info)
+        indexed = min(timeit.repeat(
+            lambda: zumoco.build_dashboard_widgets(insts, alarms, svc_info),
+            number=1, repeat=3))
+        # the linear scan is quadratic; skip it where it would take minutes
+        if size <= 2000:
+            linear = '%12.3f' % min(timeit.repeat(
+                lambda: scan_widget_alarms(insts, alarms, svc_info),
+                number=1, repeat=1))
+        else:
+            linear = '%12s' % 'skipped'
+        print('%10d %10d %12.3f %s' % (size, len(alarms), indexed, linear))
+
+
+def measure(backend, func, *args):
+    """
+    Run func, returning (result, seconds, peak traced bytes, API calls made)
+    """
+    before = collections.Counter(backend.calls)
+    tracemalloc.start()
+    start = time.time()
+    result = func(*args)
+    wall = time.time() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return result, wall, peak, backend.calls - before
+
+
+def print_measure(size, stage, wall, peak, calls):
+    """
+    Print one benchmark row
+    """
+    print('%10d %-24s %10.3f %10.1f %8d' % (size, stage, wall, peak / 1048576.0,
+                                            sum(calls.values())))
+
+
+def print_calls(calls):
+    """
+    Print API call counts per operation
+    """
+    for operation in sorted(calls):
+        print('%44s %8d' % (operation, calls[operation]))
+
+
+def bench_stages(sizes, latency):
+    """
+    Time each zumoco stage against a synthetic ec2 fleet
+    """
+    print('stages, %.1f ms per call (seconds, peak MB, API calls)' % (latency * 1000))
+    print('%10s %-24s %10s %10s %8s' % ('instances', 'stage', 'wall', 'peak MB', 'calls'))
+    for size in sizes:
+        backend = FakeAWS(latency=latency)
+        backend.add_ec2_instances(size)
+        svc_info = TestZumoco.svcinfo_helper()
+        backend.add_topics(svc_info['AlarmDestinations'].values())
+        backend.install()
+        try:
+            client = zumoco.get_client('ec2')
+            instances, wall, peak, calls = measure(backend, zumoco.get_service_instances,
+                                                   client, svc_info)
+            print_measure(size, 'get_service_instances', wall, peak, calls)
+
+            churn = int(size * CHURN)
+            previous = [zumoco.compact_instance(inst, 'InstanceId')
+                        for inst in instances[churn:]]
+            previous.extend({'myname' : 'zumocotest_ec2_gone_%d' % i,
+                             'InstanceId' : 'i-gone%d' % i} for i in range(churn))
+            _, wall, peak, calls = measure(backend, zumoco.determine_deltas,
+                                           list(instances), previous)
+            print_measure(size, 'determine_deltas', wall, peak, calls)
+
+            alarms, wall, peak, calls = measure(backend, zumoco.create_service_alarms,
+                                                instances, client, svc_info)
+            print_measure(size, 'create_service_alarms', wall, peak, calls)
+
+            widgets, wall, peak, calls = measure(backend, zumoco.build_dashboard_widgets,
+                                                 instances, alarms, svc_info)
+            print_measure(size, 'build_dashboard_widgets', wall, peak, calls)
+
+            name = svc_info['AlarmPrefix'] + '_' + svc_info['Service']
+            _, wall, peak, calls = measure(backend, zumoco.generate_dashboard,
+                                           name, {'widgets' : widgets})
+            print_measure(size, 'generate_dashboard', wall, peak, calls)
+
+            # the stages above (alarms for every instance) as one streaming pass
+            del instances, alarms, widgets
+            backend.alarms.clear()
+            _, wall, peak, calls = measure(backend, zumoco.stream_service_instances,
+                                           client, svc_info, [])
+            print_measure(size, 'stream_service_instances', wall, peak, calls)
+        finally:
+            backend.uninstall()
+
+
+def bench_main(sizes, latency):
+    """
+    Time main() end to end, for the first run and an unchanged second run,
+    with ec2 fleets of the given sizes plus 10% as many asgs and rds instances
+    """
+    print('main, %.1f ms per call (seconds, peak MB, API calls)' % (latency * 1000))
+    print('%10s %-24s %10s %10s %8s' % ('instances', 'run', 'wall', 'peak MB', 'calls'))
+    team_info = zumoco.load_monitor_file(zumoco.TEAM_FILEPATH)
+    for size in sizes:
+        backend = FakeAWS(latency=latency)
+        backend.add_ec2_instances(size)
+        backend.add_asgs(max(size // 10, 1))
+        backend.add_rds_instances(max(size // 10, 1))
+        add_team_topics(backend, team_info)
+        backend.install()
+        try:
+            runs = []
+            for run in ['first run', 'unchanged run']:
+                # keep main's EMF metric lines out of the report
+                with contextlib.redirect_stdout(io.StringIO()):
+                    _, wall, peak, calls = measure(backend, zumoco.main, {}, None)
+                print_measure(size, run, wall, peak, calls)
+                runs.append(calls)
+            for run, calls in zip(['first run', 'unchanged run'], runs):
+                print('  %s API calls:' % run)
+                print_calls(calls)
+        finally:
+            backend.uninstall()
+
+
+def bench_sharded(sizes, latency, shards=BENCH_SHARDS):
+    """
+    Time a first run of main() in Sharding mode: the orchestrator, then each
+    worker it invoked. Workers run one after another here, so the slowest
+    worker approximates the wall time of the fanned-out run.
+    """
+    print('sharded main, %d shards, %.1f ms per call (seconds, API calls)' %
+          (shards, latency * 1000))
+    print('%10s %10s %10s %10s %12s' % ('instances', 'workers', 'slowest', 'total',
+                                        'dashboards'))
+    team_info = zumoco.load_monitor_file(zumoco.TEAM_FILEPATH)
+    team_info['Sharding'] = {'WorkerFunction' : 'DiscoverInstancesWorker',
+                             'Shards' : shards}
+    load_monitor_file = zumoco.load_monitor_file
+    for size in sizes:
+        backend = FakeAWS(latency=latency)
+        backend.add_ec2_instances(size)
+        backend.add_asgs(max(size // 10, 1))
+        backend.add_rds_instances(max(size // 10, 1))
+        add_team_topics(backend, team_info)
+        backend.install()
+        zumoco.load_monitor_file = lambda name: (team_info if name == zumoco.TEAM_FILEPATH
+                                                 else load_monitor_file(name))
+        try:
+            with contextlib.redirect_stdout(io.StringIO()):
+                zumoco.main({}, None)
+                walls = []
+                for _, _, payload in backend.invocations:
+                    start = time.time()
+                    zumoco.main(json.loads(payload), None)
+                    walls.append(time.time() - start)
+            print('%10d %10d %10.3f %10.3f %12d' % (size, len(walls), max(walls), sum(walls),
+                                                    len(backend.dashboards)))
+        finally:
+            zumoco.load_monitor_file = load_monitor_file
+            backend.uninstall()
+
+
+def bench_cold_start(budget_ms=None):
+    """
+    Measure zumoco's import time and first client creation in fresh
+    interpreters. Return False if the median import exceeds budget_ms.
+    """
+    imports = []
+    clients = []
+    for _ in range(IMPORT_RUNS):
+        out = subprocess.check_output([sys.executable, '-c', COLD_START_SCRIPT],
+                                      cwd=ROOT, env=dict(os.environ))
+        import_s, client_s = out.decode('utf-8').split()
+        imports.append(float(import_s) * 1000)
+        clients.append(float(client_s) * 1000)
+    import_ms = sorted(imports)[len(imports) // 2]
+    client_ms = sorted(clients)[len(clients) // 2]
+    print('cold start (median of %d, ms)' % IMPORT_RUNS)
+    print('%16s %10.1f' % ('import zumoco', import_ms))
+    print('%16s %10.1f' % ('first client', client_ms))
+    if budget_ms is not None and import_ms > budget_ms:
+        print('import time over budget of %.1f ms' % budget_ms)
+        return False
+    return True
+
+
+def main(argv):
+    """
+    Run all benchmarks
+    """
+    budget_ms = None
+    latency = 0.0
+    sizes = []
+    for arg in argv:
+        if arg.startswith('--import-budget-ms='):
+            budget_ms = float(arg.split('=', 1)[1])
+        elif arg.startswith('--latency-ms='):
+            latency = float(arg.split('=', 1)[1]) / 1000
+        else:
+            sizes.append(int(arg))
+    sizes = sizes or DEFAULT_SIZES
+    # monitordefs are loaded relative to the repository root
+    os.chdir(ROOT)
+    zumoco.Logger.setLevel(logging.ERROR)
+    for operation in zumoco.CLOUDWATCH_TPS:
+        zumoco.CLOUDWATCH_RATES.set_rate(operation, BENCH_CLOUDWATCH_TPS)
+
+    within_budget = bench_cold_start(budget_ms)
+    bench_dashboard_widgets(sizes)
+    bench_stages(sizes, latency)
+    bench_main(sizes, latency)
+    bench_sharded(sizes, latency)
+    return 0 if within_budget else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
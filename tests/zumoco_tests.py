@@ -5,14 +5,20 @@
 """
 
 # Global imports
+import copy
+import datetime
+import json
+import shutil
+import tempfile
 import unittest
 
 from time import strftime
 import boto3
-import parsedatetime as pdt
+from botocore.stub import Stubber
 
 # Local imports
 import zumoco
+from tests.fake_aws import FakeAWS, add_team_topics
 
 
 class TestZumoco(unittest.TestCase):
@@ -20,11 +26,8 @@ class TestZumoco(unittest.TestCase):
     Standard test class, for all zumoco functions
     """
     Bucket = '<REPLACE_BUCKET>'
-    cons = pdt.Constants()
-    cons.YearParseStyle = 0
-    Pdtcal = pdt.Calendar(cons)
-    Now_tm = Pdtcal.parse("now")
-    Now_str = strftime('%c', Now_tm[0])
+    Now_str = strftime('%c')
+
     @staticmethod
     def svcinfo_helper():
         """
@@ -175,17 +178,47 @@ class TestZumoco(unittest.TestCase):
 
     def setUp(self):
         """
-        set up if needed
+        set up if needed: each test gets its own state cache directory
+        and empty module caches
         """
         print("Ensure there are >= 2 ec2 instances in account.")
         print("Also, copy the two test files to your s3 test bucket.")
+        self.backend = None
+        self.state_dir = zumoco.STATE_CACHE_DIR
+        zumoco.STATE_CACHE_DIR = tempfile.mkdtemp()
+        self.caches = [(cache, cache.copy()) for cache in
+                       (zumoco.TAG_CACHE, zumoco.STATE_CACHE, zumoco.DASHBOARD_HASHES,
+                        zumoco.TOPIC_VALID, zumoco.TOPIC_CACHE,
+                        zumoco.CLOUDWATCH_RATES.buckets)]
+        for cache, _ in self.caches:
+            cache.clear()
+        self.caches.append((zumoco.CLOUDWATCH_RATES.rates,
+                            zumoco.CLOUDWATCH_RATES.rates.copy()))
 
 
     def tearDown(self):
         """
-        tear down!
+        tear down! removes the test's backend and state cache directory,
+        and restores the caches
         """
-        pass
+        if self.backend:
+            self.backend.uninstall()
+        shutil.rmtree(zumoco.STATE_CACHE_DIR, ignore_errors=True)
+        zumoco.STATE_CACHE_DIR = self.state_dir
+        for cache, saved in self.caches:
+            cache.clear()
+            cache.update(saved)
+
+    def fake_aws(self, **kwargs):
+        """
+        Route zumoco's clients to a FakeAWS backend until the test ends,
+        with CloudWatch rates limited only by its quotas
+        """
+        self.backend = FakeAWS(**kwargs)
+        self.backend.install()
+        for operation in zumoco.CLOUDWATCH_TPS:
+            zumoco.CLOUDWATCH_RATES.set_rate(operation, 100000)
+        return self.backend
 
 
     def test_load_monitor_file(self):
@@ -217,6 +250,85 @@ class TestZumoco(unittest.TestCase):
         instances = zumoco.get_service_instances(test_client, test_info)
         self.assertGreaterEqual(len(instances), 2)
 
+    def test_project_instance(self):
+        """
+        Test instances are reduced to the fields alarms and dashboards use
+        """
+        test_info = self.svcinfo_helper()
+        inst = {'myname' : 'zumocotest_ec2_foo', 'InstanceId' : 'i-0123',
+                'Placement' : {'AvailabilityZone' : 'us-east-1a'},
+                'BlockDeviceMappings' : [{'DeviceName' : '/dev/xvda'}]}
+        record = zumoco.project_instance(inst, test_info)
+        self.assertEqual(set(record.keys()), set(['myname', 'myfingerprint',
+                                                  'InstanceId', 'Placement']))
+        self.assertEqual(record['myfingerprint'], zumoco.fingerprint_instance(inst))
+
+    def test_in_shard(self):
+        """
+        Test every instance belongs to exactly one shard
+        """
+        test_info = self.svcinfo_helper()
+        insts = [{'InstanceId' : 'i-%04d' % i} for i in range(50)]
+        for inst in insts:
+            owners = [i for i in range(4) if zumoco.in_shard(inst, test_info, (i, 4))]
+            self.assertEqual(len(owners), 1)
+            self.assertTrue(zumoco.in_shard(inst, test_info, None))
+        self.assertEqual(zumoco.shard_suffix((2, 4)), '_shard2of4')
+        self.assertEqual(zumoco.shard_suffix((0, 1)), '')
+
+    def test_prioritize_alarms(self):
+        """
+        Test critical alarms are written first, and unfinished instances found
+        """
+        test_info = self.svcinfo_helper()
+        order = zumoco.prioritize_alarms(test_info['Alarms'])
+        actions = [test_info['Alarms'][alarm]['AlarmAction'] for alarm in order]
+        self.assertEqual(actions, sorted(actions, key=lambda a: a != 'critical'))
+        insts = [{'myname' : 'zumocotest_ec2_a'}, {'myname' : 'zumocotest_ec2_b'}]
+        results = {'zumocotest_ec2_a_' + order[0] : True,
+                   'zumocotest_ec2_b_' + order[0] : None}
+        unfinished = zumoco.unfinished_instances(insts, test_info, results)
+        self.assertEqual(unfinished, [insts[1]])
+
+    def test_time_budget(self):
+        """
+        Test the time budget follows the Lambda context, less its reserve
+        """
+        class FakeContext(object):
+            """
+            Lambda context with 40s remaining
+            """
+            @staticmethod
+            def get_remaining_time_in_millis():
+                return 40000
+        budget = zumoco.TimeBudget()
+        self.assertFalse(budget.exhausted())
+        budget.start(FakeContext(), reserve_ms=30000)
+        self.assertFalse(budget.exhausted())
+        self.assertTrue(budget.exhausted(needed=11))
+        budget.defer('ec2_TeamFoo.json')
+        budget.defer('ec2_TeamFoo.json')
+        self.assertEqual(budget.deferred, ['ec2_TeamFoo.json'])
+
+    def test_parse_instance_event(self):
+        """
+        Test EventBridge lifecycle events map to (instance id, may be running)
+        """
+        event = {'source' : 'aws.ec2',
+                 'detail-type' : 'EC2 Instance State-change Notification',
+                 'detail' : {'instance-id' : 'i-0123', 'state' : 'running'}}
+        self.assertEqual(zumoco.parse_instance_event(event), ('i-0123', True))
+        event['detail']['state'] = 'terminated'
+        self.assertEqual(zumoco.parse_instance_event(event), ('i-0123', False))
+        event = {'source' : 'aws.autoscaling',
+                 'detail-type' : 'EC2 Instance Launch Successful',
+                 'detail' : {'EC2InstanceId' : 'i-4567'}}
+        self.assertEqual(zumoco.parse_instance_event(event), ('i-4567', True))
+        event['detail-type'] = 'EC2 Instance-launch Lifecycle Action'
+        self.assertIsNone(zumoco.parse_instance_event(event))
+        self.assertIsNone(zumoco.parse_instance_event({}))
+        self.assertIsNone(zumoco.parse_instance_event('foo'))
+
     def test_get_si_tag_value(self):
         """
         Test the method used for retrieving service instance tag value
@@ -232,6 +344,34 @@ class TestZumoco(unittest.TestCase):
         self.assertGreaterEqual(len(name), len(tagvalue))
 
 
+    def test_resolve_instance_tags(self):
+        """
+        Test bulk tag resolution is served from the ARN tag cache
+        """
+        test_info = self.svcinfo_helper()
+        test_info['DiscoverTags'] = 'list_tags_for_resource(ResourceName='
+        test_info['DiscoverTagsInstParm'] = 'DBInstanceArn'
+        test_info['TagsKey'] = 'TagList'
+        arn = 'arn:aws:rds:us-east-1:123456789012:db:zumocotest'
+        zumoco.TAG_CACHE[arn] = (zumoco.time.time(), [{'Key':'Name', 'Value':'dbfoo'}])
+        insts = [{'DBInstanceArn' : arn, 'InstanceId' : 'zumocotest'}]
+        zumoco.resolve_instance_tags(insts, test_info)
+        self.assertEqual(insts[0]['TagList'][0]['Value'], 'dbfoo')
+        tagvalue = zumoco.get_service_instance_tag_value(insts[0], None, test_info,
+                                                         test_info['FriendlyName'])
+        self.assertEqual(tagvalue, 'dbfoo')
+
+        # caching new tags drops expired entries, and the oldest beyond TAG_CACHE_MAX
+        now = zumoco.time.time()
+        zumoco.TAG_CACHE['expired'] = (now - zumoco.TAG_CACHE_TTL - 1, [])
+        max_tags = zumoco.TAG_CACHE_MAX
+        zumoco.TAG_CACHE_MAX = 2
+        try:
+            zumoco.cache_resource_tags({'new1' : [], 'new2' : []}, now + 1)
+        finally:
+            zumoco.TAG_CACHE_MAX = max_tags
+        self.assertEqual(sorted(zumoco.TAG_CACHE), ['new1', 'new2'])
+
     def test_readwrite_cmp_instances(self):
         """
         Test the method used for reading/writing/comparing instances
@@ -256,6 +396,50 @@ class TestZumoco(unittest.TestCase):
         self.assertEqual(del_insts.pop(), last_inst)
 
 
+    def test_compress_state(self):
+        """
+        Test the compact state format, and migration of legacy state files
+        """
+        with open('tests/ec2_test_new.json', 'rb') as legacy_file:
+            legacy = legacy_file.read()
+        insts = zumoco.decompress_state(legacy, 'InstanceId')
+        self.assertEqual(len(insts), 1)
+        self.assertEqual(set(insts[0].keys()),
+                         set(['myname', 'myfingerprint', 'InstanceId']))
+        state = {'zumocoStateFormatVersion' : zumoco.STATE_FORMAT_VERSION,
+                 'Instances' : insts}
+        raw = zumoco.compress_state(state)
+        self.assertLess(len(raw), len(legacy))
+        self.assertEqual(zumoco.decompress_state(raw, 'InstanceId'), insts)
+
+    def test_state_cache(self):
+        """
+        Test state files are cached by ETag, in memory and in /tmp
+        """
+        insts = [{'myname' : 'zumocotest_ec2_foo', 'myfingerprint' : '0'}]
+        raw = zumoco.compress_state({'Instances' : insts})
+        zumoco.cache_state(self.Bucket, 'zumocotest.json', '"etag1"', raw, insts)
+        self.assertEqual(zumoco.get_cached_state(self.Bucket, 'zumocotest.json'),
+                         ('"etag1"', insts))
+        zumoco.STATE_CACHE.clear()
+        self.assertEqual(zumoco.get_cached_state(self.Bucket, 'zumocotest.json'),
+                         ('"etag1"', insts))
+        self.assertEqual(zumoco.get_cached_state(self.Bucket, 'missing.json'),
+                         (None, None))
+
+        # the in-memory limit counts the uncompressed instances, not the gzip body
+        big = [{'myname' : 'zumocotest_ec2_%d' % i, 'myfingerprint' : '0'} for i in range(2000)]
+        raw = zumoco.compress_state({'Instances' : big})
+        self.assertEqual(zumoco.state_body_size(raw),
+                         len(json.dumps({'Instances' : big}).encode('utf-8')))
+        max_bytes = zumoco.STATE_CACHE_MAX_BYTES
+        zumoco.STATE_CACHE_MAX_BYTES = zumoco.state_body_size(raw)
+        try:
+            zumoco.cache_state(self.Bucket, 'big.json', '"etag2"', raw, big)
+        finally:
+            zumoco.STATE_CACHE_MAX_BYTES = max_bytes
+        self.assertEqual(list(zumoco.STATE_CACHE), [(self.Bucket, 'big.json')])
+
     def test_create_service_alarms(self):
         """
         Test the method used for creating cloudwatch alarms
@@ -267,6 +451,65 @@ class TestZumoco(unittest.TestCase):
         self.assertEqual(len(test_alarms), len(test_info['Alarms'])*len(instances))
         self.assertGreaterEqual(len(test_alarms), 2)
 
+    def test_build_alarm_params(self):
+        """
+        Test the put_metric_alarm arguments built for an instance alarm
+        """
+        test_info = self.svcinfo_helper()
+        inst = {'myname' : 'zumocotest_ec2_foo', 'InstanceId' : 'i-0123'}
+        targets = {'critical' : 'arn:critical'}
+        params = zumoco.build_alarm_params(inst, 'CPUUtilization',
+                                           test_info['Alarms']['CPUUtilization'],
+                                           test_info, targets)
+        self.assertEqual(params['AlarmName'], 'zumocotest_ec2_foo_CPUUtilization')
+        self.assertEqual(params['Dimensions'][0]['Value'], 'i-0123')
+        self.assertEqual(params['OKActions'], ['arn:critical'])
+        with self.assertRaises(KeyError):
+            zumoco.build_alarm_params(inst, 'DiskReadBytes',
+                                      test_info['Alarms']['DiskReadBytes'],
+                                      test_info, targets)
+
+    def test_build_group_alarm_params(self):
+        """
+        Test an Aggregate alarm queries the group's members with Metrics Insights
+        """
+        test_info = self.svcinfo_helper()
+        alarm_def = dict(test_info['Alarms']['CPUUtilization'],
+                         Aggregate={'GroupBy' : 'AutoScalingGroupName',
+                                    'GroupTag' : 'aws:autoscaling:groupName'})
+        test_info['Alarms']['CPUUtilization'] = alarm_def
+        targets = {'critical' : 'arn:critical'}
+        params = zumoco.build_group_alarm_params('web', 'CPUUtilization', alarm_def,
+                                                 test_info, targets)
+        self.assertEqual(params['AlarmName'],
+                         'zumocotest_ec2_test_inst_group_web_CPUUtilization')
+        self.assertEqual(params['Metrics'][0]['Expression'],
+                         'SELECT MAX(CPUUtilization) FROM SCHEMA("AWS/EC2", ' +
+                         "AutoScalingGroupName) WHERE AutoScalingGroupName = 'web'")
+        self.assertNotIn('Dimensions', params)
+        self.assertNotIn('CPUUtilization', zumoco.instance_alarms(test_info['Alarms']))
+        inst = {'Tags' : [{'Key' : 'aws:autoscaling:groupName', 'Value' : 'web'}]}
+        self.assertEqual(zumoco.group_value(inst, test_info, 'aws:autoscaling:groupName'),
+                         'web')
+
+    def test_fingerprint_alarm(self):
+        """
+        Test alarm fingerprints match between put arguments and describe_alarms
+        """
+        test_info = self.svcinfo_helper()
+        inst = {'myname' : 'zumocotest_ec2_foo', 'InstanceId' : 'i-0123'}
+        targets = {'critical' : 'arn:critical'}
+        params = zumoco.build_alarm_params(inst, 'CPUUtilization',
+                                           test_info['Alarms']['CPUUtilization'],
+                                           test_info, targets)
+        described = dict(params, Threshold=60.0, AlarmArn='arn:alarm',
+                         StateValue='OK', TreatMissingData='missing')
+        self.assertEqual(zumoco.fingerprint_alarm(params),
+                         zumoco.fingerprint_alarm(described))
+        described['Threshold'] = 70.0
+        self.assertNotEqual(zumoco.fingerprint_alarm(params),
+                            zumoco.fingerprint_alarm(described))
+
     def test_get_delete_service_alarms(self):
         """
         Test the method used for retrieving and deleting cloudwatch alarms
@@ -282,6 +525,53 @@ class TestZumoco(unittest.TestCase):
                                                 alarm_list=['All'])
         self.assertEqual(len(test_alarms), 0)
 
+    def test_match_instance_alarms(self):
+        """
+        Test matching deleted instances' alarms against an alarm inventory
+        """
+        inventory = [{'AlarmName' : 'zumocotest_ec2_foo_i-0123_CPUUtilization'},
+                     {'AlarmName' : 'zumocotest_ec2_foo_i-0123_NetworkIn'},
+                     {'AlarmName' : 'zumocotest_ec2_bar_i-4567_CPUUtilization'},
+                     {'AlarmName' : 'zumocotest_ec2_foo_i-0123_api_CPUUtilization'}]
+        del_insts = [{'myname' : 'zumocotest_ec2_foo_i-0123'}]
+        alarm_keys = ['CPUUtilization', 'NetworkIn']
+        alarms = zumoco.get_service_alarms('zumocotest', 'ec2', alarm_list=del_insts,
+                                           inventory=inventory, alarm_keys=alarm_keys)
+        self.assertEqual(len(alarms), 2)
+        self.assertEqual(zumoco.match_instance_alarms(inventory, [], alarm_keys), [])
+
+        # alarms of keys since removed from the monitordef are matched by dimension
+        def on(inst_id):
+            return [{'Name' : 'InstanceId', 'Value' : inst_id}]
+        inventory = [{'AlarmName' : 'zumocotest_ec2_foo_i-0123_CPUUtilization',
+                      'Dimensions' : on('i-0123')},
+                     {'AlarmName' : 'zumocotest_ec2_foo_i-0123_DiskReadOps',
+                      'Dimensions' : on('i-0123')},
+                     {'AlarmName' : 'zumocotest_ec2_foo_i-0123_api_DiskReadOps',
+                      'Dimensions' : on('i-0999')}]
+        del_insts = [{'myname' : 'zumocotest_ec2_foo_i-0123', 'InstanceId' : 'i-0123'}]
+        alarms = zumoco.match_instance_alarms(inventory, del_insts, alarm_keys, 'InstanceId')
+        self.assertEqual([alarm['AlarmName'] for alarm in alarms],
+                         [alarm['AlarmName'] for alarm in inventory[:2]])
+
+    def test_index_alarms(self):
+        """
+        Test the alarm index used when building dashboard widgets
+        """
+        test_info = self.svcinfo_helper()
+        alarms = [{'AlarmArn' : 'arn:first', 'MetricName' : 'CPUUtilization',
+                   'Dimensions' : [{'Name' : 'InstanceId', 'Value' : 'i-0123'}]},
+                  {'AlarmArn' : 'arn:second', 'MetricName' : 'CPUUtilization',
+                   'Dimensions' : [{'Name' : 'InstanceId', 'Value' : 'i-0123'}]},
+                  {'AlarmArn' : 'arn:nodim', 'MetricName' : 'CPUUtilization',
+                   'Dimensions' : []}]
+        index = zumoco.index_alarms(alarms)
+        self.assertEqual(len(index), 1)
+        inst = {'myname' : 'zumocotest_ec2_foo', 'InstanceId' : 'i-0123'}
+        props = zumoco.format_widget_props(test_info, 'foo CPU',
+                                           test_info['Charts']['CPU'], inst, index)
+        self.assertEqual(props['annotations']['alarms'], ['arn:first'])
+
     def test_build_gen_del_dashboard(self):
         """
         Test the methods used for creating and deleting a cloudwatch dashboard
@@ -335,6 +625,74 @@ class TestZumoco(unittest.TestCase):
         test_dashboard = zumoco.get_dashboards(name)
         self.assertEqual(len(test_dashboard), 0)
 
+    def test_build_search_widgets(self):
+        """
+        Test search dashboards have one widget per chart, whatever the fleet size
+        """
+        test_info = self.svcinfo_helper()
+        alarms = [{'AlarmName' : 'zumocotest_ec2_%04d_CPUUtilization' % i,
+                   'AlarmArn' : 'arn:%04d' % i,
+                   'StateValue' : 'ALARM' if i == 150 else 'OK'} for i in range(200)]
+        widgets = zumoco.build_search_widgets(alarms, test_info, 'us-east-1')
+        self.assertEqual(len(widgets), len(test_info['Charts']) + 1)
+        self.assertEqual(len(widgets[0]['properties']['alarms']), zumoco.ALARM_WIDGET_MAX)
+        self.assertEqual(widgets[0]['properties']['alarms'][0], 'arn:0150')
+        expr = zumoco.search_expression('AWS/EC2', 'InstanceId', 'CPUUtilization',
+                                        'Average', 300)
+        self.assertEqual(expr, "SEARCH('{AWS/EC2,InstanceId} " +
+                         "MetricName=\"CPUUtilization\"', 'Average', 300)")
+
+    def test_search_widget_metrics(self):
+        """
+        Test search charts of metrics with several alarms, only Aggregate
+        alarms, or no alarm at all
+        """
+        svc_info = copy.deepcopy(zumoco.load_service_file('rds_TeamFoo.json'))
+        svc_info['Alarms']['CPUUtilization']['Aggregate'] = {'GroupBy' : 'All'}
+        svc_info['Charts']['Bogus'] = dict(svc_info['Charts']['CPU'],
+                                           metric_list=['NoSuchMetric'])
+        with self.assertLogs(zumoco.Logger, 'WARNING') as logs:
+            widgets = zumoco.build_search_widgets([], svc_info, 'us-east-1')
+        props = {widg['properties']['title'].split(' ')[-1] : widg['properties']
+                 for widg in widgets[1:]}
+        self.assertNotIn('Bogus', props)
+        self.assertTrue(any('NoSuchMetric' in line for line in logs.output))
+        self.assertEqual(props['DiskFree']['metrics'][0][0]['expression'],
+                         zumoco.search_expression('AWS/RDS', 'DBInstanceIdentifier',
+                                                  'FreeStorageSpace', 'Average', 300))
+        self.assertEqual([note['value'] for note in
+                          props['DiskFree']['annotations']['horizontal']],
+                         [100000000, 200000000])
+        self.assertEqual(props['CPU']['metrics'][0][0]['expression'],
+                         zumoco.search_expression('AWS/RDS', 'DBInstanceIdentifier',
+                                                  'CPUUtilization', 'Maximum', 300))
+        self.assertNotIn('annotations', props['CPU'])
+
+    def test_hash_dashboard_body(self):
+        """
+        Test the dashboard digest ignores key order
+        """
+        body = {'widgets' : [{'type' : 'text', 'x' : 0, 'y' : 0}]}
+        same = json.loads('{"widgets": [{"y": 0, "x": 0, "type": "text"}]}')
+        self.assertEqual(zumoco.hash_dashboard_body(body),
+                         zumoco.hash_dashboard_body(same))
+        body['widgets'][0]['x'] = 6
+        self.assertNotEqual(zumoco.hash_dashboard_body(body),
+                            zumoco.hash_dashboard_body(same))
+
+    def test_format_emf(self):
+        """
+        Test metrics are formatted as CloudWatch Embedded Metric Format
+        """
+        line = zumoco.format_emf({'Team' : 'TeamFoo', 'Service' : 'cloudwatch'},
+                                 {'ApiCalls' : 3}, {'ApiCalls' : 'Count'})
+        doc = json.loads(line)
+        self.assertEqual(doc['ApiCalls'], 3)
+        self.assertEqual(doc['Service'], 'cloudwatch')
+        directive = doc['_aws']['CloudWatchMetrics'][0]
+        self.assertEqual(directive['Dimensions'], [['Service', 'Team']])
+        self.assertEqual(directive['Metrics'], [{'Name' : 'ApiCalls', 'Unit' : 'Count'}])
+
     def test_notify_targets(self):
         """
         Test the method to return AlarmDestinations
@@ -355,3 +713,522 @@ class TestZumoco(unittest.TestCase):
         resp = zumoco.send_report(report_text, test_info, self.Now_str)
         self.assertIn('ResponseMetadata', resp.keys())
         self.assertIn('MessageId', resp.keys())
+
+    def test_split_report(self):
+        """
+        Test large reports are split into messages under the SNS limit,
+        losing no instance
+        """
+        test_info = self.svcinfo_helper()
+        insts = [{'myname' : 'zumocotest_ec2_%06d' % i} for i in range(20000)]
+        record = zumoco.report_record(len(insts), insts, None, test_info)
+        messages = zumoco.render_report([record], self.Now_str)
+        self.assertGreater(len(messages), 1)
+        for message in messages:
+            self.assertLessEqual(len(message.encode('utf-8')), zumoco.MAX_SNS_MESSAGE)
+        self.assertEqual(''.join(messages),
+                         zumoco.format_report(len(insts), insts, None, test_info))
+        messages = zumoco.render_report([record], self.Now_str, 'json')
+        docs = [json.loads(message) for message in messages]
+        self.assertEqual(sum(len(svc['New']) for doc in docs for svc in doc['Services']),
+                         len(insts))
+        self.assertEqual(docs[-1]['Parts'], len(messages))
+
+    def test_load_service_file(self):
+        """
+        Test validating and compiling monitor definitions
+        """
+        self.assertEqual(zumoco.load_monitor_file(zumoco.DEFS_PATH + 'team_bad.json'), "")
+        self.assertEqual(zumoco.load_service_file('team_bad.json'), "")
+        self.assertEqual(zumoco.load_service_file('missing.json'), "")
+        team_info = zumoco.load_monitor_file(zumoco.TEAM_FILEPATH)
+        self.assertEqual(zumoco.validate_schema(team_info, zumoco.TEAM_SCHEMA), [])
+        for svc in team_info['MonitorDefs']:
+            svc_info = zumoco.load_service_file(svc)
+            self.assertTrue(svc_info)
+            # cached for the warm container
+            self.assertIs(zumoco.load_service_file(svc), svc_info)
+
+        svc_info = zumoco.load_service_file('ec2_TeamFoo.json')
+        compiled = zumoco.compile_monitor_def(svc_info)
+        inst = {'Placement' : {'AvailabilityZone' : 'us-east-1a'}}
+        for accessor in compiled['avail'].values():
+            self.assertEqual(accessor(inst), 'us-east-1a')
+        response = {'Reservations' : [{'Instances' : [1, 2]}, {'Instances' : [3]}]}
+        self.assertEqual(compiled['instances'](response), [1, 2, 3])
+        self.assertRaises(ValueError, zumoco.compile_accessor, "['a'].__class__")
+        self.assertRaises(ValueError, zumoco.compile_tag_call, 'os.system(', None)
+
+        bad_info = dict(svc_info)
+        del bad_info['AlarmDimName'], bad_info['_compiled']
+        self.assertEqual(zumoco.validate_service_def(bad_info), ['missing AlarmDimName'])
+
+        agg_info = json.loads(json.dumps({key: value for key, value in svc_info.items()
+                                          if key != '_compiled'}))
+        alarm = sorted(agg_info['Alarms'])[0]
+        agg_info['Alarms'][alarm]['Aggregate'] = {'GroupTag' : 'Team'}
+        self.assertEqual(zumoco.validate_service_def(agg_info),
+                         ['alarm ' + alarm + ' Aggregate missing GroupBy'])
+        agg_info['Alarms'][alarm]['Aggregate'] = 'Team'
+        self.assertEqual(zumoco.validate_service_def(agg_info),
+                         ['alarm ' + alarm + ' Aggregate is not an object'])
+
+        # invalid files are neither processed nor sharded
+        self.assertEqual(zumoco.process_service('team_bad.json', team_info, ''), (None, []))
+        backend = self.fake_aws()
+        sharded = dict(team_info, MonitorDefs=team_info['MonitorDefs'] + ['team_bad.json'],
+                       Sharding={'WorkerFunction' : 'zumoco', 'Shards' : 1})
+        zumoco.orchestrate(sharded)
+        payloads = [json.loads(i[2])['zumocoShard'] for i in backend.invocations]
+        self.assertEqual([i['MonitorDef'] for i in payloads], team_info['MonitorDefs'])
+        self.assertEqual(payloads[0]['Jobs'], len(team_info['MonitorDefs']))
+
+    def test_targets(self):
+        """
+        Test naming, selecting and switching (account, region) targets
+        """
+        west = {'Region' : 'us-west-2',
+                'RoleArn' : 'arn:aws:iam::222222222222:role/aws_monitor_target'}
+        home = {'Region' : 'us-west-2', 'Name' : 'home'}
+        team_info = {'Targets' : [home, west]}
+        self.assertEqual(zumoco.target_name(west), '222222222222_us-west-2')
+        self.assertEqual(zumoco.target_prefix(), '')
+        self.assertEqual(zumoco.team_targets({}), [None])
+
+        svc_info = self.svcinfo_helper()
+        with zumoco.use_target(home):
+            self.assertEqual(zumoco.target_prefix(), 'home/')
+            self.assertTrue(zumoco.state_file_name(svc_info, None).startswith('home/'))
+            with zumoco.use_target(west):
+                self.assertIs(zumoco.current_target(), west)
+            self.assertIs(zumoco.current_target(), home)
+        self.assertIsNone(zumoco.current_target())
+
+        event = {'account' : '222222222222', 'region' : 'us-west-2'}
+        self.assertIs(zumoco.event_target(team_info, event), west)
+        event['account'] = '111111111111'
+        self.assertIs(zumoco.event_target(team_info, event), home)
+        event['region'] = 'eu-west-1'
+        self.assertIs(zumoco.event_target(team_info, event), False)
+        self.assertIsNone(zumoco.event_target({}, event))
+
+        record = zumoco.report_record(1, [{'myname' : 'a'}], [], svc_info, 'home')
+        self.assertIn('Target: home', ''.join(zumoco.iter_report_text(record)))
+
+    def test_discovery_projection(self):
+        """
+        Test filter parameters and the projection of discovered instances
+        """
+        test_info = self.svcinfo_helper()
+        self.assertEqual(zumoco.discovery_kwargs(test_info),
+                         {'Filters' : test_info['InstanceFilters']})
+        test_info['InstanceFilterParam'] = 'OtherFilters'
+        self.assertEqual(list(zumoco.discovery_kwargs(test_info)), ['OtherFilters'])
+        test_info['InstanceFilters'] = {'AutoScalingGroupNames' : ['web']}
+        self.assertEqual(zumoco.discovery_kwargs(test_info),
+                         {'AutoScalingGroupNames' : ['web']})
+
+        inst = {'InstanceId' : 'i-0123', 'Tags' : [],
+                'Placement' : {'AvailabilityZone' : 'us-east-1a', 'Tenancy' : 'default'},
+                'BlockDeviceMappings' : [{'DeviceName' : '/dev/xvda'}]}
+        project = zumoco.compile_projection(test_info)
+        self.assertEqual(set(project([inst])[0]), set(['InstanceId', 'Tags', 'Placement']))
+
+        test_info['Projection'] = ('{InstanceId: InstanceId, Tags: Tags, '
+                                   'Placement: {AvailabilityZone: Placement.AvailabilityZone}}')
+        project = zumoco.compile_projection(test_info)
+        self.assertEqual(project([inst, {'Tags' : []}]),
+                         [{'InstanceId' : 'i-0123', 'Tags' : [],
+                           'Placement' : {'AvailabilityZone' : 'us-east-1a'}}])
+        test_info['Projection'] = '{InstanceId'
+        self.assertRaises(ValueError, zumoco.compile_projection, test_info)
+
+    def test_rate_controller(self):
+        """
+        Test CloudWatch calls are retried through per-target buckets
+        and a shared retry budget
+        """
+        self.assertEqual(zumoco.api_operation('put_metric_alarm'), 'PutMetricAlarm')
+        rates = zumoco.RateController({'DeleteAlarms' : 3})
+        bucket = rates.bucket('DeleteAlarms')
+        self.assertIs(rates.bucket('DeleteAlarms'), bucket)
+        with zumoco.use_target({'Name' : 'west', 'Region' : 'us-west-2'}):
+            self.assertIsNot(rates.bucket('DeleteAlarms'), bucket)
+            west = rates.bucket('DeleteAlarms')
+        # targets of the same account and region share its quota
+        with zumoco.use_target({'Name' : 'west-2', 'Region' : 'us-west-2'}):
+            self.assertIs(rates.bucket('DeleteAlarms'), west)
+        with zumoco.use_target({'Region' : 'us-west-2',
+                                'RoleArn' : 'arn:aws:iam::123456789012:role/foo'}):
+            self.assertIsNot(rates.bucket('DeleteAlarms'), west)
+        rates.set_rate('DeleteAlarms', 6)
+        self.assertEqual(bucket.max_rate, 6)
+        spent = [rates.spend_retry() for _ in range(zumoco.RETRY_BUDGET_MIN + 1)]
+        self.assertEqual(spent.count(True), zumoco.RETRY_BUDGET_MIN)
+
+        class ThrottledClient(object):
+            """
+            CloudWatch client throttling its first calls
+            """
+            def __init__(self, throttles, code='Throttling'):
+                self.throttles = throttles
+                self.code = code
+                self.calls = 0
+
+            def delete_alarms(self, **kwargs): # pylint: disable=unused-argument
+                self.calls += 1
+                if self.calls <= self.throttles:
+                    raise zumoco.exceptions.ClientError({'Error' : {'Code' : self.code}},
+                                                        'DeleteAlarms')
+                return {}
+
+        bucket = zumoco.TokenBucket(1000, min_rate=100)
+        max_backoff = zumoco.THROTTLE_MAX_BACKOFF
+        zumoco.THROTTLE_MAX_BACKOFF = 0
+        try:
+            zumoco.CLOUDWATCH_RATES.reset_budget()
+            client = ThrottledClient(2)
+            zumoco.cloudwatch_call('delete_alarms', {'AlarmNames' : ['a']}, client, bucket)
+            self.assertEqual(client.calls, 3)
+            client = ThrottledClient(1, 'ValidationError')
+            self.assertRaises(zumoco.exceptions.ClientError, zumoco.cloudwatch_call,
+                              'delete_alarms', {}, client, bucket)
+            self.assertEqual(client.calls, 1)
+            client = ThrottledClient(100)
+            self.assertRaises(zumoco.exceptions.ClientError, zumoco.cloudwatch_call,
+                              'delete_alarms', {}, client, bucket)
+            self.assertEqual(client.calls, zumoco.CLOUDWATCH_RETRIES + 1)
+        finally:
+            zumoco.THROTTLE_MAX_BACKOFF = max_backoff
+            zumoco.CLOUDWATCH_RATES.reset_budget()
+
+    def test_token_bucket_slow_rate(self):
+        """
+        Test a bucket throttled below one call per second still lets calls through
+        """
+        bucket = zumoco.TokenBucket(3)
+        bucket.throttled()
+        bucket.throttled()
+        self.assertLess(bucket.rate, 1)
+        bucket.tokens = 0.99
+        bucket.stamp = zumoco.time.time() - 0.1
+        bucket.acquire()
+        self.assertLess(bucket.tokens, 1)
+        slow = zumoco.TokenBucket(0.5)
+        slow.acquire()
+        self.assertEqual(slow.rate, 0.5)
+
+    def test_reconcile_keeps_unbuilt_alarms(self):
+        """
+        Test reconciling deletes alarms removed from the monitordef,
+        but not alarms whose parameters could not be built
+        """
+        test_info = self.svcinfo_helper()
+        backend = self.fake_aws()
+        backend.add_ec2_instances(3)
+        backend.add_topics(test_info['AlarmDestinations'].values())
+        client = zumoco.get_client('ec2')
+        insts = zumoco.get_service_instances(client, test_info)
+        zumoco.reconcile_service_alarms(insts, [], test_info)
+        self.assertEqual(len(backend.alarms), 3 * len(test_info['Alarms']))
+
+        # topic lookups fail: no alarm can be built, none is deleted
+        backend.topics = []
+        zumoco.TOPIC_CACHE.clear()
+        zumoco.TOPIC_VALID.clear()
+        zumoco.reconcile_service_alarms(insts, [], test_info)
+        self.assertEqual(len(backend.alarms), 3 * len(test_info['Alarms']))
+
+        # an alarm removed from the monitordef is deleted
+        removed = sorted(test_info['Alarms'])[0]
+        del test_info['Alarms'][removed]
+        zumoco.reconcile_service_alarms(insts, [], test_info)
+        self.assertEqual(len(backend.alarms), 3 * len(test_info['Alarms']))
+        self.assertFalse([name for name in backend.alarms if name.endswith('_' + removed)])
+
+        # alarms of another monitordef with the same AlarmPrefix and Service are kept
+        other_info = self.svcinfo_helper()
+        other_info['S3Suffix'] = 'other_inst'
+        other_info['Alarms'] = {removed : other_info['Alarms'][removed]}
+        backend.add_topics(test_info['AlarmDestinations'].values())
+        zumoco.TOPIC_CACHE.clear()
+        zumoco.TOPIC_VALID.clear()
+        zumoco.reconcile_service_alarms(insts, [], other_info,
+                                        zumoco.instance_alarms(test_info['Alarms']))
+        zumoco.reconcile_service_alarms(insts, [], test_info,
+                                        zumoco.instance_alarms(other_info['Alarms']))
+        self.assertEqual(len([name for name in backend.alarms if name.endswith('_' + removed)]),
+                         3)
+
+    def test_topic_validation_per_target(self):
+        """
+        Test a topic validated in one target is not trusted in another
+        """
+        backend = self.fake_aws()
+        arn = 'arn:aws:sns:us-east-1:123456789012:team-alerts'
+        backend.add_topics([arn])
+        self.assertEqual(zumoco.validate_topic_arns([arn]), set([arn]))
+        backend.topics = []
+        with zumoco.use_target({'Region' : 'us-west-2', 'Name' : 'west'}):
+            self.assertEqual(zumoco.validate_topic_arns([arn]), set())
+        self.assertEqual(zumoco.validate_topic_arns([arn]), set([arn]))
+
+    def test_shard_results(self):
+        """
+        Test worker results are counted past one listing page, and
+        results of old unmerged runs expire
+        """
+        backend = self.fake_aws()
+        s3_c = zumoco.get_client('s3')
+        old_run = '20000101T000000-abcdef'
+        run_id = strftime(zumoco.RUN_ID_FORMAT) + '-012345'
+        for i in range(1005):
+            s3_c.put_object(Bucket='zumoco', Key=zumoco.shard_result_key(run_id, 'svc', i),
+                            Body=b'{}')
+        s3_c.put_object(Bucket='zumoco', Key=zumoco.shard_result_key(old_run, 'svc', 0),
+                        Body=b'{}')
+        prefix = zumoco.SHARD_RESULTS_PREFIX + run_id + '/'
+        self.assertEqual(len(zumoco.list_shard_results('zumoco', prefix)), 1005)
+        self.assertEqual(zumoco.expire_shard_results({'Bucket' : 'zumoco'}), 1)
+        self.assertEqual(len(zumoco.list_shard_results('zumoco',
+                                                       zumoco.SHARD_RESULTS_PREFIX)), 1005)
+
+    def test_run_services_isolated(self):
+        """
+        Test a failing MonitorDefs entry, logged with its traceback,
+        does not stop the others running concurrently
+        """
+        backend = self.fake_aws()
+        backend.add_ec2_instances(4)
+        backend.add_rds_instances(2)
+        team_info = zumoco.load_monitor_file(zumoco.TEAM_FILEPATH)
+        add_team_topics(backend, team_info)
+        team_info['ServiceWorkers'] = 4
+        team_info['MonitorDefs'] = ['ec2_TeamFoo.json', 'as_TeamFoo.json', 'rds_TeamFoo.json']
+
+        process_service = zumoco.process_service
+        def failing_service(svc, *args, **kwargs):
+            """
+            Fail the autoscaling pipeline
+            """
+            if svc == 'as_TeamFoo.json':
+                raise RuntimeError('describe failed')
+            return process_service(svc, *args, **kwargs)
+        zumoco.process_service = failing_service
+        try:
+            with self.assertLogs(zumoco.Logger, 'ERROR') as logs:
+                results = zumoco.run_services(team_info, self.Now_str)
+        finally:
+            zumoco.process_service = process_service
+        self.assertEqual([info['Service'] if info else None for info, _ in results],
+                         ['ec2', None, 'rds'])
+        self.assertTrue(results[0][1] and results[2][1])
+        failed = [record for record in logs.records if 'as_TeamFoo.json' in record.getMessage()]
+        self.assertEqual(len(failed), 1)
+        self.assertIsNotNone(failed[0].exc_info)
+        for prefix in ('zumoco_ec2_', 'zumoco_rds_'):
+            self.assertTrue([name for name in backend.alarms if name.startswith(prefix)])
+        self.assertFalse([name for name in backend.alarms if name.startswith('zumoco_autoscaling_')])
+
+    def test_notify_targets_shared(self):
+        """
+        Test topics are listed page by page once and shared across services,
+        and a few topics are looked up one by one instead
+        """
+        backend = self.fake_aws()
+        topic = 'arn:aws:sns:us-east-1:123456789012:topic-%d'
+        backend.add_topics([topic % i for i in range(250)])
+        few = {'critical' : topic % 1, 'warning' : topic % 249, 'missing' : topic % 999}
+        self.assertEqual(zumoco.get_notify_targets(few), {'critical' : topic % 1,
+                                                          'warning' : topic % 249})
+        self.assertEqual(zumoco.get_notify_targets(few), {'critical' : topic % 1,
+                                                          'warning' : topic % 249})
+        self.assertEqual(backend.calls['sns.get_topic_attributes'], 3)
+        self.assertEqual(backend.calls['sns.list_topics'], 0)
+
+        many = {str(i) : topic % (i * 40) for i in range(zumoco.TOPIC_VALIDATE_MAX + 2)}
+        for _ in range(3):
+            targets = zumoco.get_notify_targets(many)
+            self.assertEqual(set(targets), set(str(i) for i in range(len(many)) if i * 40 < 250))
+            self.assertEqual(zumoco.get_notify_targets(few), {'critical' : topic % 1,
+                                                              'warning' : topic % 249})
+        # three pages of 100 topics, listed once for every service
+        self.assertEqual(backend.calls['sns.list_topics'], 3)
+        self.assertEqual(backend.calls['sns.get_topic_attributes'], 3)
+
+    def test_get_client_pool(self):
+        """
+        Test clients are created once per (service, region, config) and
+        shared by services, and their calls are recorded as API metrics
+        """
+        clients = dict(zumoco.CLIENTS)
+        zumoco.CLIENTS.clear()
+        zumoco.reset_metrics()
+        try:
+            ec2_c = zumoco.get_client('ec2', 'us-east-1')
+            self.assertIs(zumoco.get_client('ec2', 'us-east-1'), ec2_c)
+            self.assertIsNot(zumoco.get_client('ec2', 'eu-west-1'), ec2_c)
+            cw_c = zumoco.get_client('cloudwatch', 'us-east-1',
+                                     config=zumoco.get_cloudwatch_config())
+            self.assertIsNot(zumoco.get_client('cloudwatch', 'us-east-1'), cw_c)
+            self.assertEqual(len(zumoco.CLIENTS), 4)
+            self.assertEqual(ec2_c.meta.config.max_pool_connections,
+                             zumoco.MAX_SERVICE_WORKERS * zumoco.ALARM_WRITE_WORKERS)
+            self.assertEqual(cw_c.meta.config.retries['total_max_attempts'], 1)
+
+            with Stubber(ec2_c) as stubber:
+                stubber.add_response('describe_instances', {'Reservations' : []})
+                stubber.add_response('describe_instances', {'Reservations' : []})
+                zumoco.get_client('ec2', 'us-east-1').describe_instances()
+                zumoco.get_client('ec2', 'us-east-1').describe_instances()
+            self.assertEqual(zumoco.API_METRICS[('ec2', 'DescribeInstances')]['ApiCalls'], 2)
+        finally:
+            zumoco.CLIENTS.clear()
+            zumoco.CLIENTS.update(clients)
+            zumoco.reset_metrics()
+
+    def test_assume_role_session(self):
+        """
+        Test a role's session resolves credentials through STS, on first use
+        """
+        role_arn = 'arn:aws:iam::123456789012:role/aws_monitor_target'
+        sts_c = boto3.client('sts', region_name='us-east-1', aws_access_key_id='foo',
+                             aws_secret_access_key='bar')
+        expiry = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(hours=1)
+        sessions = dict(zumoco.ROLE_SESSIONS)
+        zumoco.ROLE_SESSIONS.clear()
+        client = boto3.client
+        boto3.client = lambda *args, **kwargs: sts_c
+        try:
+            with Stubber(sts_c) as stubber:
+                session = zumoco.assume_role_session(role_arn)
+                self.assertIs(zumoco.assume_role_session(role_arn), session)
+                stubber.add_response('assume_role',
+                                     {'Credentials' : {'AccessKeyId' : 'ASIA' + 'X' * 16,
+                                                       'SecretAccessKey' : 'secret',
+                                                       'SessionToken' : 'token',
+                                                       'Expiration' : expiry}},
+                                     {'RoleArn' : role_arn,
+                                      'RoleSessionName' : zumoco.ROLE_SESSION_NAME})
+                creds = session.get_credentials()
+                self.assertEqual(creds.method, 'sts-assume-role')
+                self.assertEqual(creds.get_frozen_credentials().token, 'token')
+                stubber.assert_no_pending_responses()
+        finally:
+            boto3.client = client
+            zumoco.ROLE_SESSIONS.clear()
+            zumoco.ROLE_SESSIONS.update(sessions)
+
+    def test_sharded_group_alarms(self):
+        """
+        Test the merge of a sharded run prunes group alarms of groups no shard
+        found, and is claimed by only one worker
+        """
+        backend = self.fake_aws()
+        backend.add_ec2_instances(20)
+        team_info = zumoco.load_monitor_file(zumoco.TEAM_FILEPATH)
+        team_info['MonitorDefs'] = ['ec2_TeamFoo.json']
+        team_info['Sharding'] = {'WorkerFunction' : 'zumoco', 'Shards' : 2}
+        add_team_topics(backend, team_info)
+        svc_info = zumoco.load_monitor_file(zumoco.DEFS_PATH + 'ec2_TeamFoo.json')
+        svc_info['Alarms']['CPUUtilization']['Aggregate'] = {
+            'GroupBy' : 'AutoScalingGroupName', 'GroupTag' : 'aws:autoscaling:groupName'}
+        defs_path = zumoco.DEFS_PATH
+        zumoco.DEFS_PATH = tempfile.mkdtemp() + '/'
+        try:
+            with open(zumoco.DEFS_PATH + 'ec2_TeamFoo.json', 'w') as svc_file:
+                json.dump(svc_info, svc_file)
+
+            def run():
+                """
+                Orchestrate a run and play its workers
+                """
+                backend.invocations = []
+                zumoco.orchestrate(team_info)
+                for _, _, payload in backend.invocations:
+                    zumoco.run_shard(team_info, json.loads(payload)['zumocoShard'],
+                                     self.Now_str)
+
+            def groups():
+                """
+                Return the groups with a group alarm
+                """
+                prefix = zumoco.group_alarm_prefix(svc_info)
+                return sorted(name[len(prefix):-len('_CPUUtilization')]
+                              for name in backend.alarms if name.startswith(prefix))
+
+            run()
+            self.assertEqual(groups(), ['web-asg-%d' % i for i in range(10)])
+            backend.ec2 = [inst for inst in backend.ec2
+                           if inst['Tags'][1]['Value'] != 'web-asg-3']
+            run()
+            self.assertEqual(groups(), ['web-asg-%d' % i for i in range(10) if i != 3])
+            self.assertFalse([key for _, key in backend.objects
+                              if key.startswith(zumoco.SHARD_RESULTS_PREFIX) and
+                              not key.endswith(zumoco.MERGE_CLAIM_SUFFIX)])
+            self.assertTrue(zumoco.merge_shard_results(team_info, 'run1'))
+            self.assertFalse(zumoco.merge_shard_results(team_info, 'run1'))
+        finally:
+            shutil.rmtree(zumoco.DEFS_PATH, ignore_errors=True)
+            zumoco.DEFS_PATH = defs_path
+
+    def test_concurrent_instance_events(self):
+        """
+        Test an instance event losing a state file write to a concurrent
+        one re-reads the file and keeps both instances
+        """
+        backend = self.fake_aws()
+        backend.add_ec2_instances(2)
+        team_info = zumoco.load_monitor_file(zumoco.TEAM_FILEPATH)
+        add_team_topics(backend, team_info)
+        first, second = [inst['InstanceId'] for inst in backend.ec2]
+        save_instances = zumoco.save_instances
+        saves = []
+
+        def racing_save(*args, **kwargs):
+            """
+            Let the second instance's event write first
+            """
+            saves.append(args[2])
+            if len(saves) == 1:
+                zumoco.process_instance_event('ec2_TeamFoo.json', team_info, second, True)
+            return save_instances(*args, **kwargs)
+
+        zumoco.save_instances = racing_save
+        try:
+            self.assertTrue(zumoco.process_instance_event('ec2_TeamFoo.json', team_info,
+                                                          first, True))
+        finally:
+            zumoco.save_instances = save_instances
+        self.assertEqual(len(saves), 3)
+        svc_info = zumoco.load_service_file('ec2_TeamFoo.json')
+        insts = zumoco.load_instances(team_info['Bucket'], zumoco.state_file_name(svc_info),
+                                      svc_info['AlarmDimName'])
+        self.assertEqual(sorted(inst['InstanceId'] for inst in insts), [first, second])
+
+    def test_deferred_service_dashboard(self):
+        """
+        Test a service deferred for lack of time keeps its previous dashboard
+        """
+        backend = self.fake_aws(latency=0.05)
+        backend.add_ec2_instances(2)
+        team_info = zumoco.load_monitor_file(zumoco.TEAM_FILEPATH)
+        add_team_topics(backend, team_info)
+
+        class FakeContext(object):
+            """
+            Lambda context running out of time during discovery
+            """
+            @staticmethod
+            def get_remaining_time_in_millis():
+                return zumoco.TIME_RESERVE_MS + 20
+        zumoco.RUN_BUDGET.start(FakeContext())
+        try:
+            svc_info, dash_j = zumoco.process_service('ec2_TeamFoo.json', team_info,
+                                                      self.Now_str)
+            self.assertEqual(zumoco.RUN_BUDGET.deferred, ['ec2_TeamFoo.json'])
+        finally:
+            zumoco.RUN_BUDGET.start(None)
+        self.assertEqual((svc_info['Service'], dash_j), ('ec2', []))
+        self.assertEqual(backend.dashboards, {})
+        self.assertEqual(backend.calls['cloudwatch.put_dashboard'], 0)
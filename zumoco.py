@@ -20,31 +20,494 @@ zumoco worker
 """
 
 
+import collections
+from concurrent import futures
+import contextlib
 import datetime
+import gzip
+import hashlib
+import io
 import json
 import logging
+import os
+import random
+import re
+import struct
+import sys
+import threading
+import time
 from time import strftime
 
-import boto3
+# boto3 and botocore.config are imported on first client use (see get_client)
 from botocore import exceptions
-import parsedatetime as pdt
 
 Logger = logging.getLogger()
 Logger.setLevel(logging.INFO)
 
-CW_C = boto3.client('cloudwatch')
-SNS_C = boto3.client('sns')
-S3_C = boto3.client('s3')
-
 # services zumoco has permission to describe
 SERVICE_LIST = ['ec2', 'cloudwatch', 'lambda', 'sns', 'rds', 'autoscaling']
 
 DEFS_PATH = 'monitordefs/'
 TEAM_FILEPATH = DEFS_PATH + 'team.json'
 
+# Required keys of team and service files, and their allowed JSON types
+STRING_TYPES = (type(u''), type(''))
+NONE_TYPE = type(None)
+TEAM_SCHEMA = {'Team' : STRING_TYPES,
+               'Bucket' : STRING_TYPES,
+               'CreateTeamDashboard' : (bool,),
+               'SendStatusUpdates' : (bool,),
+               'MonitorDefs' : (list,)}
+SERVICE_SCHEMA = {'Service' : STRING_TYPES,
+                  'S3Suffix' : STRING_TYPES,
+                  'ReportARN' : STRING_TYPES + (NONE_TYPE,),
+                  'DiscoverInstance' : STRING_TYPES,
+                  'InstanceFilters' : (list, dict, NONE_TYPE),
+                  'InstanceIterator1' : STRING_TYPES + (NONE_TYPE,),
+                  'InstanceIterator2' : STRING_TYPES + (NONE_TYPE,),
+                  'AlarmDestinations' : (dict,),
+                  'CreateServiceDashboard' : (bool,),
+                  'AlarmDimName' : STRING_TYPES,
+                  'AlarmPrefix' : STRING_TYPES,
+                  'TagsKey' : STRING_TYPES,
+                  'DiscoverTags' : STRING_TYPES + (NONE_TYPE,),
+                  'DiscoverTagsInstParm' : STRING_TYPES + (NONE_TYPE,),
+                  'FriendlyName' : STRING_TYPES + (NONE_TYPE,),
+                  'EnsureUniqueName' : (bool,),
+                  'Alarms' : (dict,),
+                  'Charts' : (dict,)}
+ALARM_KEYS = ['AlarmDescription', 'AlarmAction', 'send_ok', 'ComparisonOperator',
+              'EvaluationPeriods', 'MetricName', 'Namespace', 'Period', 'Threshold']
+CHART_KEYS = ['ch_type', 'is_alarm', 'metric_list', 'period', 'view', 'stacked']
+# avail paths, e.g. ['Placement']['AvailabilityZone'], and DiscoverTags calls,
+# e.g. list_tags_for_resource(ResourceName=
+ACCESSOR_STEP = re.compile(r"\[(?:'([^']*)'|\"([^\"]*)\"|(\d+))\]")
+TAG_CALL = re.compile(r'^(\w+)\((?:(\w+)=)?$')
+# describe call parameter taking a list of InstanceFilters, unless InstanceFilterParam
+DEFAULT_FILTER_PARAM = 'Filters'
+# Validated, compiled service files, by path and modification time
+MONITOR_CACHE = {}
+MONITOR_LOCK = threading.Lock()
+
+# bounded pool for running MonitorDefs concurrently (team.json ServiceWorkers)
+MAX_SERVICE_WORKERS = 8
+# upper bound on (target, service) pipelines run concurrently with Targets
+MAX_TARGET_WORKERS = 16
+
+# CloudWatch API quotas (transactions per second, per account and region),
+# shared by every thread calling them
+CLOUDWATCH_TPS = {'PutMetricAlarm' : 3,
+                  'DeleteAlarms' : 3,
+                  'DescribeAlarms' : 9,
+                  'GetDashboard' : 10,
+                  'PutDashboard' : 10,
+                  'ListDashboards' : 10,
+                  'DeleteDashboards' : 10}
+ALARM_WRITE_WORKERS = 4
+# attempts after the first, while the retry and time budgets last
+CLOUDWATCH_RETRIES = 6
+# retries allowed per run: a floor, plus a share of the successful calls
+RETRY_BUDGET_MIN = 20
+RETRY_BUDGET_RATIO = 0.1
+THROTTLE_CODES = ['Throttling', 'ThrottlingException', 'RequestLimitExceeded']
+# transient server errors, retried without slowing down
+RETRY_CODES = ['InternalFailure', 'InternalServiceError', 'ServiceUnavailable']
+THROTTLE_MAX_BACKOFF = 20
+DESCRIBE_ALARMS_PAGE = 100
+
+# get_resources accepts at most 100 ARNs per call
+TAG_BATCH_SIZE = 100
+TAG_CACHE_TTL = 6 * 60 * 60
+TAG_CACHE_MAX = 100000
+# resource ARN -> (fetch time, tag list), kept across warm invocations
+TAG_CACHE = {}
+TAG_CACHE_LOCK = threading.Lock()
+
+# limit of 100 alarm names per delete_alarms call
+DELETE_ALARMS_MAX = 100
+# deleted instance count above which one prefix scan beats a scan per instance
+ALARM_SCAN_THRESHOLD = 10
+# alarm settings compared when reconciling existing alarms with monitordefs
+ALARM_FINGERPRINT_KEYS = ['MetricName', 'Namespace', 'AlarmDescription', 'Statistic',
+                          'Period', 'Threshold', 'ComparisonOperator',
+                          'EvaluationPeriods', 'AlarmActions', 'OKActions',
+                          'Dimensions', 'Metrics']
+# Metrics Insights query fields compared by fingerprint_alarm
+ALARM_QUERY_KEYS = ['Id', 'Expression', 'Period']
+# Aggregate alarm query function by comparison, so any group member breaching alarms
+AGGREGATE_FUNCTIONS = {'GreaterThanThreshold' : 'MAX',
+                       'GreaterThanOrEqualToThreshold' : 'MAX',
+                       'LessThanThreshold' : 'MIN',
+                       'LessThanOrEqualToThreshold' : 'MIN'}
+# statistic charting an Aggregate alarm's metric per instance, by query function
+AGGREGATE_STATISTICS = {'MAX' : 'Maximum', 'MIN' : 'Minimum', 'AVG' : 'Average',
+                        'SUM' : 'Sum', 'COUNT' : 'SampleCount'}
+MAX_ALARM_NAME = 255
+
+# SNS topics known to exist, shared by all services and warm invocations
+TOPIC_CACHE_TTL = 15 * 60
+# referenced topic count up to which get_topic_attributes is used instead of listing
+TOPIC_VALIDATE_MAX = 5
+TOPIC_CACHE = {}
+# (target prefix, topic ARN) -> (exists, expiry time)
+TOPIC_VALID = {}
+TOPIC_LOCK = threading.Lock()
+
+# alarm puts buffered while streaming discovery, before handing to the writer pool
+STREAM_ALARM_BATCH = 200
+# top-level key of a chart's avail path, e.g. ['Placement']['AvailabilityZone']
+AVAIL_TOP_KEY = re.compile(r"\[['\"]([^'\"]+)['\"]\]")
+
+# Time kept back from the Lambda timeout for saving state, reports and the checkpoint
+TIME_RESERVE_MS = 30 * 1000
+# S3 key listing MonitorDefs left unfinished by a run, resumed first by the next
+CHECKPOINT_KEY = 'zumoco_checkpoint.json'
+CHECKPOINT_FORMAT_VERSION = 1
+# Alarms are written in AlarmAction order, so critical alarms land first
+ALARM_ACTION_PRIORITY = ['critical', 'warning', 'info']
+
+# EventBridge events handled per instance: EC2 state changes, and autoscaling
+# launch/terminate events (True where the instance may now be running).
+# Launch lifecycle actions are not handled: the instance is still pending then,
+# and is added by its later running state change.
+EC2_STATE_EVENT = 'EC2 Instance State-change Notification'
+EC2_GONE_STATES = ['shutting-down', 'terminated']
+ASG_INSTANCE_EVENTS = {'EC2 Instance Launch Successful' : True,
+                       'EC2 Instance Terminate Successful' : False,
+                       'EC2 Instance-terminate Lifecycle Action' : False}
+
+# S3 prefix for sharded workers' dashboard widgets, merged by the last worker,
+# and the suffix of the object claiming a run's merge
+SHARD_RESULTS_PREFIX = 'zumoco_shards/'
+MERGE_CLAIM_SUFFIX = '.merged'
+# S3 error codes of a conditional write losing to a concurrent one, and the
+# attempts an instance event makes to update a state file changed under it
+CONDITIONAL_WRITE_CODES = ['PreconditionFailed', 'ConditionalRequestConflict']
+STATE_WRITE_ATTEMPTS = 5
+# run ID timestamp format, and age after which an unmerged run's results are removed
+RUN_ID_FORMAT = '%Y%m%dT%H%M%S'
+SHARD_RESULTS_TTL = 24 * 60 * 60
+
 DASHBOARD_MAX_WIDTH = 16
 DASHBOARD_MAX_WIDGET = 50
+# DashboardMode search: widget size, and the alarm status widget's ARN limit
+SEARCH_WIDGET_WIDTH = 12
+SEARCH_WIDGET_HEIGHT = 6
+ALARM_WIDGET_MAX = 100
 MAX_SNS_MESSAGE = 1024 * 256
+# bytes kept free in each report message for JSON framing
+REPORT_RESERVE = 1024
+REPORT_SUBJECT = 'New/Deleted Instance Report for '
+# ReportDigest: service reports of this invocation, by MonitorDefs entry
+REPORT_DIGEST = {}
+REPORT_LOCK = threading.Lock()
+
+# S3 history file format; version 1 was an uncompressed list of full instances
+STATE_FORMAT_VERSION = 2
+# state files cached by ETag in memory and in /tmp across warm invocations:
+# limits on the uncompressed JSON size of the instances held in memory,
+# and on the compressed bodies kept in /tmp
+STATE_CACHE_DIR = '/tmp/zumoco_state'
+STATE_CACHE_MAX_BYTES = 32 * 1024 * 1024
+STATE_CACHE_MAX_DISK_BYTES = 64 * 1024 * 1024
+# (bucket, key) -> (ETag, uncompressed size, instances), least recently used first
+STATE_CACHE = collections.OrderedDict()
+STATE_CACHE_LOCK = threading.Lock()
+
+# target prefix + dashboard name -> digest of the body last published, kept across warm invocations
+DASHBOARD_HASHES = {}
+DASHBOARD_LOCK = threading.Lock()
+
+# per-run API statistics, (service, operation) -> Counter, and
+# phase durations, (monitordef, phase) -> milliseconds, emitted as EMF logs
+METRICS_NAMESPACE = 'zumoco'
+API_METRICS = {}
+PHASE_METRICS = {}
+METRICS_LOCK = threading.Lock()
+
+# default botocore client config, built on first client creation
+CLIENT_CONFIG = None
+# CloudWatch client config: retries are left to cloudwatch_call
+CLOUDWATCH_CONFIG = None
+# (service, region, config, role) -> client, kept across warm invocations
+CLIENTS = {}
+# role ARN -> boto3 session with auto-refreshing assumed-role credentials
+ROLE_SESSIONS = {}
+ROLE_SESSION_NAME = 'zumoco'
+# The (account, region) target of the current thread's work, see use_target
+TARGET = threading.local()
+# boto3's default session is not thread safe; guard client creation
+CLIENT_LOCK = threading.Lock()
+
+
+def get_client_config():
+    """
+    Return the default client config, with enough connections
+    for every service thread's alarm writers
+    """
+    global CLIENT_CONFIG # pylint: disable=global-statement
+    if CLIENT_CONFIG is None:
+        from botocore.config import Config
+        CLIENT_CONFIG = Config(max_pool_connections=MAX_SERVICE_WORKERS *
+                               ALARM_WRITE_WORKERS,
+                               retries={'mode' : 'standard', 'max_attempts' : 5})
+    return CLIENT_CONFIG
+
+
+def get_cloudwatch_config():
+    """
+    Return the CloudWatch client config, without botocore's own retries
+    """
+    global CLOUDWATCH_CONFIG # pylint: disable=global-statement
+    if CLOUDWATCH_CONFIG is None:
+        from botocore.config import Config
+        CLOUDWATCH_CONFIG = get_client_config().merge(
+            Config(retries={'mode' : 'standard', 'total_max_attempts' : 1}))
+    return CLOUDWATCH_CONFIG
+
+
+def assume_role_session(role_arn):
+    """
+    Return a boto3 session for a role, whose credentials are refreshed
+    through sts:AssumeRole before they expire.  Call with CLIENT_LOCK held.
+    """
+    session = ROLE_SESSIONS.get(role_arn)
+    if session is None:
+        import boto3
+        from botocore.credentials import CredentialProvider, DeferredRefreshableCredentials
+        from botocore.session import get_session
+        sts_c = boto3.client('sts', config=get_client_config())
+
+        def refresh():
+            """
+            Assume the role again
+            """
+            creds = sts_c.assume_role(RoleArn=role_arn,
+                                      RoleSessionName=ROLE_SESSION_NAME)['Credentials']
+            return {'access_key' : creds['AccessKeyId'],
+                    'secret_key' : creds['SecretAccessKey'],
+                    'token' : creds['SessionToken'],
+                    'expiry_time' : creds['Expiration'].isoformat()}
+
+        class RoleProvider(CredentialProvider):
+            """
+            Credential provider assuming the role, ahead of the session's own
+            """
+            METHOD = 'sts-assume-role'
+
+            def load(self):
+                return DeferredRefreshableCredentials(refresh_using=refresh,
+                                                      method=self.METHOD)
+        botocore_session = get_session()
+        botocore_session.get_component('credential_provider').insert_before(
+            'env', RoleProvider())
+        session = boto3.Session(botocore_session=botocore_session)
+        ROLE_SESSIONS[role_arn] = session
+    return session
+
+
+def get_client(service, region=None, config=None, role_arn=None):
+    """
+    Return the pooled client for a service, creating it (and importing
+    boto3) on first use.  Given a role ARN, the client uses that role.
+    """
+    key = (service, region, config, role_arn)
+    client = CLIENTS.get(key)
+    if client is None:
+        with CLIENT_LOCK:
+            client = CLIENTS.get(key)
+            if client is None:
+                import boto3
+                factory = assume_role_session(role_arn).client if role_arn else boto3.client
+                client = factory(service, region_name=region,
+                                 config=config or get_client_config())
+                client.meta.events.register('before-call', start_api_timer)
+                client.meta.events.register('after-call', record_api_call)
+                client.meta.events.register('after-call-error', record_api_error)
+                CLIENTS[key] = client
+    return client
+
+
+def current_target():
+    """
+    Return the Targets entry the current thread works on, or None for
+    the Lambda function's own account and region
+    """
+    return getattr(TARGET, 'current', None)
+
+
+@contextlib.contextmanager
+def use_target(target):
+    """
+    Direct the current thread's discovery, alarm and dashboard calls
+    to a Targets entry (None for the Lambda function's own account and region)
+    """
+    previous = current_target()
+    TARGET.current = target
+    try:
+        yield
+    finally:
+        TARGET.current = previous
+
+
+def target_client(service):
+    """
+    Return the pooled client for a service in the current thread's target
+    """
+    target = current_target() or {}
+    config = get_cloudwatch_config() if service == 'cloudwatch' else None
+    return get_client(service, target.get('Region'), config, target.get('RoleArn'))
+
+
+def role_account(role_arn):
+    """
+    Return the account id of a role ARN (arn:aws:iam::<account>:role/<name>)
+    """
+    return role_arn.split(':')[4] if role_arn else None
+
+
+def target_name(target):
+    """
+    Return a target's name: its Name, else its account and region
+    """
+    if target.get('Name'):
+        return target['Name']
+    parts = [role_account(target.get('RoleArn')), target.get('Region')]
+    return '_'.join(part for part in parts if part) or 'default'
+
+
+def target_prefix(target=None):
+    """
+    Return the S3 key prefix of a target's state files, '' without Targets
+    """
+    target = target or current_target()
+    return target_name(target) + '/' if target else ''
+
+
+def target_quota(target=None):
+    """
+    Return the (account, region) whose API quotas a target's calls count
+    against, None standing for the Lambda function's own account and region
+    """
+    target = target or current_target() or {}
+    return (role_account(target.get('RoleArn')),
+            target.get('Region') or os.environ.get('AWS_REGION'))
+
+
+def team_targets(team_info):
+    """
+    Return the team's Targets, or [None] for the Lambda function's own
+    account and region
+    """
+    return team_info.get('Targets') or [None]
+
+
+def add_api_metric(event_name, started, retries, error_code):
+    """
+    Accumulate one API call's statistics under (service, operation)
+    """
+    # event names are <event>.<service id>.<operation>
+    key = tuple(event_name.split('.')[1:3])
+    with METRICS_LOCK:
+        stats = API_METRICS.setdefault(key, collections.Counter())
+        stats['ApiCalls'] += 1
+        stats['ApiRetries'] += retries
+        if started:
+            stats['ApiTime'] += (time.time() - started) * 1000
+        if error_code:
+            stats['ApiErrors'] += 1
+            if error_code in THROTTLE_CODES:
+                stats['ApiThrottles'] += 1
+
+
+def start_api_timer(context, **kwargs): # pylint: disable=unused-argument
+    """
+    botocore before-call handler: note when the call started
+    """
+    context['zumoco_started'] = time.time()
+
+
+def record_api_call(event_name, parsed, context, **kwargs): # pylint: disable=unused-argument
+    """
+    botocore after-call handler: record a completed (or failed) API call
+    """
+    add_api_metric(event_name, context.get('zumoco_started'),
+                   parsed.get('ResponseMetadata', {}).get('RetryAttempts', 0),
+                   parsed.get('Error', {}).get('Code'))
+
+
+def record_api_error(event_name, exception, context, **kwargs): # pylint: disable=unused-argument
+    """
+    botocore after-call-error handler: record a call that raised
+    """
+    add_api_metric(event_name, context.get('zumoco_started'), 0,
+                   type(exception).__name__)
+
+
+@contextlib.contextmanager
+def timed_phase(monitordef, phase):
+    """
+    Accumulate the time spent in one phase of a monitordef's pipeline
+    """
+    started = time.time()
+    try:
+        yield
+    finally:
+        with METRICS_LOCK:
+            key = (monitordef, phase)
+            PHASE_METRICS[key] = PHASE_METRICS.get(key, 0) + (time.time() - started) * 1000
+
+
+def reset_metrics():
+    """
+    Clear metrics left by a previous (warm) invocation
+    """
+    with METRICS_LOCK:
+        API_METRICS.clear()
+        PHASE_METRICS.clear()
+
+
+def format_emf(dimensions, values, units):
+    """
+    Return a CloudWatch Embedded Metric Format log line
+    """
+    doc = {'_aws' : {'Timestamp' : int(time.time() * 1000),
+                     'CloudWatchMetrics' : [{
+                         'Namespace' : METRICS_NAMESPACE,
+                         'Dimensions' : [sorted(dimensions.keys())],
+                         'Metrics' : [{'Name' : name, 'Unit' : units[name]}
+                                      for name in sorted(values)]}]}}
+    doc.update(dimensions)
+    doc.update(values)
+    return json.dumps(doc, sort_keys=True)
+
+
+def emit_metrics(team, run_ms):
+    """
+    Write this run's API and phase metrics to stdout as EMF log lines,
+    which CloudWatch Logs turns into metrics without put_metric_data
+    """
+    units = {'ApiCalls' : 'Count', 'ApiRetries' : 'Count', 'ApiErrors' : 'Count',
+             'ApiThrottles' : 'Count', 'ApiTime' : 'Milliseconds',
+             'PhaseDuration' : 'Milliseconds', 'RunDuration' : 'Milliseconds'}
+    lines = []
+    total_calls = 0
+    with METRICS_LOCK:
+        for (service, operation), stats in sorted(API_METRICS.items()):
+            values = {name: stats[name] for name in ['ApiCalls', 'ApiRetries',
+                                                     'ApiErrors', 'ApiThrottles',
+                                                     'ApiTime']}
+            total_calls += stats['ApiCalls']
+            lines.append(format_emf({'Team' : team, 'Service' : service,
+                                     'Operation' : operation}, values, units))
+        for (monitordef, phase), duration in sorted(PHASE_METRICS.items()):
+            lines.append(format_emf({'Team' : team, 'MonitorDef' : monitordef,
+                                     'Phase' : phase},
+                                    {'PhaseDuration' : duration}, units))
+    lines.append(format_emf({'Team' : team},
+                            {'RunDuration' : run_ms, 'ApiCalls' : total_calls}, units))
+    sys.stdout.write('\n'.join(lines) + '\n')
+    sys.stdout.flush()
 
 def load_monitor_file(file_name):
     """
@@ -53,41 +516,437 @@ def load_monitor_file(file_name):
     try:
         with open(file_name, 'r') as monfile:
             mydict = json.load(monfile)
-    except IOError as error:
+    except (IOError, ValueError) as error:
         mydict = ""
         Logger.warning('Failed to load ' + file_name)
         Logger.critical('Critical Error: ' + str(error))
     return mydict
 
 
-def load_instances(bucket, filename):
+def validate_schema(mydict, schema):
+    """
+    Return a list of problems with a dictionary's required keys and types
+    """
+    if not isinstance(mydict, dict):
+        return ['not a JSON object']
+    errors = []
+    for key in sorted(schema):
+        if key not in mydict:
+            errors.append('missing ' + key)
+        elif not isinstance(mydict[key], schema[key]):
+            errors.append(key + ' has the wrong type')
+    return errors
+
+
+def compile_accessor(path):
+    """
+    Compile a subscript path such as ['Placement']['AvailabilityZone']
+    into a callable, instead of eval'ing it per instance
+    """
+    steps = []
+    pos = 0
+    for match in ACCESSOR_STEP.finditer(path):
+        if match.start() != pos:
+            break
+        key, dkey, index = match.groups()
+        steps.append(int(index) if index is not None else
+                     (key if key is not None else dkey))
+        pos = match.end()
+    if not steps or pos != len(path):
+        raise ValueError('invalid avail path ' + path)
+
+    def accessor(obj):
+        """
+        Follow the path's subscripts
+        """
+        for step in steps:
+            obj = obj[step]
+        return obj
+    return accessor
+
+
+def compile_tag_call(call, parm):
+    """
+    Compile DiscoverTags / DiscoverTagsInstParm, e.g.
+    list_tags_for_resource(ResourceName= and DBInstanceArn, into a callable
+    """
+    match = TAG_CALL.match(call)
+    if not match or (match.group(2) and not parm):
+        raise ValueError('invalid DiscoverTags ' + call)
+    method, kwarg = match.groups()
+
+    def discover_tags(svc_client, inst):
+        """
+        Call the service's tag API for one instance
+        """
+        if kwarg:
+            return getattr(svc_client, method)(**{kwarg : inst[parm]})
+        return getattr(svc_client, method)()
+    return discover_tags
+
+
+def compile_iterator(svc_info):
+    """
+    Compile InstanceIterator1/2 into a callable flattening a describe response
+    """
+    iter1 = svc_info['InstanceIterator1']
+    iter2 = svc_info['InstanceIterator2']
+    if iter2:
+        # Two levels of lists
+        return lambda response: [inst for tmp in response[iter1] for inst in tmp[iter2]]
+    if iter1:
+        return lambda response: list(response[iter1])
+    return list
+
+
+def instance_keys(svc_info):
+    """
+    Return the top-level fields of a discovered instance that zumoco reads:
+    the alarm dimension, tags and the charts' avail fields
+    """
+    keys = set([svc_info['AlarmDimName'], svc_info['TagsKey']])
+    if svc_info['DiscoverTagsInstParm']:
+        keys.add(svc_info['DiscoverTagsInstParm'])
+    for chart in svc_info['Charts'].values():
+        if chart.get('avail'):
+            keys.add(AVAIL_TOP_KEY.match(chart['avail']).group(1))
+    return keys
+
+
+def compile_projection(svc_info):
+    """
+    Compile a callable reducing a page of instances to the fields zumoco
+    reads, or to the service's Projection (a JMESPath expression per instance)
+    """
+    if not svc_info.get('Projection'):
+        keys = instance_keys(svc_info)
+        return lambda insts: [{key: inst[key] for key in keys if key in inst}
+                              for inst in insts]
+
+    import jmespath
+    from jmespath.exceptions import JMESPathError
+    try:
+        expression = jmespath.compile(svc_info['Projection'])
+    except JMESPathError as error:
+        raise ValueError('invalid Projection: ' + str(error))
+    dim_name = svc_info['AlarmDimName']
+
+    def project(insts):
+        """
+        Apply the Projection, dropping results without the alarm dimension
+        """
+        found = [expression.search(inst) for inst in insts]
+        projected = [inst for inst in found
+                     if isinstance(inst, dict) and inst.get(dim_name) is not None]
+        if len(projected) < len(found):
+            Logger.warning('Projection dropped ' + str(len(found) - len(projected)) +
+                           ' instances without ' + dim_name)
+        return projected
+    return project
+
+
+def discovery_kwargs(svc_info):
+    """
+    Return the describe call's filter parameters: InstanceFilters given as
+    a dict are passed as parameters, a list as the InstanceFilterParam
+    (by default Filters) parameter
+    """
+    filters = svc_info['InstanceFilters']
+    if not filters:
+        return {}
+    if isinstance(filters, dict):
+        return dict(filters)
+    return {svc_info.get('InstanceFilterParam') or DEFAULT_FILTER_PARAM : filters}
+
+
+def compile_monitor_def(svc_info):
+    """
+    Return a service's compiled accessors, compiling them on first use
+    """
+    compiled = svc_info.get('_compiled')
+    if compiled is None:
+        compiled = {'instances' : compile_iterator(svc_info),
+                    'project' : compile_projection(svc_info),
+                    'avail' : {chart['avail']: compile_accessor(chart['avail'])
+                               for chart in svc_info['Charts'].values()
+                               if chart.get('avail')},
+                    'discover_tags' : None}
+        if svc_info['DiscoverTags']:
+            compiled['discover_tags'] = compile_tag_call(svc_info['DiscoverTags'],
+                                                         svc_info['DiscoverTagsInstParm'])
+        svc_info['_compiled'] = compiled
+    return compiled
+
+
+def validate_aggregate(alarm, alarm_def):
+    """
+    Return a list of problems with an alarm's Aggregate settings
+    """
+    aggregate = alarm_def.get('Aggregate')
+    if not aggregate:
+        return []
+    if not isinstance(aggregate, dict):
+        return ['alarm ' + alarm + ' Aggregate is not an object']
+    errors = []
+    if not aggregate.get('GroupBy'):
+        errors.append('alarm ' + alarm + ' Aggregate missing GroupBy')
+    elif aggregate['GroupBy'] != 'All' and not aggregate.get('GroupTag'):
+        errors.append('alarm ' + alarm + ' Aggregate missing GroupTag')
+    if not aggregate.get('Function') and \
+       alarm_def.get('ComparisonOperator') not in AGGREGATE_FUNCTIONS:
+        errors.append('alarm ' + alarm + ' Aggregate missing Function')
+    return errors
+
+
+def validate_service_def(svc_info):
+    """
+    Return a list of problems with a service file, compiling it if there are none
+    """
+    errors = validate_schema(svc_info, SERVICE_SCHEMA)
+    if errors:
+        return errors
+    for alarm, alarm_def in svc_info['Alarms'].items():
+        keys = ALARM_KEYS if alarm_def.get('Aggregate') else ALARM_KEYS + ['Statistic']
+        errors.extend('alarm ' + alarm + ' missing ' + key
+                      for key in keys if key not in alarm_def)
+        errors.extend(validate_aggregate(alarm, alarm_def))
+    for cht_name, chart in svc_info['Charts'].items():
+        keys = CHART_KEYS if chart.get('is_alarm') else CHART_KEYS + ['avail', 'stat']
+        errors.extend('chart ' + cht_name + ' missing ' + key
+                      for key in keys if key not in chart)
+    if not errors:
+        try:
+            compile_monitor_def(svc_info)
+        except ValueError as error:
+            errors.append(str(error))
+    return errors
+
+
+def load_service_file(svc):
+    """
+    Load, validate and compile a MonitorDefs service file, cached across
+    warm invocations until the file changes.  Return "" if it is invalid.
+    """
+    file_name = DEFS_PATH + svc
+    try:
+        mtime = os.path.getmtime(file_name)
+    except OSError as error:
+        Logger.warning('Failed to load ' + file_name)
+        Logger.critical('Critical Error: ' + str(error))
+        return ""
+    with MONITOR_LOCK:
+        cached = MONITOR_CACHE.get(file_name)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+
+    svc_info = load_monitor_file(file_name)
+    if not svc_info:
+        return ""
+    errors = validate_service_def(svc_info)
+    if errors:
+        Logger.critical('Invalid monitor definition ' + file_name + ': ' + '; '.join(errors))
+        return ""
+    with MONITOR_LOCK:
+        MONITOR_CACHE[file_name] = (mtime, svc_info)
+    return svc_info
+
+
+def fingerprint_instance(inst):
+    """
+    Return a short digest of an instance's full description
+    """
+    if 'myfingerprint' in inst:
+        return inst['myfingerprint']
+    body = json.dumps(inst, sort_keys=True, default=dateconverter)
+    return hashlib.sha1(body.encode('utf-8')).hexdigest()[:16]
+
+
+def compact_instance(inst, dim_name=None):
+    """
+    Reduce an instance to the fields kept in the S3 history file
+    """
+    record = {'myname' : inst['myname'],
+              'myfingerprint' : fingerprint_instance(inst)}
+    if dim_name and dim_name in inst:
+        record[dim_name] = inst[dim_name]
+    if inst.get('mygroups'):
+        record['mygroups'] = inst['mygroups']
+    return record
+
+
+def compress_state(state):
+    """
+    gzip a state dictionary as JSON
+    """
+    buf = io.BytesIO()
+    with gzip.GzipFile(fileobj=buf, mode='wb') as gzfile:
+        gzfile.write(json.dumps(state, ensure_ascii=False).encode('utf-8'))
+    return buf.getvalue()
+
+
+def decompress_state(raw, dim_name=None):
+    """
+    Parse a state file body into compact instance records,
+    migrating legacy (uncompressed list of full instances) files
+    """
+    if raw[:2] == b'\x1f\x8b':
+        with gzip.GzipFile(fileobj=io.BytesIO(raw), mode='rb') as gzfile:
+            raw = gzfile.read()
+    state = json.loads(raw.decode('utf-8'))
+    if isinstance(state, list):
+        return [compact_instance(inst, dim_name) for inst in state]
+    if state.get('zumocoStateFormatVersion', 0) > STATE_FORMAT_VERSION:
+        Logger.warning('State file written by a newer zumoco, version: ' +
+                       str(state['zumocoStateFormatVersion']))
+    return state['Instances']
+
+
+def state_body_size(raw):
+    """
+    Return the uncompressed size of a state file body, read from its gzip trailer
+    """
+    if raw[:2] == b'\x1f\x8b':
+        return struct.unpack('<I', raw[-4:])[0]
+    return len(raw)
+
+
+def state_cache_path(bucket, filename):
+    """
+    Return the /tmp cache file path for an S3 state file
+    """
+    digest = hashlib.sha1((bucket + '/' + filename).encode('utf-8')).hexdigest()
+    return os.path.join(STATE_CACHE_DIR, digest)
+
+
+def evict_state_cache():
     """
-    Load JSON instances from S3 file
+    Keep the in-memory state cache within STATE_CACHE_MAX_BYTES and the /tmp
+    one within STATE_CACHE_MAX_DISK_BYTES, dropping least recently used entries first
     """
+    with STATE_CACHE_LOCK:
+        while len(STATE_CACHE) > 1 and \
+              sum(entry[1] for entry in STATE_CACHE.values()) > STATE_CACHE_MAX_BYTES:
+            STATE_CACHE.popitem(last=False)
     try:
-        obj = S3_C.get_object(Bucket=bucket, Key=filename)
-        last_str = obj['Body'].read().decode('utf-8')
-        insts = json.loads(last_str)
+        paths = [os.path.join(STATE_CACHE_DIR, f) for f in os.listdir(STATE_CACHE_DIR)
+                 if f.endswith('.state')]
+        paths.sort(key=os.path.getmtime)
+        total = sum(os.path.getsize(path) for path in paths)
+        while len(paths) > 1 and total > STATE_CACHE_MAX_DISK_BYTES:
+            path = paths.pop(0)
+            total -= os.path.getsize(path)
+            os.remove(path)
+            os.remove(path[:-len('.state')] + '.etag')
+    except (IOError, OSError) as err:
+        Logger.warning('Unable to evict state cache: ' + str(err))
+
+
+def cache_state(bucket, filename, etag, raw, insts):
+    """
+    Remember a state file body and its parsed instances by ETag
+    """
+    key = (bucket, filename)
+    with STATE_CACHE_LOCK:
+        STATE_CACHE.pop(key, None)
+        STATE_CACHE[key] = (etag, state_body_size(raw), insts)
+    path = state_cache_path(bucket, filename)
+    try:
+        if not os.path.isdir(STATE_CACHE_DIR):
+            os.makedirs(STATE_CACHE_DIR)
+        with open(path + '.state', 'wb') as state_file:
+            state_file.write(raw)
+        with open(path + '.etag', 'w') as etag_file:
+            etag_file.write(etag)
+    except (IOError, OSError) as err:
+        Logger.warning('Unable to cache state file: ' + str(err))
+    evict_state_cache()
+
+
+def get_cached_state(bucket, filename, dim_name=None):
+    """
+    Return (ETag, instances) for a cached state file, or (None, None).
+    Instances are parsed from /tmp only when not held in memory.
+    """
+    key = (bucket, filename)
+    with STATE_CACHE_LOCK:
+        if key in STATE_CACHE:
+            entry = STATE_CACHE.pop(key)
+            STATE_CACHE[key] = entry
+            return entry[0], entry[2]
+    path = state_cache_path(bucket, filename)
+    try:
+        with open(path + '.etag', 'r') as etag_file:
+            etag = etag_file.read()
+        with open(path + '.state', 'rb') as state_file:
+            raw = state_file.read()
+    except (IOError, OSError):
+        return None, None
+    insts = decompress_state(raw, dim_name)
+    with STATE_CACHE_LOCK:
+        STATE_CACHE[key] = (etag, state_body_size(raw), insts)
+    evict_state_cache()
+    return etag, insts
+
+
+def load_state(bucket, filename, dim_name=None):
+    """
+    Return (ETag, instances) of an S3 state file, with no ETag if there is none.
+    A conditional GET skips the download when the cached copy is current.
+    """
+    etag, cached = get_cached_state(bucket, filename, dim_name)
+    kwargs = {'IfNoneMatch' : etag} if etag else {}
+    try:
+        obj = get_client('s3').get_object(Bucket=bucket, Key=filename, **kwargs)
+        raw = obj['Body'].read()
+        insts = decompress_state(raw, dim_name)
+        etag = obj['ETag']
+        cache_state(bucket, filename, etag, raw, insts)
     except exceptions.ClientError as err:
-        if err.response['Error']['Code'] == "NoSuchKey":
+        if err.response['Error']['Code'] in ('304', 'NotModified'):
+            insts = cached
+        elif err.response['Error']['Code'] == "NoSuchKey":
             Logger.warning('No file found:' + filename)
-            insts = []
+            etag, insts = None, []
         else:
             raise
 
-    return insts
+    return etag, list(insts)
 
 
-def save_instances(inst_list, bucket, filename):
+def load_instances(bucket, filename, dim_name=None):
+    """
+    Load instances from S3 state file.
     """
-    Save instances to S3 json
+    return load_state(bucket, filename, dim_name)[1]
+
+
+def save_instances(inst_list, bucket, filename, dim_name=None, etag=False):
     """
+    Save compact instance records to S3, as versioned gzipped JSON.
+    Given the ETag the records were loaded with (None for no file), the
+    write only succeeds if the file has not changed since.
+    """
+    state = {'zumocoStateFormatVersion' : STATE_FORMAT_VERSION,
+             'AlarmDimName' : dim_name,
+             'Instances' : [compact_instance(inst, dim_name) for inst in inst_list]}
+    raw = compress_state(state)
+    kwargs = {}
+    if etag:
+        kwargs['IfMatch'] = etag
+    elif etag is None:
+        kwargs['IfNoneMatch'] = '*'
     try:
-        out = S3_C.put_object(Bucket=bucket, Key=filename,
-                              Body=json.dumps(inst_list, ensure_ascii=False,
-                                              default=dateconverter))
+        out = get_client('s3').put_object(Bucket=bucket, Key=filename,
+                              Body=raw,
+                              ContentType='application/json',
+                              ContentEncoding='gzip', **kwargs)
+        cache_state(bucket, filename, out['ETag'], raw, state['Instances'])
     except exceptions.ClientError as err:
-        Logger.error('Issue writing file:' + filename + ':' + err)
+        if err.response['Error']['Code'] in CONDITIONAL_WRITE_CODES:
+            Logger.info('File changed while updating it:' + filename)
+        else:
+            Logger.error('Issue writing file:' + filename + ':' + str(err))
+        out = err.response
 
     return out['ResponseMetadata']['HTTPStatusCode']
 
@@ -118,69 +977,307 @@ def determine_deltas(my_insts, my_last_insts):
         return delinsts, newinsts
 
 
-def format_report(count, new_inst, del_inst, svc_info):
+def report_record(count, new_inst, del_inst, svc_info, target=None):
     """
-    Given a service's new, deleted inst, return a string representation for email
+    Return a service's new and deleted instance names, or None if there are none.
+    Given a target name, the record names the target it was discovered in.
+    """
+    if not new_inst and not del_inst:
+        return None
+    record = {'Service' : svc_info['Service'],
+              'S3Suffix' : svc_info['S3Suffix'],
+              'Total' : count,
+              'New' : [inst['myname'] for inst in new_inst or []],
+              'Deleted' : [inst['myname'] for inst in del_inst or []]}
+    if target:
+        record['Target'] = target
+    return record
+
+
+def iter_report_text(record):
     """
-    needed = False
-    body = ''
-    if new_inst is not None and len(new_inst) > 0:
-        needed = True
-        body += '\n\n  New Instances: '
-        for inst in new_inst:
-            body += '\n    ' + inst['myname']
+    Yield the text of a service's report, one line at a time
+    """
+    yield 'Service: ' + record['Service']
+    if record.get('Target'):
+        yield '\n  Target: ' + record['Target']
+    yield '\n  Total Instances: ' + str(record['Total'])
+    yield '\n\n'
+    if record['New']:
+        yield '\n\n  New Instances: '
+        for name in record['New']:
+            yield '\n    ' + name
     else:
-        body += '\n\n  No new instances.'
-    if del_inst is not None and len(del_inst) > 0:
-        needed = True
-        body += '\n\n  Deleted Instances: '
-        for inst in del_inst:
-            body += '\n    ' + inst['myname']
+        yield '\n\n  No new instances.'
+    if record['Deleted']:
+        yield '\n\n  Deleted Instances: '
+        for name in record['Deleted']:
+            yield '\n    ' + name
     else:
-        body += '\n\n  No deleted instances.'
-    if needed:
-        output = 'Service: ' + svc_info['Service']
-        output += '\n  Total Instances: ' + str(count)
-        output += '\n\n'
-        return output + body
+        yield '\n\n  No deleted instances.'
 
-    return None
+
+def format_report(count, new_inst, del_inst, svc_info):
+    """
+    Given a service's new, deleted inst, return a string representation for email
+    """
+    record = report_record(count, new_inst, del_inst, svc_info)
+    if record is None:
+        return None
+    return ''.join(iter_report_text(record))
+
+
+def split_report(pieces, limit=MAX_SNS_MESSAGE - REPORT_RESERVE):
+    """
+    Join text pieces into messages of at most limit UTF-8 bytes,
+    splitting only between pieces
+    """
+    messages = []
+    current = []
+    size = 0
+    for piece in pieces:
+        piece_size = len(piece.encode('utf-8'))
+        if current and size + piece_size > limit:
+            messages.append(''.join(current))
+            current = []
+            size = 0
+        current.append(piece)
+        size += piece_size
+    if current:
+        messages.append(''.join(current))
+    return messages
+
+
+def split_json_report(records, now_str, limit=MAX_SNS_MESSAGE - REPORT_RESERVE):
+    """
+    Return compact JSON messages of at most limit UTF-8 bytes (plus framing),
+    each listing the instance names of one or more services
+    """
+    def entry(record):
+        """
+        Copy of a record, without its names
+        """
+        return dict(record, New=[], Deleted=[])
+
+    docs = [[]]
+    size = 0
+    for record in records:
+        current = entry(record)
+        docs[-1].append(current)
+        size += len(json.dumps(current))
+        for key in ['New', 'Deleted']:
+            for name in record[key]:
+                name_size = len(json.dumps(name).encode('utf-8')) + 1
+                if size + name_size > limit:
+                    current = entry(record)
+                    docs.append([current])
+                    size = len(json.dumps(current))
+                current[key].append(name)
+                size += name_size
+    return [json.dumps({'Run' : now_str, 'Part' : pos + 1, 'Parts' : len(docs),
+                        'Services' : doc}, separators=(',', ':'))
+            for pos, doc in enumerate(docs)]
+
+
+def render_report(records, now_str, report_format=None):
+    """
+    Return the SNS messages reporting one or more services, as text or JSON
+    """
+    if report_format == 'json':
+        return split_json_report(records, now_str)
+
+    def pieces():
+        """
+        Text of every record, separated by blank lines
+        """
+        for pos, record in enumerate(records):
+            if pos:
+                yield '\n\n\n'
+            for piece in iter_report_text(record):
+                yield piece
+    return split_report(pieces())
+
+
+def publish_report(topic_arn, messages, now_str):
+    """
+    Publish report messages to AWS SNS, numbering them if there are several
+    """
+    resp = None
+    for pos, message in enumerate(messages):
+        subject = REPORT_SUBJECT + now_str
+        if len(messages) > 1:
+            subject += ' (' + str(pos + 1) + '/' + str(len(messages)) + ')'
+        resp = get_client('sns').publish(TopicArn=topic_arn, Message=message,
+                                         Subject=subject[:100])
+    return resp
 
 
 def send_report(report_text, svc_info, now_str):
     """
     Publish report to AWS SNS endpoint
-    Note: publish takes a max of 256KB.
-    """
-    overage = len(report_text) - MAX_SNS_MESSAGE
-    if overage > 0:
-        report_text = report_text[:-overage - 20] + '\n<message truncated/>'
-    resp = SNS_C.publish(TopicArn=svc_info['ReportARN'],
-                         Message=report_text,
-                         Subject='New/Deleted Instance Report for ' + now_str)
-    return resp
+    Note: publish takes a max of 256KB, so larger reports are split.
+    """
+    return publish_report(svc_info['ReportARN'],
+                          split_report(report_text.splitlines(True)), now_str)
+
+
+def send_digest(svcs, now_str, report_format=None):
+    """
+    Publish the reports collected this run (ReportDigest), one digest
+    per ReportARN, in MonitorDefs order
+    """
+    with REPORT_LOCK:
+        digest = dict(REPORT_DIGEST)
+        REPORT_DIGEST.clear()
+    by_topic = collections.OrderedDict()
+    for svc in svcs:
+        if svc in digest:
+            topic_arn, record = digest[svc]
+            by_topic.setdefault(topic_arn, []).append(record)
+    for topic_arn, records in by_topic.items():
+        publish_report(topic_arn, render_report(records, now_str, report_format), now_str)
+
+
+def list_topic_arns():
+    """
+    Return the set of SNS topic ARNs in the account, paging through
+    every topic once per TOPIC_CACHE_TTL and sharing it across services
+    of the current target
+    """
+    with TOPIC_LOCK:
+        cache = TOPIC_CACHE.setdefault(target_prefix(), {'arns' : set(), 'expires' : 0})
+        if cache['expires'] < time.time():
+            arns = set()
+            paginator = target_client('sns').get_paginator('list_topics')
+            for response in paginator.paginate():
+                arns.update(i['TopicArn'] for i in response['Topics'])
+            cache['arns'] = arns
+            cache['expires'] = time.time() + TOPIC_CACHE_TTL
+        return cache['arns']
+
+
+def validate_topic_arns(arns):
+    """
+    Return the subset of the given SNS topic ARNs that exist,
+    checking each with get_topic_attributes
+    """
+    valid = set()
+    prefix = target_prefix()
+    for arn in arns:
+        with TOPIC_LOCK:
+            cached = TOPIC_VALID.get((prefix, arn))
+        if cached and cached[1] > time.time():
+            exists = cached[0]
+        else:
+            try:
+                target_client('sns').get_topic_attributes(TopicArn=arn)
+                exists = True
+            except exceptions.ClientError as err:
+                if err.response['Error']['Code'] not in ('NotFound', 'InvalidParameter',
+                                                         'AuthorizationError'):
+                    raise
+                exists = False
+            with TOPIC_LOCK:
+                TOPIC_VALID[(prefix, arn)] = (exists, time.time() + TOPIC_CACHE_TTL)
+        if exists:
+            valid.add(arn)
+    return valid
+
+
+def alarm_destinations(svc_info):
+    """
+    Return a service's AlarmDestinations, with the current target's overrides
+    """
+    target = current_target() or {}
+    return dict(svc_info['AlarmDestinations'], **target.get('AlarmDestinations', {}))
 
 
 def get_notify_targets(a_dest):
     """
     Return a dict of SNS alarm ARNs
     """
-    topics = SNS_C.list_topics()['Topics']
-    arns = [i['TopicArn'] for i in topics]
+    wanted = set(a_dest[a] for a in a_dest if a_dest[a])
+    with TOPIC_LOCK:
+        listed = TOPIC_CACHE.get(target_prefix(), {'expires' : 0})['expires'] >= time.time()
+    # a few lookups are cheaper than listing every topic in the account
+    if not listed and len(wanted) <= TOPIC_VALIDATE_MAX:
+        arns = validate_topic_arns(wanted)
+    else:
+        arns = list_topic_arns()
     return {a: a_dest[a] for a in a_dest if a_dest[a] in arns}
 
 
+def fetch_resource_tags(arns):
+    """
+    Bulk fetch tags for resource ARNs via the Resource Groups Tagging API.
+    Untagged resources are returned with an empty tag list.
+    """
+    found = {}
+    paginator = target_client('resourcegroupstaggingapi').get_paginator('get_resources')
+    for i in range(0, len(arns), TAG_BATCH_SIZE):
+        batch = arns[i:i + TAG_BATCH_SIZE]
+        found.update({arn: [] for arn in batch})
+        for response in paginator.paginate(ResourceARNList=batch):
+            for mapping in response['ResourceTagMappingList']:
+                found[mapping['ResourceARN']] = mapping['Tags']
+    return found
+
+
+def cache_resource_tags(found, now):
+    """
+    Add fetched tags to TAG_CACHE, dropping expired entries and,
+    beyond TAG_CACHE_MAX entries, the oldest ones
+    """
+    with TAG_CACHE_LOCK:
+        TAG_CACHE.update({arn: (now, tags) for arn, tags in found.items()})
+        for arn in [arn for arn, entry in TAG_CACHE.items() if now - entry[0] > TAG_CACHE_TTL]:
+            del TAG_CACHE[arn]
+        if len(TAG_CACHE) > TAG_CACHE_MAX:
+            oldest = sorted(TAG_CACHE, key=lambda arn: TAG_CACHE[arn][0])
+            for arn in oldest[:len(TAG_CACHE) - TAG_CACHE_MAX]:
+                del TAG_CACHE[arn]
+
+
+def resolve_instance_tags(insts, svc_info):
+    """
+    Attach tags to instances whose describe call does not return them,
+    using cached bulk lookups instead of a DiscoverTags call per instance
+    """
+    parm = svc_info['DiscoverTagsInstParm']
+    tags_key = svc_info['TagsKey']
+    if not svc_info['DiscoverTags'] or not parm:
+        return
+    untagged = [inst for inst in insts if tags_key not in inst and parm in inst]
+    if not untagged:
+        return
+
+    now = time.time()
+    with TAG_CACHE_LOCK:
+        missing = set(inst[parm] for inst in untagged
+                      if now - TAG_CACHE.get(inst[parm], (0, None))[0] > TAG_CACHE_TTL)
+    found = {}
+    if missing:
+        try:
+            found = fetch_resource_tags(sorted(missing))
+        except exceptions.ClientError as err:
+            # fall back to DiscoverTags per instance
+            Logger.warning('Bulk tag lookup failed: ' + str(err))
+            return
+        cache_resource_tags(found, now)
+
+    with TAG_CACHE_LOCK:
+        for inst in untagged:
+            inst[tags_key] = found[inst[parm]] if inst[parm] in found \
+                             else TAG_CACHE[inst[parm]][1]
+
+
 def get_service_instance_tag_value(inst, svc_client, svc_info, tag_name):
     """
     Retrieve given tag value from the given instance
     """
-    # Requires another API call
-    if svc_info['DiscoverTags']:
-        cmd = 'svc_client.' + svc_info['DiscoverTags']
-        if svc_info['DiscoverTagsInstParm']:
-            cmd += 'inst["' + svc_info['DiscoverTagsInstParm'] + '"]'
-        cmd += ')'
-        inst = eval(cmd)
+    # Requires another API call, unless tags were already resolved
+    if svc_info['DiscoverTags'] and svc_info['TagsKey'] not in inst:
+        inst = compile_monitor_def(svc_info)['discover_tags'](svc_client, inst)
     # turn tag list into dictionary
     tagl = {i['Key']:i['Value'] for i in inst[svc_info['TagsKey']] if i['Value']}
     try:
@@ -209,70 +1306,453 @@ def create_friendly_name(instance, svc_client, svc_info):
     return name
 
 
-def create_service_alarms(svc_inst, svc_client, svc_info):
+def build_alarm_params(instance, alarm, alarm_def, svc_info, alm_tgt):
     """
-    Parse instances, creating alarms for each
+    Return put_metric_alarm arguments for one instance alarm
     """
-    alarms = svc_info['Alarms']
-    alm_tgt = get_notify_targets(svc_info['AlarmDestinations'])
-    for instance in svc_inst:
-        for alarm in alarms:
-            alarmname = instance['myname'] + '_' + alarm
-            try:
-                if alarms[alarm]['send_ok']:
-                    CW_C.put_metric_alarm(AlarmName=alarmname,
-                                          MetricName=alarms[alarm]['MetricName'],
-                                          Namespace=alarms[alarm]['Namespace'],
-                                          AlarmDescription=alarms[alarm]['AlarmDescription'],
-                                          Statistic=alarms[alarm]['Statistic'],
-                                          Period=alarms[alarm]['Period'],
-                                          Threshold=alarms[alarm]['Threshold'],
-                                          ComparisonOperator=alarms[alarm]['ComparisonOperator'],
-                                          EvaluationPeriods=alarms[alarm]['EvaluationPeriods'],
-                                          AlarmActions=[alm_tgt[alarms[alarm]['AlarmAction']]],
-                                          OKActions=[alm_tgt[alarms[alarm]['AlarmAction']]],
-                                          Dimensions=[{'Name':svc_info['AlarmDimName'],
-                                                       'Value':instance[svc_info['AlarmDimName']]}])
-                else:
-                    CW_C.put_metric_alarm(AlarmName=alarmname,
-                                          MetricName=alarms[alarm]['MetricName'],
-                                          Namespace=alarms[alarm]['Namespace'],
-                                          AlarmDescription=alarms[alarm]['AlarmDescription'],
-                                          Statistic=alarms[alarm]['Statistic'],
-                                          Period=alarms[alarm]['Period'],
-                                          Threshold=alarms[alarm]['Threshold'],
-                                          ComparisonOperator=alarms[alarm]['ComparisonOperator'],
-                                          EvaluationPeriods=alarms[alarm]['EvaluationPeriods'],
-                                          AlarmActions=[alm_tgt[alarms[alarm]['AlarmAction']]],
-                                          Dimensions=[{'Name':svc_info['AlarmDimName'],
-                                                       'Value':instance[svc_info['AlarmDimName']]}])
+    params = {'AlarmName' : instance['myname'] + '_' + alarm,
+              'MetricName' : alarm_def['MetricName'],
+              'Namespace' : alarm_def['Namespace'],
+              'AlarmDescription' : alarm_def['AlarmDescription'],
+              'Statistic' : alarm_def['Statistic'],
+              'Period' : alarm_def['Period'],
+              'Threshold' : alarm_def['Threshold'],
+              'ComparisonOperator' : alarm_def['ComparisonOperator'],
+              'EvaluationPeriods' : alarm_def['EvaluationPeriods'],
+              'AlarmActions' : [alm_tgt[alarm_def['AlarmAction']]],
+              'Dimensions' : [{'Name':svc_info['AlarmDimName'],
+                               'Value':instance[svc_info['AlarmDimName']]}]}
+    if alarm_def['send_ok']:
+        params['OKActions'] = [alm_tgt[alarm_def['AlarmAction']]]
+    return params
+
+
+class TokenBucket(object):
+    """
+    Thread safe token bucket shared by all callers of a rate limited API.
+    The fill rate halves on throttling and recovers additively on success.
+    """
+    def __init__(self, rate, min_rate=0.5):
+        self.lock = threading.Lock()
+        self.min_rate = min_rate
+        self.set_rate(rate)
+
+    def set_rate(self, rate):
+        """
+        Reset the bucket to a new maximum rate (e.g. a raised quota)
+        """
+        with self.lock:
+            self.max_rate = float(rate)
+            self.rate = self.max_rate
+            self.min_rate = min(self.min_rate, self.max_rate)
+            self.tokens = self.max_rate
+            self.stamp = time.time()
+
+    def acquire(self):
+        """
+        Block until a call may be made
+        """
+        while True:
+            with self.lock:
+                now = time.time()
+                # a burst of at least one call, so rates below 1/s still pass
+                self.tokens = min(max(self.rate, 1),
+                                  self.tokens + (now - self.stamp) * self.rate)
+                self.stamp = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def throttled(self):
+        """
+        Multiplicative decrease after a throttling error
+        """
+        with self.lock:
+            self.rate = max(self.min_rate, self.rate / 2)
+            self.tokens = min(self.tokens, 0)
+
+    def succeeded(self):
+        """
+        Additive increase after a successful call
+        """
+        with self.lock:
+            self.rate = min(self.max_rate, self.rate + self.max_rate / 20)
+
+
+class TimeBudget(object):
+    """
+    Remaining time of the current invocation, from the Lambda context,
+    and the MonitorDefs deferred to the next run for lack of it
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.start(None)
+
+    def start(self, context, reserve_ms=TIME_RESERVE_MS):
+        """
+        Start a run; without a Lambda context the budget is unlimited
+        """
+        remaining = getattr(context, 'get_remaining_time_in_millis', None)
+        with self.lock:
+            self.deadline = None
+            if remaining is not None:
+                self.deadline = time.time() + (remaining() - reserve_ms) / 1000.0
+            self.deferred = []
+            self.resumed = []
+
+    def remaining(self):
+        """
+        Seconds left before the reserve is reached
+        """
+        if self.deadline is None:
+            return float('inf')
+        return self.deadline - time.time()
+
+    def exhausted(self, needed=0):
+        """
+        Return whether needed seconds of work no longer fit
+        """
+        return self.remaining() <= needed
+
+    def defer(self, svc):
+        """
+        Record a MonitorDefs entry left (partly) undone
+        """
+        with self.lock:
+            if svc not in self.deferred:
+                self.deferred.append(svc)
+
+
+RUN_BUDGET = TimeBudget()
+
+
+class RateController(object):
+    """
+    Token buckets per (account, region, CloudWatch operation), shared by the
+    targets calling the same quota and adapting to throttling,
+    and a retry budget shared by every CloudWatch call of a run
+    """
+    def __init__(self, rates):
+        self.lock = threading.Lock()
+        self.rates = dict(rates)
+        self.buckets = {}
+        self.reset_budget()
+
+    def set_rate(self, operation, rate):
+        """
+        Set an operation's maximum rate in every target (e.g. a raised quota)
+        """
+        with self.lock:
+            self.rates[operation] = rate
+            buckets = [bucket for key, bucket in self.buckets.items() if key[-1] == operation]
+        for bucket in buckets:
+            bucket.set_rate(rate)
+
+    def bucket(self, operation):
+        """
+        Return the token bucket of an operation in the current thread's
+        target's account and region
+        """
+        key = target_quota() + (operation,)
+        with self.lock:
+            if key not in self.buckets:
+                self.buckets[key] = TokenBucket(self.rates[operation])
+            return self.buckets[key]
+
+    def reset_budget(self):
+        """
+        Start a run's retry budget
+        """
+        with self.lock:
+            self.retry_tokens = float(RETRY_BUDGET_MIN)
+
+    def succeeded(self):
+        """
+        Earn part of a retry for a successful call
+        """
+        with self.lock:
+            self.retry_tokens += RETRY_BUDGET_RATIO
+
+    def spend_retry(self):
+        """
+        Take a retry from the budget, returning False once it is spent
+        """
+        with self.lock:
+            if self.retry_tokens < 1:
+                return False
+            self.retry_tokens -= 1
+            return True
+
+
+CLOUDWATCH_RATES = RateController(CLOUDWATCH_TPS)
+
+
+def api_operation(method):
+    """
+    Return the API operation name of a client method, e.g. PutMetricAlarm
+    """
+    return ''.join(part.capitalize() for part in method.split('_'))
+
+
+def retryable_error(err):
+    """
+    Return whether a CloudWatch ClientError may succeed if retried
+    """
+    code = err.response['Error']['Code']
+    status = err.response.get('ResponseMetadata', {}).get('HTTPStatusCode', 0)
+    return code in THROTTLE_CODES or code in RETRY_CODES or status >= 500
+
+
+def cloudwatch_call(method, params, cw_client=None, bucket=None):
+    """
+    Make a CloudWatch call through its operation's token bucket, backing off
+    and retrying throttling and transient errors while the run's retry and
+    time budgets last.  The client and bucket default to the current
+    thread's target.  The last error is raised once retries run out.
+    """
+    cw_client = cw_client or target_client('cloudwatch')
+    bucket = bucket or CLOUDWATCH_RATES.bucket(api_operation(method))
+    attempt = 0
+    while True:
+        bucket.acquire()
+        try:
+            response = getattr(cw_client, method)(**params)
+        except exceptions.ClientError as err:
+            if not retryable_error(err):
+                raise
+            if err.response['Error']['Code'] in THROTTLE_CODES:
+                bucket.throttled()
+            if attempt >= CLOUDWATCH_RETRIES or RUN_BUDGET.exhausted() or \
+               not CLOUDWATCH_RATES.spend_retry():
+                raise
+        except (exceptions.ConnectionError, exceptions.HTTPClientError):
+            if attempt >= CLOUDWATCH_RETRIES or RUN_BUDGET.exhausted() or \
+               not CLOUDWATCH_RATES.spend_retry():
+                raise
+        else:
+            bucket.succeeded()
+            CLOUDWATCH_RATES.succeeded()
+            return response
+        time.sleep(min(random.uniform(0, min(THROTTLE_MAX_BACKOFF, 2 ** attempt)),
+                       max(RUN_BUDGET.remaining(), 0)))
+        attempt += 1
+
+
+def cloudwatch_pages(method, params):
+    """
+    Yield each page of a paginated CloudWatch call, made through cloudwatch_call
+    """
+    params = dict(params)
+    cw_client = target_client('cloudwatch')
+    bucket = CLOUDWATCH_RATES.bucket(api_operation(method))
+    while True:
+        response = cloudwatch_call(method, params, cw_client, bucket)
+        yield response
+        if not response.get('NextToken'):
+            return
+        params['NextToken'] = response['NextToken']
+
+
+def put_metric_alarm(params, cw_client=None, bucket=None):
+    """
+    Put a single alarm through the shared rate controller.
+    The client and bucket default to the current thread's target.
+    Return True or False, or None if it was not completed in time
+    (out of time or retry budget, or still throttled) and should be retried.
+    """
+    if RUN_BUDGET.exhausted():
+        return None
+    try:
+        cloudwatch_call('put_metric_alarm', params, cw_client, bucket)
+    except exceptions.ClientError as err:
+        if retryable_error(err):
+            Logger.warning('Throttled creating alarm: ' + params['AlarmName'])
+            return None
+        Logger.warning('Failed to create alarm: ' + params['AlarmName'] +
+                       ': ' + str(err))
+        return False
+    except (exceptions.ConnectionError, exceptions.HTTPClientError) as err:
+        Logger.warning('Failed to reach CloudWatch creating alarm: ' +
+                       params['AlarmName'] + ': ' + str(err))
+        return None
+    return True
+
+
+def put_metric_alarms(alarm_params):
+    """
+    Fan put_metric_alarm calls out over a bounded thread pool, in order.
+    Return a dict of AlarmName to success, None where not completed.
+    """
+    if not alarm_params:
+        return {}
+    # the pool's threads do not see this thread's target
+    cw_client = target_client('cloudwatch')
+    bucket = CLOUDWATCH_RATES.bucket('PutMetricAlarm')
+    workers = min(ALARM_WRITE_WORKERS, len(alarm_params))
+    with futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        results = executor.map(lambda params: put_metric_alarm(params, cw_client, bucket),
+                               alarm_params)
+        return {p['AlarmName']: ok for p, ok in zip(alarm_params, results)}
+
+
+def instance_alarms(alarms):
+    """
+    Return the alarms defined per instance, rather than per group (Aggregate)
+    """
+    return {alarm: alarm_def for alarm, alarm_def in alarms.items()
+            if not alarm_def.get('Aggregate')}
+
+
+def prioritize_alarms(alarms):
+    """
+    Return alarm names ordered by their AlarmAction's priority
+    """
+    def priority(alarm):
+        action = alarms[alarm].get('AlarmAction')
+        if action in ALARM_ACTION_PRIORITY:
+            return ALARM_ACTION_PRIORITY.index(action)
+        return len(ALARM_ACTION_PRIORITY)
+    return sorted(alarms, key=priority)
+
+
+def unfinished_instances(svc_inst, svc_info, results):
+    """
+    Return the instances with an alarm put that was not completed
+    """
+    return [inst for inst in svc_inst
+            if any(results.get(inst['myname'] + '_' + alarm, True) is None
+                   for alarm in svc_info['Alarms'])]
 
+
+def build_service_alarm_params(svc_inst, svc_info):
+    """
+    Return put_metric_alarm arguments for every alarm of every instance,
+    highest priority alarms first
+    """
+    alarms = instance_alarms(svc_info['Alarms'])
+    alm_tgt = get_notify_targets(alarm_destinations(svc_info))
+    alarm_params = []
+    for alarm in prioritize_alarms(alarms):
+        for instance in svc_inst:
+            try:
+                alarm_params.append(build_alarm_params(instance, alarm, alarms[alarm],
+                                                       svc_info, alm_tgt))
             except KeyError:
-                Logger.warning('Failed to create alarm: ' + alarmname)
+                Logger.warning('Failed to create alarm: ' + instance['myname'] +
+                               '_' + alarm)
                 Logger.warning('Ensure valid AlarmDestinations / AlarmDimName')
                 Logger.warning('in monitor definitions:' + svc_info['Service'])
+    return alarm_params
+
+
+def write_service_alarms(svc_inst, svc_info, existing=None):
+    """
+    Create alarms for each instance, returning the instances
+    whose alarms were not all completed.
+    Alarms in existing (AlarmName to fingerprint) with the same settings are skipped.
+    """
+    alarm_params = [params for params in build_service_alarm_params(svc_inst, svc_info)
+                    if not existing or
+                    existing.get(params['AlarmName']) != fingerprint_alarm(params)]
+    results = put_metric_alarms(alarm_params)
+    return unfinished_instances(svc_inst, svc_info, results)
+
+
+def existing_alarm_fingerprints(svc_info, alarm_list):
+    """
+    Return AlarmName to fingerprint for the service's existing alarms,
+    e.g. those a previous, unfinished run already put
+    """
+    alarms = get_service_alarms(svc_info['AlarmPrefix'], svc_info['Service'],
+                                alarm_list=alarm_list,
+                                alarm_keys=instance_alarms(svc_info['Alarms']))
+    return {alarm['AlarmName']: fingerprint_alarm(alarm) for alarm in alarms}
+
+
+def create_service_alarms(svc_inst, svc_client, svc_info):
+    """
+    Parse instances, creating alarms for each
+    """
+    write_service_alarms(svc_inst, svc_info)
 
     return get_service_alarms(svc_info['AlarmPrefix'], svc_info['Service'],
                               alarm_list=['All'])
 
 
-def get_service_alarms(prefix, service, alarm_list):
+def instance_alarm_names(inst_list, alarm_keys):
+    """
+    Return the set of alarm names (<myname>_<alarm>) of the given instances
+    """
+    return set(inst['myname'] + '_' + alarm for inst in inst_list for alarm in alarm_keys)
+
+
+def instance_alarm_filter(inst_list, alarm_keys, dim_name=None):
+    """
+    Return a test for alarms of the given instances: named <myname>_<alarm>
+    for one of alarm_keys, or (given dim_name) named <myname>_<anything> on the
+    instance's dimension, e.g. alarms since removed from the monitordef.
+    An instance whose name is a prefix of another's (web and web_api) only
+    matches its own alarms.
+    """
+    names = instance_alarm_names(inst_list, alarm_keys)
+    owners = {inst[dim_name]: inst['myname'] + '_' for inst in inst_list
+              if dim_name and inst.get(dim_name)}
+
+    def owned(alarm):
+        """
+        Return whether an alarm belongs to one of the instances
+        """
+        if alarm['AlarmName'] in names:
+            return True
+        dims = alarm.get('Dimensions') or []
+        owner = owners.get(dims[0]['Value']) if dims and dims[0]['Name'] == dim_name else None
+        return owner is not None and alarm['AlarmName'].startswith(owner)
+    return owned
+
+
+def match_instance_alarms(alarms, inst_list, alarm_keys, dim_name=None):
+    """
+    Return the alarms of any of the given instances (see instance_alarm_filter),
+    matched in memory
+    """
+    owned = instance_alarm_filter(inst_list, alarm_keys, dim_name)
+    return [alarm for alarm in alarms if owned(alarm)]
+
+
+def get_service_alarms(prefix, service, alarm_list, inventory=None, alarm_keys=(),
+                       dim_name=None):
     """
-    Get all alarms for a given AlarmPrefix + service
+    Get all alarms for a given AlarmPrefix + service.
+    Given an instance list, only those instances' alarms (named by
+    alarm_keys, the monitordef's instance alarms, or on their dim_name
+    dimension) are returned.
+    Large instance lists (or a given inventory of the service's alarms)
+    are matched locally against a single prefix scan.
     """
     alarms = []
     alarmprefix = prefix + '_' + service
-    paginator = CW_C.get_paginator('describe_alarms')
     if alarm_list is not None:
         if alarm_list == ['All']:
             alarminst = alarmprefix
-            for response in paginator.paginate(AlarmNamePrefix=alarminst):
+            for response in cloudwatch_pages('describe_alarms',
+                                             {'AlarmNamePrefix' : alarminst,
+                                              'MaxRecords' : DESCRIBE_ALARMS_PAGE}):
                 alarms.extend(response['MetricAlarms'])
+        elif inventory is not None or len(alarm_list) >= ALARM_SCAN_THRESHOLD:
+            if inventory is None:
+                inventory = get_service_alarms(prefix, service, alarm_list=['All'])
+            alarms = match_instance_alarms(inventory, alarm_list, alarm_keys, dim_name)
         else:
+            owned = instance_alarm_filter(alarm_list, alarm_keys, dim_name)
             for inst in alarm_list:
-                alarminst = alarmprefix + '_' + inst['myname']
-                for response in paginator.paginate(AlarmNamePrefix=alarminst):
-                    alarms.extend(response['MetricAlarms'])
+                alarminst = inst['myname'] + '_'
+                for response in cloudwatch_pages('describe_alarms',
+                                                 {'AlarmNamePrefix' : alarminst,
+                                                  'MaxRecords' : DESCRIBE_ALARMS_PAGE}):
+                    # the prefix also finds instances named <myname>_<more>
+                    alarms.extend(alarm for alarm in response['MetricAlarms'] if owned(alarm))
     return alarms
 
 
@@ -283,15 +1763,229 @@ def delete_service_alarms(alarm_list):
     alarmnames = []
     for alarm in alarm_list:
         alarmnames.append(alarm['AlarmName'])
-        # limit of 100 for delete
-        if len(alarmnames) > 90:
-            CW_C.delete_alarms(AlarmNames=alarmnames)
+        if len(alarmnames) == DELETE_ALARMS_MAX:
+            cloudwatch_call('delete_alarms', {'AlarmNames' : alarmnames})
             alarmnames = []
     if alarmnames:
-        CW_C.delete_alarms(AlarmNames=alarmnames)
+        cloudwatch_call('delete_alarms', {'AlarmNames' : alarmnames})
+
+
+def fingerprint_alarm(alarm):
+    """
+    Return a digest of the alarm settings zumoco manages, from either
+    put_metric_alarm arguments or a describe_alarms result
+    """
+    settings = {key: alarm.get(key) for key in ALARM_FINGERPRINT_KEYS}
+    if settings['Threshold'] is not None:
+        settings['Threshold'] = float(settings['Threshold'])
+    for key in ['AlarmActions', 'OKActions']:
+        settings[key] = sorted(settings[key] or [])
+    settings['Dimensions'] = settings['Dimensions'] or None
+    if settings['Metrics']:
+        settings['Metrics'] = [{key: query.get(key) for key in ALARM_QUERY_KEYS}
+                               for query in settings['Metrics']]
+    body = json.dumps(settings, sort_keys=True)
+    return hashlib.sha1(body.encode('utf-8')).hexdigest()
+
+
+def shared_alarm_keys(svc, svc_info, team_info):
+    """
+    Return the instance alarm keys of the team's other MonitorDefs files
+    that name alarms with the same AlarmPrefix and Service
+    """
+    keys = set()
+    for other in team_info['MonitorDefs']:
+        other_info = load_service_file(other) if other != svc else None
+        if other_info and other_info['AlarmPrefix'] == svc_info['AlarmPrefix'] and \
+           other_info['Service'] == svc_info['Service']:
+            keys.update(instance_alarms(other_info['Alarms']))
+    return keys
+
+
+def reconcile_service_alarms(svc_inst, del_inst, svc_info, shared_keys=()):
+    """
+    Make the service's alarms match its monitordef: create missing alarms,
+    re-put alarms whose settings changed, and delete alarms of deleted
+    instances or of alarms removed from the monitordef.  Alarms named for
+    shared_keys belong to other monitordefs with the same AlarmPrefix and
+    Service, and are left alone.
+    Return the service's alarms, as create_service_alarms does.
+    """
+    inventory = get_service_alarms(svc_info['AlarmPrefix'], svc_info['Service'],
+                                   alarm_list=['All'])
+    existing = {alarm['AlarmName']: alarm for alarm in inventory}
+    desired = {params['AlarmName']: params
+               for params in build_service_alarm_params(svc_inst, svc_info)}
+
+    puts = [params for name, params in desired.items()
+            if name not in existing or
+            fingerprint_alarm(params) != fingerprint_alarm(existing[name])]
+
+    # A live instance's alarm is stale if its alarm was removed from the
+    # monitordef, or if the instance was renamed and its alarm under the new
+    # name is desired.  An alarm whose parameters failed to build (e.g. a
+    # topic lookup failed) is missing from desired, but is not stale.
+    live = {inst[svc_info['AlarmDimName']]: inst['myname'] for inst in svc_inst
+            if svc_info['AlarmDimName'] in inst}
+    own_keys = instance_alarms(svc_info['Alarms'])
+    alarm_keys = sorted(set(own_keys) | set(shared_keys), key=len, reverse=True)
+    stale = {}
+    for alarm in inventory:
+        if not alarm.get('Dimensions') or alarm['Dimensions'][0]['Value'] not in live:
+            continue
+        name = alarm['AlarmName']
+        key = next((key for key in alarm_keys if name.endswith('_' + key)), None)
+        if key is not None and key not in own_keys:
+            continue
+        current = live[alarm['Dimensions'][0]['Value']] + '_' + str(key)
+        if key is None or (name != current and current in desired):
+            stale[name] = alarm
+    stale.update({alarm['AlarmName']: alarm
+                  for alarm in match_instance_alarms(inventory, del_inst or [],
+                                                     instance_alarms(svc_info['Alarms']),
+                                                     svc_info['AlarmDimName'])})
+
+    delete_service_alarms(list(stale.values()))
+    put_metric_alarms(puts)
+    Logger.info('Reconciled ' + svc_info['Service'] + ' alarms: ' +
+                str(len(puts)) + ' put, ' + str(len(stale)) + ' deleted')
+
+    if not puts and not stale:
+        return inventory
+    return get_service_alarms(svc_info['AlarmPrefix'], svc_info['Service'],
+                              alarm_list=['All'])
+
+
+def group_tags(svc_info):
+    """
+    Return the instance tags Aggregate alarms group by
+    """
+    return sorted(set(alarm_def['Aggregate']['GroupTag']
+                      for alarm_def in svc_info['Alarms'].values()
+                      if alarm_def.get('Aggregate') and
+                      alarm_def['Aggregate'].get('GroupTag')))
+
+
+def group_value(inst, svc_info, tag):
+    """
+    Return an instance's value of a group tag, from its tags or projected record
+    """
+    if 'mygroups' in inst:
+        return inst['mygroups'].get(tag)
+    tags = inst.get(svc_info['TagsKey']) or []
+    return {i['Key']: i['Value'] for i in tags}.get(tag)
+
+
+def group_alarm_prefix(svc_info):
+    """
+    Return the name prefix of a service's Aggregate alarms
+    """
+    return svc_info['AlarmPrefix'] + '_' + svc_info['Service'] + '_' + \
+           svc_info['S3Suffix'] + '_group_'
+
+
+def build_group_alarm_params(group, alarm, alarm_def, svc_info, alm_tgt):
+    """
+    Return put_metric_alarm arguments for one Aggregate alarm: a Metrics
+    Insights query over the group's members, breaching when any member does
+    """
+    aggregate = alarm_def['Aggregate']
+    function = aggregate.get('Function') or \
+               AGGREGATE_FUNCTIONS[alarm_def['ComparisonOperator']]
+    dim_name = aggregate['GroupBy']
+    query = 'SELECT ' + function + '(' + alarm_def['MetricName'] + ') FROM SCHEMA("' + \
+            alarm_def['Namespace'] + '", '
+    if dim_name == 'All':
+        query += svc_info['AlarmDimName'] + ')'
+    else:
+        query += dim_name + ') WHERE ' + dim_name + " = '" + \
+                 group.replace('\\', '\\\\').replace("'", "\\'") + "'"
+    name = group_alarm_prefix(svc_info) + group
+    name = name[:MAX_ALARM_NAME - len(alarm) - 1] + '_' + alarm
+    params = {'AlarmName' : name,
+              'AlarmDescription' : alarm_def['AlarmDescription'],
+              'Metrics' : [{'Id' : 'q1', 'Expression' : query,
+                            'Period' : alarm_def['Period'], 'ReturnData' : True}],
+              'Threshold' : alarm_def['Threshold'],
+              'ComparisonOperator' : alarm_def['ComparisonOperator'],
+              'EvaluationPeriods' : alarm_def['EvaluationPeriods'],
+              'AlarmActions' : [alm_tgt[alarm_def['AlarmAction']]]}
+    if alarm_def['send_ok']:
+        params['OKActions'] = [alm_tgt[alarm_def['AlarmAction']]]
+    return params
+
+
+def build_group_alarms_params(svc_inst, svc_info):
+    """
+    Return put_metric_alarm arguments for every Aggregate alarm of
+    every group found among the instances
+    """
+    aggregates = {alarm: alarm_def for alarm, alarm_def in svc_info['Alarms'].items()
+                  if alarm_def.get('Aggregate')}
+    if not aggregates:
+        return []
+    alm_tgt = get_notify_targets(alarm_destinations(svc_info))
+    alarm_params = []
+    for alarm in prioritize_alarms(aggregates):
+        aggregate = aggregates[alarm]['Aggregate']
+        if aggregate['GroupBy'] == 'All':
+            groups = ['All'] if svc_inst else []
+        else:
+            groups = sorted(set(group_value(inst, svc_info, aggregate['GroupTag'])
+                                for inst in svc_inst) - set([None, '']))
+        for group in groups:
+            try:
+                alarm_params.append(build_group_alarm_params(group, alarm, aggregates[alarm],
+                                                             svc_info, alm_tgt))
+            except KeyError:
+                Logger.warning('Failed to create alarm: ' + group + '_' + alarm)
+    return alarm_params
 
 
-def format_widget_props(svc_info, cht_name, chart, inst, alarms):
+def sync_group_alarms(svc_inst, svc_info, prune=True):
+    """
+    Make the service's Aggregate alarms match the groups of its instances:
+    put missing or changed group alarms and (if prune) delete those of
+    groups or alarms that no longer exist.  Instances joining or leaving
+    an existing group need no alarm changes.
+    Return whether any group alarm was put or deleted.
+    """
+    desired = {params['AlarmName']: params
+               for params in build_group_alarms_params(svc_inst, svc_info)}
+    existing = {}
+    for response in cloudwatch_pages('describe_alarms',
+                                     {'AlarmNamePrefix' : group_alarm_prefix(svc_info),
+                                      'MaxRecords' : DESCRIBE_ALARMS_PAGE}):
+        existing.update((alarm['AlarmName'], alarm) for alarm in response['MetricAlarms'])
+
+    puts = [params for name, params in desired.items()
+            if name not in existing or
+            fingerprint_alarm(params) != fingerprint_alarm(existing[name])]
+    stale = [alarm for name, alarm in existing.items() if name not in desired] if prune else []
+    delete_service_alarms(stale)
+    put_metric_alarms(puts)
+    if puts or stale:
+        Logger.info('Synced ' + svc_info['Service'] + ' group alarms: ' +
+                    str(len(puts)) + ' put, ' + str(len(stale)) + ' deleted')
+    return bool(puts or stale)
+
+
+def index_alarms(alarms):
+    """
+    Index alarm ARNs by (MetricName, dimension name, dimension value),
+    keeping each alarm's list position so lookups return the first match
+    """
+    index = {}
+    for pos, alarm in enumerate(alarms):
+        if not alarm.get('Dimensions'):
+            continue
+        dim = alarm['Dimensions'][0]
+        index.setdefault((alarm['MetricName'], dim['Name'], dim['Value']),
+                         (pos, alarm['AlarmArn']))
+    return index
+
+
+def format_widget_props(svc_info, cht_name, chart, inst, alarm_index):
     """
     Helper to format AWS dashboard widget dictionary
     """
@@ -299,13 +1993,12 @@ def format_widget_props(svc_info, cht_name, chart, inst, alarms):
     props = {}
 
     if chart['is_alarm']:
-        arns = []
-        for alarm in alarms:
-            if alarm['MetricName'] in chart['metric_list']:
-                if alarm['Dimensions'][0]['Value'] == inst[svc_info['AlarmDimName']]:
-                    arns.append(alarm['AlarmArn'])
-                    # currently AWS handles 1 alarm
-                    break
+        dim_name = svc_info['AlarmDimName']
+        matches = [alarm_index[(metric, dim_name, inst[dim_name])]
+                   for metric in chart['metric_list']
+                   if (metric, dim_name, inst[dim_name]) in alarm_index]
+        # currently AWS handles 1 alarm
+        arns = [min(matches)[1]] if matches else []
         props['annotations'] = {'alarms' : arns}
     else:
         for mts in chart['metric_list']:
@@ -313,7 +2006,7 @@ def format_widget_props(svc_info, cht_name, chart, inst, alarms):
             metric.append(inst[svc_info['AlarmDimName']])
             metrics.append(metric)
         props['metrics'] = metrics
-        avail_zone = eval('inst' + chart['avail'])
+        avail_zone = compile_monitor_def(svc_info)['avail'][chart['avail']](inst)
         props['region'] = avail_zone[:-1]
         props['stat'] = chart['stat']
     props['period'] = chart['period']
@@ -333,13 +2026,14 @@ def build_dashboard_widgets(svc_inst, alarms, svc_info):
     width = 6
     height = 4
     chts = svc_info['Charts']
+    alarm_index = index_alarms(alarms)
     for inst in svc_inst:
         for cht in chts:
             # build a chart widget
             widg = {}
             cht_name = inst['myname'] + ' ' + cht
             widg['properties'] = format_widget_props(svc_info, cht_name,
-                                                     chts[cht], inst, alarms)
+                                                     chts[cht], inst, alarm_index)
             widg['type'] = chts[cht]['ch_type']
 
             # position graph
@@ -350,7 +2044,7 @@ def build_dashboard_widgets(svc_inst, alarms, svc_info):
 
             # go small if singleValue chart
             if widg['properties']['view'] == 'singleValue':
-                widg['width'] /= 2
+                widg['width'] = int(widg['width'] / 2)
             widgets.append(widg)
 
             # wrap to next line, if necessary
@@ -362,10 +2056,130 @@ def build_dashboard_widgets(svc_inst, alarms, svc_info):
     return widgets
 
 
+def search_expression(namespace, dim_name, metric, stat, period, term=None):
+    """
+    Return a SEARCH() expression over every dim_name series of a metric
+    """
+    query = '{' + namespace + ',' + dim_name + '} MetricName="' + metric + '"'
+    if term:
+        query += ' ' + term
+    return "SEARCH('" + query + "', '" + stat + "', " + str(period) + ")"
+
+
+def build_alarm_widget(alarms, title):
+    """
+    Return an alarm status widget for up to ALARM_WIDGET_MAX alarms,
+    those in ALARM state first
+    """
+    ordered = sorted(alarms, key=lambda a: (a.get('StateValue') != 'ALARM', a['AlarmName']))
+    if len(ordered) > ALARM_WIDGET_MAX:
+        title += ' (' + str(ALARM_WIDGET_MAX) + ' of ' + str(len(ordered)) + ')'
+    return {'type' : 'alarm',
+            'properties' : {'title' : title,
+                            'alarms' : [a['AlarmArn'] for a in ordered[:ALARM_WIDGET_MAX]],
+                            'sortBy' : 'stateUpdatedTimestamp'}}
+
+
+def build_search_widgets(alarms, svc_info, region):
+    """
+    Return one SEARCH() widget per chart, covering every instance, and an
+    alarm status widget, so the dashboard size does not grow with the fleet
+    """
+    name = svc_info['AlarmPrefix'] + '_' + svc_info['Service'] + '_' + svc_info['S3Suffix']
+    dim_name = svc_info['AlarmDimName']
+    # a metric's namespace and statistic come from its per instance alarms, else
+    # its Aggregate ones, and only per instance alarms give threshold annotations
+    alarm_defs = {}
+    for alarm_def in sorted(svc_info['Alarms'].values(),
+                            key=lambda alarm_def: bool(alarm_def.get('Aggregate'))):
+        alarm_defs.setdefault(alarm_def['MetricName'], alarm_def)
+    thresholds = collections.defaultdict(list)
+    for alarm, alarm_def in sorted(instance_alarms(svc_info['Alarms']).items()):
+        thresholds[alarm_def['MetricName']].append({'label' : alarm + ' threshold',
+                                                    'value' : alarm_def['Threshold']})
+    widgets = [build_alarm_widget(alarms, name + ' alarms')]
+    for cht_name, chart in svc_info['Charts'].items():
+        searches = []
+        annotations = []
+        if chart['is_alarm']:
+            for metric in chart['metric_list']:
+                alarm_def = alarm_defs.get(metric)
+                if alarm_def is None:
+                    Logger.warning('No alarm defines the namespace of ' + metric +
+                                   ', left out of chart ' + cht_name)
+                    continue
+                if alarm_def.get('Aggregate'):
+                    function = alarm_def['Aggregate'].get('Function') or \
+                               AGGREGATE_FUNCTIONS[alarm_def['ComparisonOperator']]
+                    stat = AGGREGATE_STATISTICS.get(function.upper(), 'Average')
+                else:
+                    stat = alarm_def['Statistic']
+                searches.append(search_expression(alarm_def['Namespace'], dim_name, metric,
+                                                  stat, chart['period'], chart.get('search')))
+                annotations.extend(thresholds[metric])
+        else:
+            for mts in chart['metric_list']:
+                searches.append(search_expression(mts[0], mts[2], mts[1], chart['stat'],
+                                                  chart['period'], chart.get('search')))
+        if not searches:
+            Logger.warning('Skipping chart ' + cht_name + ' of ' + name + ': no metrics')
+            continue
+        props = {'metrics' : [[{'expression' : expr, 'id' : 'e' + str(pos + 1)}]
+                              for pos, expr in enumerate(searches)],
+                 'region' : region,
+                 'period' : chart['period'],
+                 'view' : 'timeSeries',
+                 'stacked' : chart['stacked'],
+                 'title' : name + ' ' + cht_name}
+        if annotations:
+            props['annotations'] = {'horizontal' : annotations}
+        widgets.append({'type' : 'metric', 'properties' : props})
+
+    for pos, widg in enumerate(widgets):
+        # two widgets per row
+        widg['x'] = (pos % 2) * SEARCH_WIDGET_WIDTH
+        widg['y'] = (pos // 2) * SEARCH_WIDGET_HEIGHT
+        widg['width'] = SEARCH_WIDGET_WIDTH
+        widg['height'] = SEARCH_WIDGET_HEIGHT
+    return widgets
+
+
+def hash_dashboard_body(body):
+    """
+    Return a stable digest of a dashboard body dictionary
+    """
+    return hashlib.sha1(json.dumps(body, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def dashboard_unchanged(dname, digest):
+    """
+    Compare a dashboard page digest against the last published page,
+    fetching the current body when this container has not published it
+    """
+    with DASHBOARD_LOCK:
+        if DASHBOARD_HASHES.get(target_prefix() + dname) == digest:
+            return True
+    try:
+        resp = cloudwatch_call('get_dashboard', {'DashboardName' : dname})
+    except exceptions.ClientError as err:
+        if err.response['Error']['Code'] == 'ResourceNotFound':
+            return False
+        raise
+    if hash_dashboard_body(json.loads(resp['DashboardBody'])) != digest:
+        return False
+    with DASHBOARD_LOCK:
+        DASHBOARD_HASHES[target_prefix() + dname] = digest
+    return True
+
+
 def generate_dashboard(name, chart_j):
     """
-    Given chart widgets, create a dashboard
+    Given chart widgets, create a dashboard.
+    Only pages whose content changed are written, and trailing
+    pages no longer needed are deleted.
     """
+    existing = {d['DashboardName']: d for d in get_dashboards(name)}
+    changed = False
     wgtcount = len(chart_j['widgets'])
     dashcount = int(wgtcount / DASHBOARD_MAX_WIDGET + 1)
     for dash in range(0, dashcount):
@@ -374,9 +2188,24 @@ def generate_dashboard(name, chart_j):
                                       min(dash * DASHBOARD_MAX_WIDGET + wgtcount,
                                           (dash+1) * DASHBOARD_MAX_WIDGET)]
         dwidgets = {'widgets' : widglist}
-        CW_C.put_dashboard(DashboardName=dname, DashboardBody=json.dumps(dwidgets))
+        digest = hash_dashboard_body(dwidgets)
+        if dname not in existing or not dashboard_unchanged(dname, digest):
+            cloudwatch_call('put_dashboard', {'DashboardName' : dname,
+                                              'DashboardBody' : json.dumps(dwidgets)})
+            with DASHBOARD_LOCK:
+                DASHBOARD_HASHES[target_prefix() + dname] = digest
+            changed = True
         wgtcount -= DASHBOARD_MAX_WIDGET
 
+    pages = re.compile(re.escape(name) + r'_(\d+)$')
+    stale = [existing[d] for d in existing
+             if pages.match(d) and int(pages.match(d).group(1)) > dashcount]
+    if stale:
+        delete_dashboards(stale)
+        changed = True
+
+    if not changed:
+        return list(existing.values())
     return get_dashboards(name)
 
 
@@ -384,8 +2213,10 @@ def get_dashboards(prefix):
     """
     Get Cloudwatch dashboards for a given prefix
     """
-    dashboards = CW_C.list_dashboards(DashboardNamePrefix=prefix)
-    return dashboards['DashboardEntries']
+    dashboards = []
+    for response in cloudwatch_pages('list_dashboards', {'DashboardNamePrefix' : prefix}):
+        dashboards.extend(response['DashboardEntries'])
+    return dashboards
 
 def delete_dashboards(dashboard_list):
     """
@@ -395,118 +2226,769 @@ def delete_dashboards(dashboard_list):
     for dashboard in dashboard_list:
         dashboardnames.append(dashboard['DashboardName'])
     if dashboardnames:
-        CW_C.delete_dashboards(DashboardNames=dashboardnames)
+        cloudwatch_call('delete_dashboards', {'DashboardNames' : dashboardnames})
+        with DASHBOARD_LOCK:
+            for dname in dashboardnames:
+                DASHBOARD_HASHES.pop(target_prefix() + dname, None)
 
-def parse_service_response(svc_client, svc_info, response):
+def in_shard(inst, svc_info, shard):
     """
-    Handle paginated response from service
+    Return whether an instance belongs to shard (index, count),
+    by a stable hash of its alarm dimension value
     """
-    inst = []
-    if svc_info['InstanceIterator2']:
-        # Two levels of lists
-        for tmp in response[svc_info['InstanceIterator1']]:
-            for tmp2 in tmp[svc_info['InstanceIterator2']]:
-                tmp2['myname'] = create_friendly_name(tmp2, svc_client, svc_info)
-                inst.append(tmp2)
-    elif svc_info['InstanceIterator1']:
-        for tmp in response[svc_info['InstanceIterator1']]:
-            tmp['myname'] = create_friendly_name(tmp, svc_client, svc_info)
-            inst.append(tmp)
-    else:
-        for tmp in response:
-            tmp['myname'] = create_friendly_name(tmp, svc_client, svc_info)
-            inst.append(tmp)
+    if shard is None or shard[1] <= 1:
+        return True
+    digest = hashlib.sha1(inst[svc_info['AlarmDimName']].encode('utf-8')).hexdigest()
+    return int(digest, 16) % shard[1] == shard[0]
+
+
+def parse_service_response(svc_client, svc_info, response, shard=None):
+    """
+    Handle paginated response from service, keeping only the fields used.
+    Given a shard (index, count), other shards' instances are dropped
+    before their tags are resolved and names built.
+    """
+    compiled = compile_monitor_def(svc_info)
+    inst = [tmp for tmp in compiled['project'](compiled['instances'](response))
+            if in_shard(tmp, svc_info, shard)]
+
+    # Resolve the whole page's tags at once, rather than per instance
+    if svc_info['FriendlyName']:
+        resolve_instance_tags(inst, svc_info)
+    tags = group_tags(svc_info)
+    for tmp in inst:
+        tmp['myname'] = create_friendly_name(tmp, svc_client, svc_info)
+        # kept in the state file, for the sharded merge to prune group alarms
+        if tags:
+            tmp['mygroups'] = {tag: group_value(tmp, svc_info, tag) for tag in tags}
     return inst
 
 
-def get_service_instances(svc_client, svc_info):
+def iter_service_instances(svc_client, svc_info, shard=None):
+    """
+    Yield named instances for the given service, one page at a time,
+    Flattening AWS structure if necessary.
+    Given a shard (index, count), only that shard's instances are yielded.
+    """
+    paginator = svc_client.get_paginator(svc_info['DiscoverInstance'])
+    for response in paginator.paginate(**discovery_kwargs(svc_info)):
+        for inst in parse_service_response(svc_client, svc_info, response, shard):
+            yield inst
+
+
+def get_service_instances(svc_client, svc_info, shard=None):
     """
     Retrieve instances for the given service,
     Flattening AWS structure if necessary
     """
+    return list(iter_service_instances(svc_client, svc_info, shard))
+
+
+def project_instance(inst, svc_info):
+    """
+    Reduce an instance to the fields alarms and dashboards use:
+    its name, fingerprint, alarm dimension and the charts' avail fields
+    """
+    keys = instance_keys(svc_info) - set([svc_info['TagsKey'],
+                                          svc_info['DiscoverTagsInstParm']])
+    keys.add('myname')
+    record = {key: inst[key] for key in keys if key in inst}
+    record['myfingerprint'] = fingerprint_instance(inst)
+    tags = group_tags(svc_info)
+    if tags:
+        record['mygroups'] = {tag: group_value(inst, svc_info, tag) for tag in tags}
+    return record
+
+
+def stream_service_instances(svc_client, svc_info, old_inst, create_alarms=True,
+                             shard=None, existing=None):
+    """
+    Stream discovered instances page by page through naming, delta
+    detection against the previous state, and (optionally) alarm creation,
+    holding only compact records of the fleet.
+    Alarms in existing (AlarmName to fingerprint) with the same settings are skipped.
+    Return (instances, deleted instances, new instances, new instances
+    whose alarms were not all completed).
+    """
+    old_index = {inst['myname']: inst for inst in old_inst or []}
+    alm_tgt = get_notify_targets(alarm_destinations(svc_info)) if create_alarms else {}
+    alarms = instance_alarms(svc_info['Alarms'])
+    rank = {alarm: pos for pos, alarm in enumerate(prioritize_alarms(alarms))}
     instances = []
-    paginator = svc_client.get_paginator(svc_info['DiscoverInstance'])
-    if svc_info['InstanceFilters']:
-        for response in paginator.paginate(Filters=svc_info['InstanceFilters']):
-            instances.extend(parse_service_response(svc_client, svc_info, response))
+    new_inst = []
+    pending = []
+    results = {}
+    for inst in iter_service_instances(svc_client, svc_info, shard):
+        record = project_instance(inst, svc_info)
+        instances.append(record)
+        if record['myname'] in old_index:
+            continue
+        new_inst.append(record)
+        if not create_alarms:
+            continue
+        for alarm in alarms:
+            try:
+                params = build_alarm_params(record, alarm, alarms[alarm], svc_info, alm_tgt)
+                if not existing or \
+                   existing.get(params['AlarmName']) != fingerprint_alarm(params):
+                    pending.append((rank[alarm], params))
+            except KeyError:
+                Logger.warning('Failed to create alarm: ' + record['myname'] +
+                               '_' + alarm)
+        if len(pending) >= STREAM_ALARM_BATCH:
+            results.update(put_metric_alarms(
+                [params for _, params in sorted(pending, key=lambda p: p[0])]))
+            pending = []
+    results.update(put_metric_alarms(
+        [params for _, params in sorted(pending, key=lambda p: p[0])]))
+    unfinished = unfinished_instances(new_inst, svc_info, results)
+
+    if not old_index:
+        return instances, None, new_inst, unfinished
+    seen = set(inst['myname'] for inst in instances)
+    del_inst = [old_index[name] for name in old_index if name not in seen]
+    return instances, del_inst, new_inst, unfinished
+
+
+def get_service_workers(team_info):
+    """
+    Return the bounded number of services to process concurrently
+    """
+    try:
+        workers = int(team_info.get('ServiceWorkers', 1))
+    except (TypeError, ValueError):
+        Logger.warning('Invalid ServiceWorkers value, running sequentially')
+        workers = 1
+    return max(1, min(workers, MAX_SERVICE_WORKERS))
+
+
+def shard_suffix(shard):
+    """
+    Return the state file / dashboard name suffix for a shard (index, count)
+    """
+    if shard is None or shard[1] <= 1:
+        return ''
+    return '_shard' + str(shard[0]) + 'of' + str(shard[1])
+
+
+def service_shards(svc_info, team_info):
+    """
+    Return the number of shards of a service in Sharding mode
+    (monitordef Shards, else Sharding Shards, else 1)
+    """
+    default_shards = team_info['Sharding'].get('Shards', 1)
+    return max(1, int((svc_info or {}).get('Shards', default_shards)))
+
+
+def state_file_name(svc_info, shard=None):
+    """
+    Return the S3 key of a service's (or service shard's) state file,
+    under the current target's prefix
+    """
+    return (target_prefix() + svc_info['Service'] + '_' + svc_info['S3Suffix'] +
+            shard_suffix(shard) + '.json')
+
+
+def process_service(svc, team_info, now_str, shard=None):
+    """
+    Run the discovery/alarm/dashboard pipeline for one MonitorDefs entry,
+    returning its service info and dashboard widgets.
+    Given a shard (index, count), only that shard's instances are handled.
+    Work that does not fit the run's time budget is deferred to the next run.
+    Discovery, alarms and dashboards use the current thread's target.
+    """
+    #   Load service file
+    svc_info = load_service_file(svc)
+    if not svc_info:
+        return None, []
+    job = target_prefix() + svc
+    if RUN_BUDGET.exhausted():
+        Logger.warning('Out of time, deferring service file ' + job)
+        RUN_BUDGET.defer(job)
+        return svc_info, []
+
+    #   Ensure API exists for service
+    try:
+        svc_client = target_client(svc_info['Service'])
+    except exceptions.UnknownServiceError:
+        Logger.critical('Service unknown to AWS API:' + svc_info['Service'])
+        return svc_info, []
+
+    if svc_info['Service'] not in SERVICE_LIST:
+        Logger.warning('No permissions for listing instances. Service: ')
+        Logger.warning(svc_info['Service'])
+        return svc_info, []
+
+    instfile = state_file_name(svc_info, shard)
+    # Get old instances
+    with timed_phase(svc, 'load_state'):
+        old_inst = load_instances(team_info['Bucket'], instfile,
+                                  svc_info['AlarmDimName'])
+    reconcile = team_info.get('ReconcileAlarms', False)
+    streaming = team_info.get('StreamingDiscovery', False)
+    # A service left unfinished by the previous run skips the alarms it already put
+    resumed = job in RUN_BUDGET.resumed and not reconcile
+    unfinished = []
+    if streaming:
+        #   Get new instances, creating alarms for new ones as they arrive.
+        with timed_phase(svc, 'stream'):
+            existing = existing_alarm_fingerprints(svc_info, ['All']) if resumed else None
+            instances, del_inst, new_inst, unfinished = stream_service_instances(
+                svc_client, svc_info, old_inst, create_alarms=not reconcile,
+                shard=shard, existing=existing)
     else:
-        for response in paginator.paginate():
-            instances.extend(parse_service_response(svc_client, svc_info, response))
+        #   Get new instances.
+        with timed_phase(svc, 'discover'):
+            instances = get_service_instances(svc_client, svc_info, shard)
+        # Determine what's new and deleted.
+        del_inst, new_inst = determine_deltas(list(instances), old_inst)
+    inventory = None
+    if not reconcile:
+        #   Cleanup any old instance alarms, matching many against one prefix scan.
+        with timed_phase(svc, 'delete_alarms'):
+            if del_inst and len(del_inst) >= ALARM_SCAN_THRESHOLD:
+                inventory = get_service_alarms(svc_info['AlarmPrefix'], svc_info['Service'],
+                                               alarm_list=['All'])
+            deleted = get_service_alarms(svc_info['AlarmPrefix'], svc_info['Service'],
+                                         alarm_list=del_inst, inventory=inventory,
+                                         alarm_keys=instance_alarms(svc_info['Alarms']),
+                                         dim_name=svc_info['AlarmDimName'])
+            delete_service_alarms(deleted)
+
+    with timed_phase(svc, 'alarms'):
+        if reconcile:
+            #   Create, update and delete alarms to match the monitordef.
+            alarms = reconcile_service_alarms(instances, del_inst, svc_info,
+                                              shared_alarm_keys(svc, svc_info, team_info))
+        elif not streaming:
+            #   Create instance alarms for new instances.
+            existing = None
+            if resumed and new_inst:
+                existing = existing_alarm_fingerprints(svc_info, new_inst)
+            unfinished = write_service_alarms(new_inst, svc_info, existing)
+        #   Aggregate alarms follow the groups, not individual instances.  A shard
+        #   only sees some groups, so it leaves other shards' group alarms alone:
+        #   the run's merge prunes them (see prune_sharded_group_alarms).
+        synced = sync_group_alarms(instances, svc_info, prune=shard is None or shard[1] <= 1)
+        if not reconcile and inventory is not None and not new_inst and not synced:
+            #   Nothing was put since the scan: reuse it, less the deleted alarms.
+            names = set(alarm['AlarmName'] for alarm in deleted)
+            alarms = [alarm for alarm in inventory if alarm['AlarmName'] not in names]
+        elif not reconcile:
+            alarms = get_service_alarms(svc_info['AlarmPrefix'], svc_info['Service'],
+                                        alarm_list=['All'])
+    if unfinished or RUN_BUDGET.exhausted():
+        Logger.warning('Out of time, ' + str(len(unfinished)) + ' instances of ' +
+                       job + ' deferred')
+        RUN_BUDGET.defer(job)
+
+    #   Only commit state for completed work: new instances whose alarms
+    #   are unfinished stay out of it, to be picked up as new next run.
+    if unfinished:
+        names = set(inst['myname'] for inst in unfinished)
+        instances = [inst for inst in instances if inst['myname'] not in names]
+        new_inst = [inst for inst in new_inst if inst['myname'] not in names]
+    with timed_phase(svc, 'save_state'):
+        http_status = save_instances(instances, team_info['Bucket'],
+                                     instfile, svc_info['AlarmDimName'])
+    if http_status != 200:
+        Logger.error('Unable to write instances file:' + instfile)
+
+    record = report_record(len(instances), new_inst, del_inst, svc_info,
+                           target_prefix()[:-1])
+    if team_info['SendStatusUpdates'] and record:
+        if team_info.get('ReportDigest'):
+            with REPORT_LOCK:
+                REPORT_DIGEST[job] = (svc_info['ReportARN'], record)
+        else:
+            with timed_phase(svc, 'report'):
+                publish_report(svc_info['ReportARN'],
+                               render_report([record], now_str,
+                                             team_info.get('ReportFormat')), now_str)
+
+    if job in RUN_BUDGET.deferred:
+        #   A deferred service's dashboards would miss its unfinished work:
+        #   the previous ones are kept until it completes.
+        return svc_info, []
+
+    with timed_phase(svc, 'dashboards'):
+        if svc_info.get('DashboardMode') == 'search':
+            #   Search widgets cover every shard's instances, so only one
+            #   shard builds them, under the unsharded dashboard name.
+            if shard is not None and shard[0] > 0:
+                return svc_info, []
+            shard = None
+            dash_j = build_search_widgets(alarms, svc_info,
+                                          target_client('cloudwatch').meta.region_name)
+        else:
+            dash_j = build_dashboard_widgets(instances, alarms, svc_info)
 
-    return instances
+        #   If service dashboard is requested, create one.
+        if svc_info['CreateServiceDashboard']:
+            name = svc_info['AlarmPrefix'] + '_' + svc_info['Service']
+            name += '_' + svc_info['S3Suffix'] + shard_suffix(shard)
+            chart_j = {'widgets' : dash_j}
+            generate_dashboard(name, chart_j)
 
+    return svc_info, dash_j
 
 
-def main(event, context):
+def run_service(svc, team_info, now_str, shard=None, target=None):
     """
-    Main functionality
+    Isolate a single service's pipeline, so one failure does not
+    abort the remaining MonitorDefs (or targets)
     """
-    all_widgets = []
-    cons = pdt.Constants()
-    cons.YearParseStyle = 0
-    pdtcal = pdt.Calendar(cons)
-    now_tm = pdtcal.parse("now")
-    now_str = strftime('%c', now_tm[0])
+    try:
+        with use_target(target), timed_phase(svc, 'total'):
+            return process_service(svc, team_info, now_str, shard)
+    except Exception: # pylint: disable=broad-except
+        Logger.exception('Failed processing service file ' + target_prefix(target) + svc)
+        return None, []
+
+
+def team_jobs(team_info):
+    """
+    Return the (target, MonitorDefs entry) pairs of a run, target by target
+    """
+    return [(target, svc) for target in team_targets(team_info)
+            for svc in team_info['MonitorDefs']]
 
-    ##### PROGRAM FLOW #####
-    # Load team file
-    team_info = load_monitor_file(TEAM_FILEPATH)
 
-    # For each service file in MonitorDefs,
+def run_services(team_info, now_str, jobs=None):
+    """
+    Run every (target, MonitorDefs) pipeline, concurrently if ServiceWorkers > 1
+    or there are several Targets (ServiceWorkers per target).
+    Results are returned in the order of jobs, by default team_jobs.
+    """
+    jobs = team_jobs(team_info) if jobs is None else jobs
+    workers = get_service_workers(team_info)
+    if team_info.get('Targets'):
+        workers = min(workers * len(team_info['Targets']), MAX_TARGET_WORKERS)
+    workers = min(workers, max(len(jobs), 1))
+    if workers == 1:
+        return [run_service(svc, team_info, now_str, target=target)
+                for target, svc in jobs]
+
+    with futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(lambda job: run_service(job[1], team_info, now_str,
+                                                         target=job[0]),
+                                 jobs))
+
+
+def orchestrate(team_info):
+    """
+    Fan the MonitorDefs out to asynchronous worker invocations, one per
+    shard of each service in each target
+    """
+    run_id = strftime(RUN_ID_FORMAT) + '-' + '%06x' % random.getrandbits(24)
+    expire_shard_results(team_info)
+    targets = range(len(team_info['Targets'])) if team_info.get('Targets') else [None]
+    jobs = []
     for svc in team_info['MonitorDefs']:
+        svc_info = load_service_file(svc)
+        if not svc_info:
+            Logger.warning('Skipping invalid service file ' + svc)
+            continue
+        shards = service_shards(svc_info, team_info)
+        jobs.extend((target, svc, index, shards) for target in targets
+                    for index in range(shards))
+
+    lambda_c = get_client('lambda')
+    for target, svc, index, shards in jobs:
+        payload = {'zumocoShard' : {'RunId' : run_id, 'MonitorDef' : svc,
+                                    'Shard' : index, 'Shards' : shards,
+                                    'Target' : target, 'Jobs' : len(jobs)}}
+        lambda_c.invoke(FunctionName=team_info['Sharding']['WorkerFunction'],
+                        InvocationType='Event', Payload=json.dumps(payload))
+    Logger.info('Run ' + run_id + ' invoked ' + str(len(jobs)) + ' workers')
+    return run_id
+
+
+def shard_result_key(run_id, svc, index):
+    """
+    Return the S3 key holding a worker's dashboard widgets
+    """
+    return SHARD_RESULTS_PREFIX + run_id + '/' + svc + '_' + str(index) + '.json'
 
-        #   Load service file
-        svc_info = load_monitor_file(DEFS_PATH + svc)
 
-        #   Ensure API exists for service
-        try:
-            svc_client = boto3.client(svc_info['Service'])
-        except exceptions.UnknownServiceError:
-            Logger.critical('Service unknown to AWS API:' + svc_info['Service'])
-
-        if svc_info['Service'] in SERVICE_LIST:
-            #   Get new instances.
-            instances = get_service_instances(svc_client, svc_info)
-            instfile = svc_info['Service'] + '_' + svc_info['S3Suffix'] + '.json'
-            # Get old instances
-            old_inst = load_instances(team_info['Bucket'], instfile)
-            # Determine what's new and deleted.
-            del_inst, new_inst = determine_deltas(list(instances), old_inst)
-            #   Cleanup any old instance alarms.
+def list_shard_results(bucket, prefix):
+    """
+    Return the keys of the workers' results under an S3 prefix
+    """
+    keys = []
+    paginator = get_client('s3').get_paginator('list_objects_v2')
+    for response in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        keys.extend(obj['Key'] for obj in response.get('Contents', []))
+    return keys
+
+
+def delete_shard_results(bucket, keys):
+    """
+    Delete workers' results, 1000 keys per request
+    """
+    s3_c = get_client('s3')
+    for i in range(0, len(keys), 1000):
+        s3_c.delete_objects(Bucket=bucket,
+                            Delete={'Objects' : [{'Key' : k} for k in keys[i:i + 1000]]})
+
+
+def expire_shard_results(team_info):
+    """
+    Remove the results of runs older than SHARD_RESULTS_TTL, left behind
+    when a worker failed and the run was never merged
+    """
+    cutoff = strftime(RUN_ID_FORMAT, time.localtime(time.time() - SHARD_RESULTS_TTL))
+    stale = [key for key in list_shard_results(team_info['Bucket'], SHARD_RESULTS_PREFIX)
+             if key[len(SHARD_RESULTS_PREFIX):].split('/')[0] < cutoff]
+    if stale:
+        Logger.warning('Removing ' + str(len(stale)) + ' results of unmerged runs')
+        delete_shard_results(team_info['Bucket'], stale)
+    return len(stale)
+
+
+def claim_merge(team_info, run_id):
+    """
+    Return whether this worker is the one to merge the run's results,
+    claimed by creating an S3 object only if it does not exist yet
+    """
+    try:
+        get_client('s3').put_object(Bucket=team_info['Bucket'],
+                                    Key=SHARD_RESULTS_PREFIX + run_id + MERGE_CLAIM_SUFFIX,
+                                    Body=b'', IfNoneMatch='*')
+    except exceptions.ClientError as err:
+        if err.response['Error']['Code'] in CONDITIONAL_WRITE_CODES:
+            return False
+        raise
+    return True
+
+
+def prune_sharded_group_alarms(team_info, results, prefix):
+    """
+    Delete the group alarms of groups no shard of a service found,
+    from the groups in every shard's state file.  Services with a
+    failed or deferred shard are left for the next run.
+    """
+    for target in team_targets(team_info):
+        for svc in team_info['MonitorDefs']:
+            svc_info = load_service_file(svc)
+            if not svc_info or not any(alarm_def.get('Aggregate')
+                                       for alarm_def in svc_info['Alarms'].values()):
+                continue
+            shards = service_shards(svc_info, team_info)
+            svc_prefix = prefix + target_prefix(target) + svc + '_'
+            complete = [k for k in results
+                        if k.startswith(svc_prefix) and results[k].get('Complete')]
+            if shards <= 1 or len(complete) < shards:
+                continue
+            with use_target(target), timed_phase(svc, 'group_alarms'):
+                insts = []
+                for index in range(shards):
+                    insts.extend(load_instances(team_info['Bucket'],
+                                                state_file_name(svc_info, (index, shards)),
+                                                svc_info['AlarmDimName']))
+                sync_group_alarms(insts, svc_info)
+
+
+def merge_shard_results(team_info, run_id):
+    """
+    Once every worker of a run has saved its results, prune group alarms
+    across the shards, build each target's team dashboard from the widgets
+    in MonitorDefs order and remove the run's results
+    """
+    if not claim_merge(team_info, run_id):
+        Logger.info('Run ' + run_id + ' is merged by another worker')
+        return False
+    s3_c = get_client('s3')
+    prefix = SHARD_RESULTS_PREFIX + run_id + '/'
+    keys = list_shard_results(team_info['Bucket'], prefix)
+
+    results = {}
+    for key in keys:
+        obj = s3_c.get_object(Bucket=team_info['Bucket'], Key=key)
+        results[key] = json.loads(obj['Body'].read().decode('utf-8'))
+
+    prune_sharded_group_alarms(team_info, results, prefix)
+    if team_info['CreateTeamDashboard']:
+        for target in team_targets(team_info):
+            all_widgets = []
+            alarm_prefix = None
+            for svc in team_info['MonitorDefs']:
+                svc_prefix = prefix + target_prefix(target) + svc + '_'
+                svc_keys = sorted((k for k in results if k.startswith(svc_prefix)),
+                                  key=lambda k, p=svc_prefix: int(k[len(p):-len('.json')]))
+                for key in svc_keys:
+                    alarm_prefix = results[key]['AlarmPrefix'] or alarm_prefix
+                    all_widgets.extend(results[key]['Widgets'])
+
+            if alarm_prefix is not None:
+                name = alarm_prefix + '_' + team_info['Team']
+                with use_target(target), timed_phase('team', 'dashboards'):
+                    generate_dashboard(name, {'widgets' : all_widgets})
+    delete_shard_results(team_info['Bucket'], keys)
+    return True
+
+
+def run_shard(team_info, job, now_str):
+    """
+    Worker: run one shard of one MonitorDefs entry, then save its widgets
+    for the team dashboard and whether it completed, merging the results
+    if it is the run's last worker
+    """
+    svc = job['MonitorDef']
+    target = team_targets(team_info)[job.get('Target') or 0]
+    svc_info, dash_j = run_service(svc, team_info, now_str,
+                                   shard=(job['Shard'], job['Shards']), target=target)
+    send_digest([target_prefix(target) + svc], now_str, team_info.get('ReportFormat'))
+
+    result = {'AlarmPrefix' : svc_info['AlarmPrefix'] if svc_info else None,
+              'Widgets' : dash_j if team_info['CreateTeamDashboard'] else [],
+              'Complete' : bool(svc_info) and
+                           target_prefix(target) + svc not in RUN_BUDGET.deferred}
+    s3_c = get_client('s3')
+    s3_c.put_object(Bucket=team_info['Bucket'],
+                    Key=shard_result_key(job['RunId'], target_prefix(target) + svc,
+                                         job['Shard']),
+                    Body=json.dumps(result).encode('utf-8'))
+    done = list_shard_results(team_info['Bucket'], SHARD_RESULTS_PREFIX + job['RunId'] + '/')
+    if len(done) >= job['Jobs']:
+        merge_shard_results(team_info, job['RunId'])
+
+
+def parse_instance_event(event):
+    """
+    Return (instance id, whether it may be running) for an EC2 state-change
+    or autoscaling launch/terminate EventBridge event, else None
+    """
+    if not isinstance(event, dict):
+        return None
+    detail = event.get('detail') or {}
+    detail_type = event.get('detail-type')
+    if event.get('source') == 'aws.ec2' and detail_type == EC2_STATE_EVENT:
+        return detail.get('instance-id'), detail.get('state') not in EC2_GONE_STATES
+    if event.get('source') == 'aws.autoscaling' and detail_type in ASG_INSTANCE_EVENTS:
+        return detail.get('EC2InstanceId'), ASG_INSTANCE_EVENTS[detail_type]
+    return None
+
+
+def describe_event_instance(svc_client, svc_info, inst_id):
+    """
+    Return the named instance if it matches the monitordef's filters, else None
+    """
+    kwargs = discovery_kwargs(svc_info)
+    kwargs['InstanceIds'] = [inst_id]
+    try:
+        response = getattr(svc_client, svc_info['DiscoverInstance'])(**kwargs)
+    except exceptions.ClientError as err:
+        if err.response['Error']['Code'] == 'InvalidInstanceID.NotFound':
+            return None
+        raise
+    insts = parse_service_response(svc_client, svc_info, response)
+    return insts[0] if insts else None
+
+
+def process_instance_event(svc, team_info, inst_id, running):
+    """
+    Create or delete one ec2 instance's alarms, and add it to or remove it
+    from the state file, following a lifecycle event.  The state file is
+    written only if unchanged since it was read, else re-read and retried,
+    so concurrent events do not drop each other's updates.
+    Return whether anything changed.
+    """
+    svc_info = load_service_file(svc)
+    if not svc_info or svc_info['Service'] != 'ec2':
+        return False
+    dim_name = svc_info['AlarmDimName']
+    inst = None
+    if running:
+        inst = describe_event_instance(target_client('ec2'), svc_info, inst_id)
+
+    shard = None
+    if team_info.get('Sharding'):
+        count = service_shards(svc_info, team_info)
+        shard = [(i, count) for i in range(count)
+                 if in_shard({dim_name : inst_id}, svc_info, (i, count))][0]
+    instfile = state_file_name(svc_info, shard)
+    alarms_written = False
+    for attempt in range(STATE_WRITE_ATTEMPTS):
+        etag, old_inst = load_state(team_info['Bucket'], instfile, dim_name)
+        known = [old for old in old_inst if old.get(dim_name) == inst_id]
+
+        if inst is not None and not known:
+            if not alarms_written and write_service_alarms([inst], svc_info):
+                Logger.warning('Alarms incomplete for ' + inst['myname'] +
+                               ', left to the next run')
+                return False
+            alarms_written = True
+            old_inst.append(inst)
+            message = 'Added ' + inst['myname'] + ' to ' + svc
+        elif inst is None and known:
             delete_service_alarms(get_service_alarms(svc_info['AlarmPrefix'],
                                                      svc_info['Service'],
-                                                     alarm_list=del_inst))
-            http_status = save_instances(instances, team_info['Bucket'],
-                                         instfile)
-            if http_status != 200:
-                Logger.error('Unable to write instances file:' + instfile)
+                                                     alarm_list=known,
+                                                     alarm_keys=instance_alarms(svc_info['Alarms']),
+                                                     dim_name=dim_name))
+            old_inst = [old for old in old_inst if old.get(dim_name) != inst_id]
+            message = 'Removed ' + known[0]['myname'] + ' from ' + svc
+        else:
+            return alarms_written
 
-            report_text = format_report(len(instances), new_inst, del_inst, svc_info)
-            if team_info['SendStatusUpdates'] and report_text:
-                send_report(report_text, svc_info, now_str)
+        status = save_instances(old_inst, team_info['Bucket'], instfile, dim_name, etag=etag)
+        if status == 200:
+            Logger.info(message)
+            return True
+        if status not in (409, 412):
+            Logger.error('Unable to write instances file:' + instfile)
+            return True
+        time.sleep(random.uniform(0, 0.1 * 2 ** attempt))
 
-            #   Create instance alarms for new instances.
-            alarms = create_service_alarms(new_inst, svc_client, svc_info)
+    Logger.warning('State file ' + instfile + ' kept changing, ' + inst_id +
+                   ' left to the next run')
+    return True
 
-            dash_j = build_dashboard_widgets(instances, alarms, svc_info)
-            all_widgets.extend(dash_j)
-
-            #   If service dashboard is requested, create one.
-            if svc_info['CreateServiceDashboard']:
-                name = svc_info['AlarmPrefix'] + '_' + svc_info['Service']
-                name += '_' + svc_info['S3Suffix']
-                chart_j = {'widgets' : dash_j}
-                delete_dashboards(get_dashboards(name))
+
+def event_target(team_info, event):
+    """
+    Return the Targets entry an EventBridge event came from (by its account
+    and region), None without Targets, or False if it matches no target
+    """
+    if not team_info.get('Targets'):
+        return None
+    matches = [target for target in team_info['Targets']
+               if target.get('Region') in (None, event.get('region')) and
+               role_account(target.get('RoleArn')) in (None, event.get('account'))]
+    # a target assuming a role in the event's account wins over the own account
+    matches.sort(key=lambda target: not target.get('RoleArn'))
+    return matches[0] if matches else False
+
+
+def handle_instance_event(team_info, inst_id, running, target=None):
+    """
+    Apply an instance lifecycle event to every ec2 MonitorDefs entry
+    of the given target
+    """
+    for svc in team_info['MonitorDefs']:
+        try:
+            with use_target(target), timed_phase(svc, 'event'):
+                process_instance_event(svc, team_info, inst_id, running)
+        except Exception as err: # pylint: disable=broad-except
+            Logger.error('Failed processing event for ' + inst_id + ' in service file ' +
+                         svc + ': ' + str(err))
+
+
+def load_checkpoint(bucket):
+    """
+    Return the MonitorDefs a previous run left unfinished
+    """
+    try:
+        obj = get_client('s3').get_object(Bucket=bucket, Key=CHECKPOINT_KEY)
+    except exceptions.ClientError as err:
+        if err.response['Error']['Code'] == 'NoSuchKey':
+            return []
+        raise
+    checkpoint = json.loads(obj['Body'].read().decode('utf-8'))
+    return checkpoint.get('Pending', [])
+
+
+def save_checkpoint(bucket, pending, resumed, now_str):
+    """
+    Record the MonitorDefs this run left unfinished,
+    removing the checkpoint once nothing is pending
+    """
+    s3_c = get_client('s3')
+    if pending:
+        checkpoint = {'zumocoCheckpointFormatVersion' : CHECKPOINT_FORMAT_VERSION,
+                      'Saved' : now_str, 'Pending' : pending}
+        s3_c.put_object(Bucket=bucket, Key=CHECKPOINT_KEY,
+                        Body=json.dumps(checkpoint).encode('utf-8'),
+                        ContentType='application/json')
+        Logger.warning('Checkpointed unfinished service files: ' + ', '.join(pending))
+    elif resumed:
+        s3_c.delete_object(Bucket=bucket, Key=CHECKPOINT_KEY)
+
+
+def run_team(team_info, now_str):
+    """
+    Run every (target, MonitorDefs) pipeline in this invocation, those left
+    unfinished by the previous run first, then each target's team dashboard
+    """
+    resumed = load_checkpoint(team_info['Bucket'])
+    RUN_BUDGET.resumed = resumed
+    jobs = team_jobs(team_info)
+    keys = [target_prefix(target) + svc for target, svc in jobs]
+    order = ([i for i, key in enumerate(keys) if key in resumed] +
+             [i for i, key in enumerate(keys) if key not in resumed])
+    all_widgets = {}
+    svc_infos = {}
+    # For each service file in MonitorDefs, run its pipeline
+    for i, (info, dash_j) in zip(order, run_services(team_info, now_str,
+                                                     [jobs[i] for i in order])):
+        if info is not None:
+            svc_infos[target_prefix(jobs[i][0])] = info
+        all_widgets[keys[i]] = dash_j
+    save_checkpoint(team_info['Bucket'], RUN_BUDGET.deferred, resumed, now_str)
+    with timed_phase('team', 'report'):
+        send_digest(keys, now_str, team_info.get('ReportFormat'))
+
+    # If team dashboard is requested, create one per target.  A deferred service
+    # has no widgets, so the previous dashboard is kept until it completes.
+    if RUN_BUDGET.deferred:
+        Logger.warning('Team dashboard not updated, service files deferred')
+    elif team_info['CreateTeamDashboard']:
+        for target in team_targets(team_info):
+            svc_info = svc_infos.get(target_prefix(target))
+            if svc_info is None:
+                continue
+            name = svc_info['AlarmPrefix'] + '_' + team_info['Team']
+            chart_j = {'widgets' : [widget for svc in team_info['MonitorDefs'] for widget
+                                    in all_widgets[target_prefix(target) + svc]]}
+            with use_target(target), timed_phase('team', 'dashboards'):
                 generate_dashboard(name, chart_j)
+
+
+def main(event, context):
+    """
+    Main functionality
+    """
+    now_str = strftime('%c')
+    started = time.time()
+    reset_metrics()
+    RUN_BUDGET.start(context)
+    CLOUDWATCH_RATES.reset_budget()
+    with REPORT_LOCK:
+        REPORT_DIGEST.clear()
+
+    ##### PROGRAM FLOW #####
+    # Load team file
+    team_info = load_monitor_file(TEAM_FILEPATH)
+    errors = validate_schema(team_info, TEAM_SCHEMA)
+    if errors:
+        Logger.critical('Invalid team file ' + TEAM_FILEPATH + ': ' + '; '.join(errors))
+        return
+    if team_info.get('AlarmWriteTPS'):
+        CLOUDWATCH_RATES.set_rate('PutMetricAlarm', team_info['AlarmWriteTPS'])
+    for operation, rate in team_info.get('CloudWatchTPS', {}).items():
+        CLOUDWATCH_RATES.set_rate(operation, rate)
+
+    instance_event = parse_instance_event(event)
+    if isinstance(event, dict) and 'zumocoShard' in event:
+        # Worker invocation from the orchestrator
+        run_shard(team_info, event['zumocoShard'], now_str)
+    elif instance_event is not None:
+        # EventBridge lifecycle event for a single instance
+        target = event_target(team_info, event)
+        if target is False:
+            Logger.warning('Ignoring event from ' + str(event.get('account')) + ' ' +
+                           str(event.get('region')) + ', not in Targets')
         else:
-            Logger.warning('No permissions for listing instances. Service: ')
-            Logger.warning(svc_info['Service'])
-    # If team dashboard is requested, create one
-    if team_info['CreateTeamDashboard']:
-        name = svc_info['AlarmPrefix'] + '_' + team_info['Team']
-        chart_j = {'widgets' : all_widgets}
-        delete_dashboards(get_dashboards(name))
-        generate_dashboard(name, chart_j)
+            handle_instance_event(team_info, *instance_event, target=target)
+    elif team_info.get('Sharding'):
+        # Orchestrator: workers do the discovery and alarm work
+        orchestrate(team_info)
+    else:
+        run_team(team_info, now_str)
+
+    if team_info.get('EmitMetrics', True):
+        emit_metrics(team_info['Team'], (time.time() - started) * 1000)
 
 
 #main('foo', 'bar')